@@ -1,5 +1,10 @@
 import os
+import re
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from rohan.meter.FwMan import Walker
+from rohan.meter.utils import cache_dir
 from typing import List
 from rohan.meter.Walker import OWI_URL
 
@@ -58,16 +63,105 @@ def get_name_from_url(url):
         name = name + "Agent"
     return name, version
 
+def version_key(version):
+    """ sort key of a version string, numbers compare as numbers so 1.10 comes after 1.9 """
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split(r'[.\-_]', version)]
+
 class AgentInfoAuto(AgentInfo):
     def __init__(self, url, container_id=rohan_CONTAINER_ID, depends_on=[]):
         name,version = get_name_from_url(url)
         super().__init__(name, version, container_id, url, depends_on)
 
+class AgentCatalog:
+    """ cached index of DI agents: name, version, flavour (DevInternal/Release) and _TS.zip url
+
+    Each agent is crawled with one glob over DI_Agents/<name>/*/*/*_TS.zip,
+    several agents at once, and kept in sqlite in the host cache directory
+    for Walker.CACHE_TTL seconds.
+    """
+    def __init__(self, db_file=None, ttl=Walker.CACHE_TTL, jobs=8):
+        self.db_file = db_file if db_file else os.path.join(cache_dir(), "agents.db")
+        self.ttl = ttl
+        self.jobs = jobs
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS agent (name TEXT, version TEXT, flavour TEXT, url TEXT, seq INTEGER);
+                CREATE INDEX IF NOT EXISTS agent_name ON agent (name, version);
+                CREATE TABLE IF NOT EXISTS loaded (name TEXT PRIMARY KEY, time REAL);
+            """)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def _query(self, query, args=()):
+        conn = self._connect()
+        try:
+            return conn.execute(query, args).fetchall()
+        finally:
+            conn.close()
+
+    def _crawl(self, name):
+        rows = []
+        for seq, url in enumerate(Walker.glob(f"{OWI_URL}DI_Agents/{name}/*/*/*_TS.zip")):
+            parts = url.split('DI_Agents/', 1)[1].split('/')
+            rows.append((name, parts[1], parts[2], url, seq))
+        return name, rows
+
+    def load(self, names, refresh=False):
+        """ crawl the agents that are not cached, all at once """
+        names = set(names)
+        if not refresh:
+            fresh = {row[0] for row in self._query("SELECT name FROM loaded WHERE time > ?", (time.time() - self.ttl,))}
+            names -= fresh
+        if not names:
+            return
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            results = list(executor.map(self._crawl, sorted(names)))
+        conn = self._connect()
+        try:
+            with conn:
+                for name, rows in results:
+                    conn.execute("DELETE FROM agent WHERE name = ?", (name,))
+                    conn.executemany("INSERT INTO agent VALUES (?, ?, ?, ?, ?)", rows)
+                    conn.execute("INSERT OR REPLACE INTO loaded VALUES (?, ?)", (name, time.time()))
+        finally:
+            conn.close()
+
+    def versions(self, name):
+        """ versions of an agent that have a package, oldest first """
+        self.load([name])
+        rows = self._query("SELECT DISTINCT version FROM agent WHERE name = ?", (name,))
+        return sorted((row[0] for row in rows), key=version_key)
+
+    def url(self, name, version):
+        """ package to install for an agent version, DevInternal is preferred over Release """
+        self.load([name])
+        rows = self._query("SELECT flavour, url FROM agent WHERE name = ? AND version = ? ORDER BY seq", (name, version))
+        for flavour in ('DevInternal', 'Release'):
+            urls = [url for kind, url in rows if flavour in kind]
+            if flavour == 'DevInternal' and len(urls) > 1:
+                urls = [url for url in urls if os.path.basename(url).startswith(name) or os.path.basename(url).startswith('signed-')]
+            if urls:
+                return urls[0]
+        return None
+
+
 class AgentMan:
+    def __init__(self, catalog=None):
+        self._catalog = catalog
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = AgentCatalog()
+        return self._catalog
+
     def get_versions(self, name):
-        agentdir = f"{OWI_URL}DI_Agents/{name}"
-        versions = Walker.glob(agentdir + '/*')
-        return versions
+        return [f"{OWI_URL}DI_Agents/{name}/{version}/" for version in self.catalog.versions(name)]
 
     def get_rel_agent(self, name, rel_ver):
         versions = self.get_versions(name)
@@ -75,17 +169,13 @@ class AgentMan:
         return self.get_agent(name, version)
 
     def get_agent(self, name, version):
-        types = Walker.glob(version + '*')
-        match = [match for match in types if 'DevInternal' in match]
-        url = None
-        if match:
-            urls=Walker.glob(os.path.join(match[0], '*_TS.zip'))
-            if len(urls) > 1:
-                urls = [url for url in urls if os.path.basename(url).startswith(name) or os.path.basename(url).startswith('signed-')]
-            url = urls[0]
-        else:
-            match = [match for match in types if 'Release' in match]
-            url=Walker.glob(os.path.join(match[0], '*_TS.zip'))
+        """! agent package for a version
+
+        @param name     agent directory name in DI_Agents
+        @param version  version, or its url from get_versions()
+        """
+        version = os.path.basename(version.rstrip('/'))
+        url = self.catalog.url(name, version)
 
         assert url, "don't know how to process agent download path"
         agentname,version = get_name_from_url(url)
@@ -95,3 +185,66 @@ class AgentMan:
         container = rohan_CONTAINER_ID
         return AgentInfo(name, version, container, url)
 
+    def install_plan(self, agents):
+        """! resolve a set of agents and their dependencies in one pass
+
+        @param agents  list of AgentInfo, (name, version) or name (latest version).
+                       AgentInfo without a url are resolved by name and version.
+        @return list of AgentInfo with urls, every agent after the agents it depends on
+        """
+        requested = []
+        for agent in agents:
+            if isinstance(agent, AgentInfo):
+                requested.append(agent)
+            elif isinstance(agent, str):
+                requested.append(AgentInfo(agent, None, rohan_CONTAINER_ID, None))
+            else:
+                requested.append(AgentInfo(agent[0], agent[1], rohan_CONTAINER_ID, None))
+
+        # every agent in the graph, copied so the caller's agents are not changed
+        copies = {}
+        pending = list(requested)
+        while pending:
+            agent = pending.pop()
+            if id(agent) in copies:
+                continue
+            copies[id(agent)] = (agent, AgentInfo(agent.name, agent.version, agent.container_id, agent.url,
+                                                  [], agent.has_daemon, agent.reg_name))
+            pending.extend(agent.depends_on)
+        for agent, copy in copies.values():
+            copy.depends_on = [copies[id(dependency)][1] for dependency in agent.depends_on]
+        every = [copy for _, copy in copies.values()]
+        requested = [copies[id(agent)][1] for agent in requested]
+        self.catalog.load([agent.name for agent in every if not agent.url])
+
+        # an agent asked for without a version takes the version another request pins
+        pinned = {agent.name: agent.version for agent in every if agent.version and not agent.url}
+        pinned.update({agent.name: agent.version for agent in every if agent.url})
+        for agent in every:
+            if not agent.url:
+                versions = self.catalog.versions(agent.name)
+                assert versions, f"no packages for agent {agent.name}"
+                version = agent.version or pinned.get(agent.name) or versions[-1]
+                url = self.catalog.url(agent.name, version)
+                assert url, f"no package for agent {agent.name} {version}"
+                agent.url = url
+                agent.version = get_name_from_url(url)[1]
+
+        plan = []
+        state = {}
+        def visit(agent, chain):
+            done = state.get(agent.name)
+            if done is not None:
+                if done.url != agent.url:
+                    raise ValueError(f"agent {agent.name} requested as {done.url} and {agent.url}")
+                if done in chain:
+                    raise ValueError(f"dependency cycle: {' -> '.join(a.name for a in chain + [agent])}")
+                return
+            state[agent.name] = agent
+            for dependency in agent.depends_on:
+                visit(dependency, chain + [agent])
+            plan.append(agent)
+
+        for agent in requested:
+            visit(agent, [])
+        return plan
@@ -2,13 +2,41 @@ from operator import truediv
 import os
 import re
 import git
-import yaml
+import time
+import sqlite3
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from .utils import cache_dir
+from .VersionStore import sort_key
 
 build_path = [
     '/mnt/ral-rdgbuild-03/DI_APPSERVICES/NightlyBuilds/Latest'
     ]
 
+SUFFIX = {
+    'release': "bionic-x86_64/TargetRelease/FinalPackage",
+    'debug': "bionic-x86_64/TargetDebug/FinalPackage",
+}
+
+# nightly directories younger than this are scanned again, their packages may still be coming
+RESCAN_AGE = 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS build (
+    version TEXT,
+    kind TEXT,
+    entry TEXT,
+    path TEXT,
+    sort_key TEXT,
+    PRIMARY KEY (version, kind, entry)
+);
+CREATE TABLE IF NOT EXISTS scanned (
+    entry TEXT PRIMARY KEY,
+    mtime REAL,
+    complete INTEGER
+);
+"""
+
 
 def get_gittop():
     repo = git.Repo('.', search_parent_directories=True)
@@ -24,54 +52,132 @@ def get_zip(dir):
     assert len(di) == 1
     return os.path.join(dir, di[0])
 
+
+class AsIndex:
+    """ index of the DI AppServices nightly packages, release and debug
+
+    Kept in sqlite in the host cache directory.  update() only scans
+    nightly directories it has not seen, or recent ones that were missing
+    a package, with os.scandir on a thread pool.
+
+    Usage:
+        index = AsIndex()
+        index.update()
+        zip_file = index.find('1.5.317', release=False)
+    """
+    def __init__(self, prefix=None, db_file=None, jobs=16, logger=None):
+        self.prefix = prefix if prefix else build_path[0]
+        self.db_file = db_file if db_file else os.path.join(cache_dir(), "asman.db")
+        self.jobs = jobs
+        self.logger = logger if logger else logging.getLogger(__name__)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def find(self, version, release=False):
+        """! newest package whose version matches the regex `version`
+
+        @return path of the zip file, None if not indexed
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT version, path FROM build WHERE kind = ? ORDER BY sort_key, entry",
+                                ('release' if release else 'debug',)).fetchall()
+        finally:
+            conn.close()
+        matches = [path for ver, path in rows if re.match(version, ver)]
+        if len(set(matches)) > 1:
+            self.logger.warning("many versions matching %s.  Returning the last entry", version)
+        return matches[-1] if matches else None
+
+    def _scan_entry(self, entry):
+        """ (entry, mtime, [(version, kind, path)], complete) for one nightly directory """
+        path = os.path.join(self.prefix, entry.name)
+        found = []
+        for kind, suffix in SUFFIX.items():
+            try:
+                with os.scandir(os.path.join(path, suffix)) as it:
+                    di = [e.name for e in it if re.match("DI-AppServices-Package.*zip", e.name)]
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if len(di) != 1:
+                self.logger.warning("%s DI packages in %s", len(di), os.path.join(path, suffix))
+                continue
+            ver = re.search("Package-([0123456789.]+)_[TtPp][sS]", di[0])
+            if ver:
+                found.append((ver[1], kind, os.path.join(path, suffix, di[0])))
+        return entry.name, entry.stat().st_mtime, found, len(found) == len(SUFFIX)
+
+    def update(self):
+        """ scan new nightly directories, returns the number scanned """
+        conn = self._connect()
+        try:
+            scanned = {row[0]: row[1:] for row in conn.execute("SELECT entry, mtime, complete FROM scanned")}
+        finally:
+            conn.close()
+
+        now = time.time()
+        todo = []
+        with os.scandir(self.prefix) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                seen = scanned.get(entry.name)
+                if seen:
+                    mtime, complete = seen
+                    if complete or (entry.stat().st_mtime == mtime and now - mtime > RESCAN_AGE):
+                        continue
+                todo.append(entry)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            results = list(executor.map(self._scan_entry, todo))
+
+        conn = self._connect()
+        try:
+            with conn:
+                for name, mtime, found, complete in results:
+                    for version, kind, path in found:
+                        conn.execute("INSERT OR REPLACE INTO build VALUES (?, ?, ?, ?, ?)",
+                                     (version, kind, name, path, sort_key(version)))
+                    conn.execute("INSERT OR REPLACE INTO scanned VALUES (?, ?, ?)", (name, mtime, int(complete)))
+        finally:
+            conn.close()
+        return len(todo)
+
+    def forget(self, path):
+        """ drop a package that no longer exists, its directory is scanned again """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM scanned WHERE entry IN (SELECT entry FROM build WHERE path = ?)", (path,))
+                conn.execute("DELETE FROM build WHERE path = ?", (path,))
+        finally:
+            conn.close()
+
+
 def get_build(version=None, release=False, logger=None):
-    found = None
-    fast_lookup = {}
+    """! find the DI AppServices package for a version regex
+
+    served from the AsIndex without listing any directory when the version is known,
+    otherwise the new nightly directories are scanned first
 
+    @return path of the package zip, None if not found
+    """
     if not logger:
         logger = logging.getLogger()
 
-    cache_file = os.path.join(get_gittop(), ".di_versions_cache.yaml")
-    if os.path.exists(cache_file):
-        with open(cache_file, "r") as f:
-            fast_lookup = yaml.safe_load(f)
-
-    dirs = os.listdir(build_path[0])
-    prefix=build_path[0]
-    suffix = "bionic-x86_64/TargetRelease/FinalPackage" if release else "bionic-x86_64/TargetDebug/FinalPackage"
-
-    # find all matching versions
-    matches = [value for key, value in fast_lookup.items() if re.match(version, key)]
-    if matches:
-        if len(matches) > 1:
-            logger.warning("many versions matching %s.  Returning the last entry", version)
-        found = matches[-1]
-    else:
-        # could not find version in cache, so scan the directories (slow)
-        for entry in dirs:
-            if entry in fast_lookup.values():
-                continue
-            try:
-                path = os.path.join(prefix, entry, suffix)
-                files = os.listdir(path)
-                r = re.compile("DI-AppServices-Package.*zip")
-                di = list(filter(r.match, files)) # Read Note below
-                if di:
-                    filename = di[0]
-                    ver=re.search("Package-([0123456789.]+)_[TtPp][sS]", filename)
-                    fver = ver[1]
-                    fullname = os.path.join(path, filename)
-                    if fver in fast_lookup.keys():
-                        logger.error("multiple directories with same version: %s", version)
-                        logger.error("  %s and %s", fast_lookup[fver], entry)
-                    fast_lookup[fver] = entry
-                    if re.match(version, fver):
-                        found = fullname
-                        break
-            except FileNotFoundError:
-                pass
-
-        with open(cache_file, "w", ) as f:
-            yaml.dump(fast_lookup, f, default_flow_style=False,indent=True)
-
-    return get_zip(os.path.join(prefix, found, suffix)) if found else None
+    index = AsIndex(logger=logger)
+    found = index.find(version, release)
+    while found and not os.path.exists(found):
+        index.forget(found)
+        found = index.find(version, release)
+    if not found:
+        index.update()
+        found = index.find(version, release)
+    return found
@@ -0,0 +1,177 @@
+"""
+Build catalog indexer
+
+Scans the GEN5 RIVA build directories and records every build in the
+firmware version catalog (rohan.meter.VersionStore):
+
+    fw_version, fw_path, base_path, coldstart, as_ver, han_ver
+    packages: {package type: {url, name, size, modified, sha256}}
+    signature: names, sizes and dates of the packages
+
+A build whose signature has not changed since the last run is skipped, so
+a run only lists the build directories and reads the new or rebuilt builds.
+Builds are processed on a worker pool.
+
+FwMan.get_build() and FwMan.get_build_ex() are served from the catalog.
+
+Usage:
+    fw-index                     # index new and changed builds
+    fw-index --full --jobs 16    # re-index everything
+"""
+import os
+import re
+import json
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from . import Walker
+from . import FwMan
+from .Manifest import PackageManifest, preinstall_versions, sha256_file, CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+DISTRO_DIR = 'Distribution-Files/Gen5RivaMeter-Dev'
+
+
+def build_version(build):
+    """ firmware version from a build directory name, FW_10_5_633_1 -> 10.5.633.1, None if not a build """
+    fw_ver = re.search("FW_(10[0123456789_]+)", build)
+    return fw_ver[1].strip('_').replace('_', '.') if fw_ver else None
+
+
+def file_digest(path):
+    """ SHA-256 of a package on the mount or the web server """
+    if os.path.exists(path):
+        return sha256_file(path)
+    digest = hashlib.sha256()
+    with Walker.get_crawler().session.get(path, stream=True, timeout=(60, 400)) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_packages(distro, refresh=False):
+    """! find the package of each type in a build
+
+    @param distro  .../Distribution-Files/Gen5RivaMeter-Dev of the build
+    @return {package type: {url, name, size, modified}}, types without exactly one zip are left out
+    """
+    try:
+        items = Walker.listdir(distro, refresh=refresh)
+    except FileNotFoundError:
+        return {}
+    packages = {}
+    for item in FwMan.PACKAGE_TYPES:
+        if item not in items and item[:-1] not in items:
+            continue
+        path = os.path.join(distro, item)
+        names = Walker.listdir(path, refresh=refresh)
+        zips = [name for name in names if name.endswith('zip')]
+        if len(zips) != 1:
+            logger.info("skipping %s, %s zip files", path, len(zips))
+            continue
+        url = os.path.join(path, zips[0])
+        size, modified = Walker.stat(url) or (None, None)
+        packages[item[:-1]] = {'url': url, 'name': zips[0], 'size': size, 'modified': modified}
+    return packages
+
+
+def signature(packages):
+    """ changes when a package is added, removed or rebuilt """
+    return json.dumps(sorted((kind, p['name'], p['size'], p['modified']) for kind, p in packages.items()))
+
+
+class BuildIndexer:
+    """ keep the version catalog in step with the build directories """
+    def __init__(self, store=None, jobs=8, digests=True, agents=True, refresh=False):
+        """
+        @param store    VersionStore, default is FwMan.version_tree
+        @param jobs     builds processed at the same time
+        @param digests  record the SHA-256 of every package (downloads them)
+        @param agents   record the DI AppServices and HAN versions (downloads and decrypts the coldstart)
+        @param refresh  re-list directories and re-index builds that have not changed
+        """
+        self.store = store if store is not None else FwMan.version_tree
+        self.jobs = jobs
+        self.digests = digests
+        self.agents = agents
+        self.refresh = refresh
+
+    def builds(self, build_paths):
+        """ (fw_version, build directory) for every build under the build paths, first path wins """
+        found = {}
+
+        def list_path(path):
+            try:
+                return path, Walker.listdir(path, refresh=self.refresh)
+            except FileNotFoundError:
+                logger.info("empty %s", path)
+                return path, []
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for path, dirs in executor.map(list_path, build_paths):
+                for build in sorted(dirs, reverse=True):
+                    fw_ver = build_version(build)
+                    if fw_ver and fw_ver not in found:
+                        found[fw_ver] = build if build.startswith(path) else os.path.join(path, build)
+        return list(found.items())
+
+    def index_build(self, fw_ver, cwd):
+        """! index one build
+
+        @return 'added', 'updated', 'unchanged' or 'skipped' (no coldstart package)
+        """
+        distro = os.path.join(cwd, DISTRO_DIR)
+        packages = find_packages(distro, self.refresh)
+        if 'ColdStartPackage' not in packages:
+            return 'skipped'
+
+        old = self.store.get(fw_ver)
+        sig = signature(packages)
+        if old and old.get('signature') == sig and not self.refresh:
+            return 'unchanged'
+
+        coldstart = packages['ColdStartPackage']['url']
+        data = {
+            'fw_version': fw_ver,
+            'fw_path': cwd,
+            'base_path': distro,
+            'coldstart': coldstart,
+            'packages': packages,
+            'signature': sig,
+        }
+        if self.agents:
+            data.update(preinstall_versions(FwMan.get_preinstall(coldstart)))
+        if self.digests:
+            manifest = PackageManifest() if self.agents else None
+            for package in packages.values():
+                # the coldstart was just downloaded and indexed by get_preinstall
+                sha = manifest.lookup(package['url']) if manifest else None
+                package['sha256'] = sha if sha else file_digest(package['url'])
+
+        self.store.put(data)
+        logger.info("%s %s, AS version %s", 'updated' if old else 'added', fw_ver, data.get('as_ver'))
+        return 'updated' if old else 'added'
+
+    def run(self, build_paths=None):
+        """! index every build under build_paths, default is FwMan.get_build_path()
+
+        @return {fw_version: result of index_build, or the exception}
+        """
+        if build_paths is None:
+            build_paths = FwMan.get_build_path()
+        if isinstance(build_paths, str):
+            build_paths = [build_paths]
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {executor.submit(self.index_build, fw_ver, cwd): fw_ver for fw_ver, cwd in self.builds(build_paths)}
+            for future in as_completed(futures):
+                fw_ver = futures[future]
+                try:
+                    results[fw_ver] = future.result()
+                except Exception as e:
+                    logger.exception("failed to index %s", fw_ver)
+                    results[fw_ver] = e
+        return results
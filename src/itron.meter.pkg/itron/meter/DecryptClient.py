@@ -0,0 +1,369 @@
+"""
+Client for the fwdl decrypt service
+
+    curl -F "fwdl=@DI-AppServices-Package-1.5.270.0.tar.gz" http://ral-rdpwsgi-01.rohan.com/fwdl-decrypter --output decrypted.tar.gz
+
+The client keeps one HTTP session per thread, streams the upload and the
+download in large chunks, and runs several packages at once with
+decrypt_many().  Results are kept in a DecryptStore keyed by the SHA-256
+of the encrypted file, so a package is only sent to the service once.
+
+StandInServer is a small local replacement for the service (it returns
+the upload unchanged) so the client can be tested and benchmarked
+offline:
+
+    python -m rohan.meter.DecryptClient --serve 8123
+    FWDL_DECRYPT_URL=http://localhost:8123/fwdl-decrypter mm ...
+"""
+import os
+import re
+import time
+import uuid
+import shutil
+import socket
+import logging
+import argparse
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .utils import cache_dir, Coalescer
+from .Manifest import sha256_file
+
+logger = logging.getLogger(__name__)
+
+DECRYPT_URL = os.getenv("FWDL_DECRYPT_URL", 'http://ral-rdpwsgi-01.rohan.com/fwdl-decrypter')
+CHUNK_SIZE = 1024 * 1024
+SERVICE_KEY_CLASS = 'fwdl'
+
+
+class _MultipartFile:
+    """ multipart/form-data body that reads the file as it is sent
+
+    requests sends a Content-Length for objects with __len__, so the file
+    is streamed instead of being built into one large body in memory.
+    """
+    def __init__(self, field, file_name):
+        self.boundary = uuid.uuid4().hex
+        self.fileobj = open(file_name, 'rb')
+        self.parts = [
+            (f'--{self.boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+             f'filename="{os.path.basename(file_name)}"\r\n'
+             f'Content-Type: application/octet-stream\r\n\r\n').encode(),
+            self.fileobj,
+            f'\r\n--{self.boundary}--\r\n'.encode(),
+        ]
+        self.length = len(self.parts[0]) + os.path.getsize(file_name) + len(self.parts[2])
+        self.current = 0
+        self.offset = 0
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        size = CHUNK_SIZE if size is None or size < 0 else size
+        data = b''
+        while len(data) < size and self.current < len(self.parts):
+            part = self.parts[self.current]
+            if isinstance(part, bytes):
+                chunk = part[self.offset:self.offset + size - len(data)]
+                self.offset += len(chunk)
+                if self.offset >= len(part):
+                    self.current += 1
+                    self.offset = 0
+            else:
+                chunk = part.read(size - len(data))
+                if not chunk:
+                    self.current += 1
+            data += chunk
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+class DecryptClient:
+    """ decrypt packages with the fwdl decrypt service
+
+    Usage:
+        client = DecryptClient()
+        client.decrypt('package.tar.gz', 'decrypted.tar.gz')
+        client.decrypt_many([('a.tar.gz', 'a.dec'), ('b.tar.gz', 'b.dec')])
+    """
+    def __init__(self, url=None, cache=True, workers=4, chunk_size=CHUNK_SIZE, retry_timeout=10*60, logger=logger):
+        """
+        @param url            decrypt service url, default is FWDL_DECRYPT_URL or the rohan server
+        @param cache          DecryptStore or directory for decrypted results, True for the default store, None for no cache
+        @param workers        packages decrypted at the same time by decrypt_many
+        @param chunk_size     size of the chunks read from the service
+        @param retry_timeout  seconds to keep retrying when the service can not be reached
+        """
+        self.url = url if url else DECRYPT_URL
+        self.cache = get_store() if cache is True else DecryptStore(cache) if isinstance(cache, str) else cache
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.retry_timeout = retry_timeout
+        self.logger = logger
+        self.local = threading.local()
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.inflight = Coalescer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions:
+                session.close()
+            self.sessions = []
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        """ requests sessions are not thread safe, so keep one per thread """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers['User-Agent'] = 'Mozilla/5.0'
+            self.local.session = session
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def decrypt(self, encrypted_file, target, logger=None):
+        """! decrypt a file
+
+        @param encrypted_file  encrypted package (the .tar.gz inside the signed zip)
+        @param target          file name for the decrypted result
+        @param logger          logger for this call, default the logger of the client
+
+        @return target
+        """
+        logger = logger or self.logger
+        digest = sha256_file(encrypted_file)
+
+        # concurrent requests for the same file share the first caller's upload and copy its result
+        result = self.inflight.run(digest, self._decrypt, encrypted_file, target, digest, logger)
+        if result != target:
+            _copy(self.cache.path(digest, SERVICE_KEY_CLASS) if self.cache else result, target)
+        return target
+
+    def _decrypt(self, encrypted_file, target, digest, logger):
+        if not self.cache:
+            return self._post(encrypted_file, target, logger)
+        if self.cache.get(digest, SERVICE_KEY_CLASS, target):
+            logger.info("decrypt cache hit for %s", os.path.basename(encrypted_file))
+            return target
+        self._post(encrypted_file, target, logger)
+        self.cache.put(target, digest, SERVICE_KEY_CLASS)
+        return target
+
+    def decrypt_many(self, jobs):
+        """! decrypt several files at once
+
+        @param jobs  list of (encrypted_file, target)
+
+        @return list of targets in the same order
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.decrypt, src, target) for src, target in jobs]
+            return [f.result() for f in futures]
+
+    def _post(self, encrypted_file, result, logger):
+        partial = f"{result}.{os.getpid()}.{threading.get_ident()}.part"
+        end_time = time.time() + self.retry_timeout
+        delay = 5
+        while True:
+            body = _MultipartFile('fwdl', encrypted_file)
+            try:
+                logger.debug("Request %s", encrypted_file)
+                start = time.time()
+                with self.session.post(self.url, data=body, headers={'Content-Type': body.content_type},
+                                       stream=True, timeout=(60, 400)) as resp:
+                    resp.raise_for_status()
+                    with open(partial, "wb") as f:
+                        for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                            f.write(chunk)
+                os.replace(partial, result)
+                logger.info("decrypted %s in %.1fs", os.path.basename(encrypted_file), time.time() - start)
+                return result
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if time.time() + delay > end_time:
+                    logger.error("timeout decrypting package")
+                    raise TimeoutError("timeout decrypting package") from e
+                logger.warning("Connection error with %s, retry in %ss", self.url, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+            finally:
+                body.close()
+                if os.path.exists(partial):
+                    os.remove(partial)
+
+
+class DecryptStore:
+    """ decrypted packages keyed by the SHA-256 of the encrypted file and the key class
+
+    The key class names the key that decrypted the file: SERVICE_KEY_CLASS
+    for the fwdl decrypt service, or the device key fingerprint of a meter
+    (see SSHGen5Meter.device_key_class), since meters with different keys
+    produce different results for the same file.
+
+    The default location is ROHAN_DECRYPT_STORE, so a directory shared by
+    every host in the shop can be used, otherwise the host cache directory.
+    Files are published with a rename, so readers never see a partial file.
+
+        <root>/<key class>/<digest[:2]>/<digest>.tar.gz
+    """
+    def __init__(self, root=None):
+        self.root = root if root else os.getenv("ROHAN_DECRYPT_STORE") or cache_dir("decrypt")
+
+    def path(self, digest, key_class):
+        return os.path.join(self.root, key_class, digest[:2], digest + ".tar.gz")
+
+    def has(self, digest, key_class):
+        return os.path.exists(self.path(digest, key_class))
+
+    def get(self, digest, key_class, target):
+        """! copy a stored result to target
+
+        @return target, or None if the result is not in the store
+        """
+        name = self.path(digest, key_class)
+        if not os.path.exists(name):
+            return None
+        _copy(name, target)
+        return target
+
+    def put(self, src, digest, key_class):
+        """ add the decrypted file `src`, an existing entry is kept """
+        name = self.path(digest, key_class)
+        if os.path.exists(name):
+            return name
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        tmp = f"{name}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            shutil.copyfile(src, tmp)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, name)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return name
+
+
+def _copy(src, target):
+    """ copy through a temporary name so target is never partial """
+    tmp = target + ".part"
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, target)
+
+
+_client = None
+_store = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """ the client shared by everything in this process """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = DecryptClient()
+        return _client
+
+
+def get_store():
+    """ the decrypt store shared by everything in this process """
+    global _store
+    with _client_lock:
+        if _store is None:
+            _store = DecryptStore()
+        return _store
+
+
+class StandInServer:
+    """ local stand-in for the decrypt service
+
+    Accepts the same multipart upload and returns the 'fwdl' field
+    unchanged.  `delay` adds a fixed service time per request.
+
+    Usage:
+        with StandInServer() as server:
+            client = DecryptClient(server.url, cache=None)
+    """
+    def __init__(self, port=0, delay=0.0):
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                server.requests += 1
+                length = int(self.headers['Content-Length'])
+                boundary = re.search('boundary=(.+)', self.headers['Content-Type'])[1].encode()
+                body = self.rfile.read(length)
+                start = body.index(b'\r\n\r\n') + 4
+                end = body.rindex(b'\r\n--' + boundary)
+                time.sleep(delay)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(end - start))
+                self.end_headers()
+                view = memoryview(body)[start:end]
+                for offset in range(0, len(view), CHUNK_SIZE):
+                    self.wfile.write(view[offset:offset + CHUNK_SIZE])
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.httpd = ThreadingHTTPServer(('localhost', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://localhost:{self.httpd.server_address[1]}/fwdl-decrypter'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fwdl decrypt client and local stand-in server')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='run the stand-in server on PORT')
+    parser.add_argument('--delay', type=float, default=0.0, help='stand-in service time per request (seconds)')
+    parser.add_argument('--url', type=str, help='decrypt service url')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the decrypt store')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='packages to decrypt at once')
+    parser.add_argument('files', nargs='*', help='encrypted files, decrypted to FILE.decrypted')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.serve is not None:
+        server = StandInServer(args.serve, args.delay)
+        print("serving", server.url)
+        server.thread.join()
+        return
+
+    with DecryptClient(args.url, cache=None if args.no_cache else True, workers=args.jobs) as client:
+        start = time.time()
+        client.decrypt_many([(f, f + ".decrypted") for f in args.files])
+        print("decrypted %s files in %.1fs" % (len(args.files), time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,15 @@ import re
 import tempfile
 import requests
 import zipfile
-import tarfile
 import time
 import logging
 from . import Walker
-import json
+from . import Repack
+from . import Manifest
+from . import DecryptClient
+from .VersionStore import VersionStore
+from .utils import Coalescer
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -19,53 +23,34 @@ def get_build_path():
     return _build_internal
 
 def get_version_data():
-    """ this file is created by running:
-        pytest pytest-regress-venv/src/rohan.meter.pkg/rohan/meter/test_fwman.py::test_make_fw_dict
+    """ the firmware version catalog, see rohan.meter.VersionStore
 
-        That testcase will scan the OWI_BUILDS web site for new builds
+        The catalog is filled by running the fw-index command (rohan.meter.BuildCatalog)
+
+        That command will scan the OWI_BUILDS web site for new and changed builds
 
         This increases the speed of firmware lookups when installing, as we can translate
-        the version to the location instantly
+        the version to the location instantly.  Nothing is read until the first lookup.
     """
-    if os.path.exists("version_data.json"):
-        logger.info(f"Using version_data.json")
-        with open("version_data.json", 'r') as f:
-            index = json.load(f)
-            return index
-    else:
-        return []
+    return VersionStore()
 
 version_tree = get_version_data()
 
 
 
 def decrypt(encrypted_file, target, logger=logging):
-    # curl -F "fwdl=@DI-AppServices-Package-1.5.270.0.tar.gz" http://ral-rdpwsgi-01.rohan.com/fwdl-decrypter --output decrypted.tar.gz
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    link    = 'http://ral-rdpwsgi-01.rohan.com/fwdl-decrypter'
-    with requests.Session() as session:
-        with open(encrypted_file, 'rb') as xmit_file:
-            files = {'fwdl': xmit_file}
-            retry = True
-            end_time = time.time() + 10*60
-            while time.time() < end_time:
-                try:
-                    logger.debug("Request")
-                    with session.post(link,headers=headers, files=files, stream=True, timeout=(400,400)) as resp:
-                        with open(target, "wb") as f:
-                            logger.debug("writing chunk")
-                            for chunk in resp.iter_content(chunk_size=1024):
-                                f.write(chunk)
-                    retry = False
-                    break
-                except requests.exceptions.ConnectionError:
-                    logger.exception("Connection error with %s", link)
-                    time.sleep(60)
-                    continue
-            if retry:
-                logger.error("timeout decrypting package")
-                raise TimeoutError("timeout decrypting package")
-    return target
+    """! decrypt a package with the fwdl decrypt service
+
+    results are cached on this host by the digest of `encrypted_file`,
+    see rohan.meter.DecryptClient
+
+    @param encrypted_file  encrypted .tar.gz from the signed package
+    @param target          file name for the decrypted package
+    @param logger          logger for the progress messages
+
+    @return target
+    """
+    return DecryptClient.get_client().decrypt(encrypted_file, target, logger=logger)
 
 def _find_file(path, str):
     for root, dirs, files in Walker.walk(path):
@@ -77,13 +62,24 @@ def _find_file(path, str):
 def get_preinstall(fw_package, as_dir=None):
     """! get the  PreInstall packages from the fw_package
 
+    The package contents are indexed (rohan.meter.Manifest) the first time a
+    package is seen, later calls are answered from the index without
+    downloading or decrypting the package.
+
     @param fw_package   file name of signed package
     @param as_dir       name of directory to extract the packages to
 
     @return name of AS package
      """
+    manifest = Manifest.PackageManifest()
+    if not as_dir:
+        sha = manifest.lookup(fw_package)
+        if sha:
+            logger.info("Using manifest for %s", fw_package)
+            return manifest.preinstall(sha)
 
     with tempfile.TemporaryDirectory() as TMP:
+        source = fw_package
         if not fw_package.startswith("http://"):
             assert os.path.exists(fw_package), "Fw package does not exist"
         else:
@@ -95,6 +91,11 @@ def get_preinstall(fw_package, as_dir=None):
                     file.write(chunk)
             fw_package = zipfile_name
 
+        sha = Manifest.sha256_file(fw_package)
+        if not as_dir and manifest.has(sha):
+            manifest.add_source(source, sha)
+            return manifest.preinstall(sha)
+
         asdir = os.path.join(TMP, "AppServ")
         os.mkdir(asdir)
         with zipfile.ZipFile(fw_package) as z:
@@ -107,44 +108,13 @@ def get_preinstall(fw_package, as_dir=None):
         if not os.path.exists(decrypted):
             decrypt(INTERNAL, decrypted)
 
-        FILENAME=os.path.basename(fw_package)[7:]
-
-        rfs = os.path.join(TMP, "rootfs")
-        l1 = os.path.join(TMP, "layer1")
-        l2 = os.path.join(TMP, "layer2")
-        os.mkdir(rfs)
-        os.mkdir(l1)
-        os.mkdir(l2)
-        with tarfile.open(name=SRC,mode="r:gz") as t:
-            t.extractall(l1)
-
-        # Find .xz file and extract it to layer2
-
-        iner = _find_file(l1, ".xz")
-        mode='r:xz'
-        if not iner:
-            iner = _find_file(l1, ".gz")
-            mode='r:gz'
-
-        INNER=os.path.join(l1, iner)
-
-        with tarfile.open(name=INNER,mode=mode) as t:
-            t.extractall(l2)
-
-        # now we should have the rootfs.tar.gz in layer2, so extract that
-        ROOTFS=os.path.join(l2, "rootfs.tar.gz")
-        with tarfile.open(name=ROOTFS,mode='r:gz') as t:
-            items = t.getmembers()
-
-        didir = 'usr/share/rohan/PreInstall'
-        cur_pack = []
-        for i in items:
-            # if this is a preinstall file, fetch it
-            if re.search(didir, i.path):
-                cur_pack.append(i.path)
-                if as_dir:
-                    t.extract(i, as_dir)
-        return cur_pack
+        if not manifest.has(sha):
+            manifest.index(sha, fw_package, SRC, fw_package=source)
+
+        # stream the PreInstall files out of the nested layers, nothing else is unpacked
+        if as_dir:
+            return Repack.extract(SRC, as_dir, layers=Repack.PACKAGE_LAYERS, match=Repack.PREINSTALL_DIR)
+        return manifest.preinstall(sha)
 
 def _get_diff_ver(version,dirs,path,downgrade=False):
 
@@ -257,27 +227,52 @@ def pkg_to_ver(file):
     ver = version[1] if not version[0].endswith('.') else version[1][:-1]
     return ver
 
+PACKAGE_TYPES = ["ColdStartPackage/","DowngradePackage/","UpgradeFromSR_10-2/",
+    "UpgradeFromSR_10-3/",
+    "UpgradeFromSR_10-4/",
+    "UpgradeWithinSR_10-5/",
+    "FutureDiff1/",
+    "FutureDiff2/",
+    "FutureDiff3/",
+]
+
+_build_ex_lookups = Coalescer()
+
 def get_build_ex(version):
+    """! find every package of a build
+
+    concurrent calls for the same version share one lookup
+
+    @return {'base_path', 'version', package type: url}
+    """
+    return _build_ex_lookups.run(version, _get_build_ex, version)
+
+def _get_build_ex(version):
+    data = version_tree.get(version)
+    if data and 'packages' in data:
+        logger.info("Build in version catalog")
+        info = {
+            "base_path": data['base_path'],
+            "version": version
+        }
+        for item, package in data['packages'].items():
+            info[item] = package['url']
+        return info
+
     coldpath, coldfile, _, _ = get_build(version=version)
 
     distro = os.path.dirname(coldpath) if not coldpath.endswith('/') else os.path.dirname(coldpath[:-1])
     items = Walker.listdir(distro)
-    avail_packages = ["ColdStartPackage/","DowngradePackage/","UpgradeFromSR_10-2/",
-        "UpgradeFromSR_10-3/",
-        "UpgradeFromSR_10-4/",
-        "UpgradeWithinSR_10-5/",
-        "FutureDiff1/",                       
-        "FutureDiff2/",                       
-        "FutureDiff3/",                       
-    ]
     info = {
         "base_path": distro,
         "version": pkg_to_ver(coldfile)
     }
 
-    for item in avail_packages:
-        if item in items or item[:-1] in items:
-            name = _find_zip(os.path.join(distro, item)+'/')
+    # one listing per package type, all at once
+    found = [item for item in PACKAGE_TYPES if item in items or item[:-1] in items]
+    with ThreadPoolExecutor(max_workers=len(PACKAGE_TYPES)) as executor:
+        names = executor.map(lambda item: _find_zip(os.path.join(distro, item)+'/'), found)
+        for item, name in zip(found, names):
             info[item[:-1]] = os.path.join(distro, item, name)
 
     return info
@@ -289,10 +284,11 @@ def get_build(file=None, version=None,diff_upgrade=False, downgrade=False):
         coldfile = os.path.basename(file)
         found = True
     else:
-        if version in version_tree:
-            logger.info("Build in version_data.json")
-            coldpath = os.path.dirname(version_tree[version]['coldstart'])
-            coldfile = os.path.basename(version_tree[version]['coldstart'])
+        data = version_tree.get(version)
+        if data:
+            logger.info("Build in version catalog")
+            coldpath = os.path.dirname(data['coldstart'])
+            coldfile = os.path.basename(data['coldstart'])
             return coldpath, coldfile, None, None
 
         found = False
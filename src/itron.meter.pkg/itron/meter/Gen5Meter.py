@@ -11,17 +11,17 @@ will poll for the meter to come back and be accessible again.
 
 """
 import os
-import stat
 import time
 import subprocess  # For executing a shell command
 from rohan.meter.AbstractMeter import AbstractMeter
 from rohan.meter.MeterInstance import MeterInstanceBase
 from . import MeterMan
 from . import AsMan
+from . import Repack
+from . import DecryptClient
+from .Manifest import sha256_file
 import json
 import logging
-import tempfile
-import tarfile
 import shutil
 import rohan.meter.FwMan as FwMan
 import re
@@ -276,10 +276,40 @@ class SSHGen5Meter(AbstractMeter):
                 insensitive.append(CaseInsensitiveDict(entry))
         return insensitive
 
+    def device_key_class(self):
+        """ fingerprint of the image decryption key in the device tree
+
+        Meters with the same fingerprint decrypt a package to the same
+        result, so it is part of the DecryptStore key.  None if it can
+        not be read.
+        """
+        if getattr(self, '_key_class', None) is None:
+            code, data = self.command_with_code("sha256sum /proc/device-tree/exdata")
+            self._key_class = 'meter-' + data[0].split()[0][:16] if code == 0 and data else None
+        return self._key_class
+
     def decrypt_package(self,src, destname):
-        """ Decrypt a package and extract the signed .gz file """
+        """ Decrypt a package and extract the signed .gz file
+
+        Results are shared through the DecryptStore (see rohan.meter.DecryptClient),
+        keyed by the digest of src and the meter's device key, so a package is only
+        decrypted once by any meter with the same key.
+
+        @param src       encrypted file
+        @param destname  file name for the decrypted file, or a directory to put it in
+        @return name of the decrypted file
+        """
         ENCRYPTED=os.path.join("/media/mmcblk0p1", f"encrypt{time.time()}")
         REMOTE_DECRYPTED=os.path.join("/media/mmcblk0p1", f"decrypt{time.time()}")
+        if os.path.isdir(destname):
+            destname = os.path.join(destname, os.path.basename(REMOTE_DECRYPTED))
+
+        store = DecryptClient.get_store()
+        digest = sha256_file(src)
+        key_class = self.device_key_class()
+        if key_class and store.get(digest, key_class, destname):
+            logging.info("decrypted %s found in %s", src, store.root)
+            return destname
 
         try:
             logging.info("copy %s to meter for decrypt", src)
@@ -288,9 +318,11 @@ class SSHGen5Meter(AbstractMeter):
             logging.info("ImageDecrypt: %s", data)
             if code == 0:
                 self.get_file(REMOTE_DECRYPTED, destname)
+                if key_class:
+                    store.put(destname, digest, key_class)
 
         finally:
-            self.command(f"rm -rf ${ENCRYPTED}, ${REMOTE_DECRYPTED}")
+            self.command(f"rm -rf {ENCRYPTED} {REMOTE_DECRYPTED}")
         return destname
 
     def _find_file(self, path, str):
@@ -303,9 +335,10 @@ class SSHGen5Meter(AbstractMeter):
     def repack_diff_package(self, logger,  fw_package, di_package, di_scripts, workdir):
         """ Repack is responsible for re-inserting a DI-AppServe package
 
-        This is achieved by decrypting the package,
-        untaring the sub-tarballs and replacing the DI package
-        re-tar, and re-sign
+        This is achieved by decrypting the package, then streaming each
+        sub-tarball into a new package with the PreInstall directory of the
+        rootfs replaced by the DI package (see rohan.meter.Repack).
+        Nothing is extracted to disk.  The result is re-signed.
         """
 
         m = re.search("Package-([0123456789.]+)_", di_package)
@@ -319,11 +352,6 @@ class SSHGen5Meter(AbstractMeter):
         rohan = os.path.join(workdir, "rohan")
         os.mkdir(rohan)
 
-        tmp = os.path.join(workdir, "tmp_file")
-        os.mkdir(tmp)
-
-
-
         if os.path.basename(fw_package).startswith("decrypted-"):
             FILENAME = os.path.basename(fw_package)[10:]
             if FILENAME.startswith("signed-"):
@@ -341,151 +369,30 @@ class SSHGen5Meter(AbstractMeter):
 
             pkg_name = self._find_file(asdir, "tar.gz")
             INTERNAL = os.path.join(asdir, pkg_name)
-            decrypted = os.path.join(os.path.dirname(fw_package), "decrypted-" + pkg_name)
-            SRC = decrypted
-            if not os.path.exists(decrypted):
-                SRC = self.decrypt_package(INTERNAL, decrypted)
+            SRC = self.decrypt_package(INTERNAL, os.path.join(rohan, "decrypted-" + pkg_name))
 
             FILENAME = os.path.basename(fw_package)[7:]
 
-        rfs = os.path.join(rohan, "rootfs")
-        l1 = os.path.join(rohan, "layer1")
-        l2 = os.path.join(rohan, "layer2")
-        os.mkdir(rfs)
-        os.mkdir(l1)
-        os.mkdir(l2)
-
-        with tarfile.open(name=SRC, mode="r:gz") as t:
-            t.extractall(l1)
-
-
-        logging.info(os.listdir(l1))
-
-
-        INNER = os.path.join(l1, self._find_file(l1, "tar.gz"))
-
-        assert os.path.exists(INNER), f"{INNER} does not exist"
-
-
-        # tempdata = tar.extract(member, path=f'{workdir}/tmpfile',set_attrs=False)
-
-
-        # extract_tar(INNER)
-
-        tar_file = INNER
-
-        logging.info(INNER)
-
-        # Find .xz file and extract it to layer2
-        # INNER = os.path.join(l1, self._find_file(l1, "tar.gz"))
-
-        logging.info('l1')
-        logging.info(os.listdir(l1))
-        logging.info('l2')
-        logging.info(os.listdir(l2))
-        logging.info('rfs')
-        logging.info(os.listdir(rfs))
-        # logging.info(os.path.join(l2, INNER))
-        # assert os.path.exists(os.path.join(l2, INNER))
-        
-
-
-
-        with tarfile.open(name=tar_file, mode='r:gz') as t:
-            t.extractall(l1)
-
-        logging.info('l1')
-        logging.info(os.listdir(l1))
-        logging.info('l2')
-        logging.info(os.listdir(l2))
-        logging.info('rfs')
-        logging.info(os.listdir(rfs))
-
-
-        with tarfile.open(name=os.path.join(l1, self._find_file(l1, "tar.gz")), mode='r:gz') as t:
-            t.extractall(l2)
-
-        logging.info('l1')
-        logging.info(os.listdir(l1))
-        logging.info('l2')
-        logging.info(os.listdir(l2))
-        logging.info('rfs')
-        logging.info(os.listdir(rfs))
-
-
-        # now we should have the rootfs.tar.gz in layer2, so extract that
-        ROOTFS = os.path.join(l2, "rootfs.tar.gz")
-
-        logging.info(ROOTFS)
-        extract_tar(ROOTFS)
-
-
-        # Set permissions for extracted files/directories (if needed)
-        # for root, dirs, files in os.walk(l2):
-        #     for dir_name in dirs:
-        #         dir_path = os.path.join(root, dir_name)
-        #         os.chmod(dir_path, 0o755)  # Change to appropriate permissions
-                
-        #     for file_name in files:
-        #         file_path = os.path.join(root, file_name)
-        #         os.chmod(file_path, 0o644)  # Change to appropriate permissions
-
-        assert os.path.exists(ROOTFS), "ROOTFS does not exist"
-
-        
-        # with tarfile.open(name=ROOTFS) as t:
-
-        with tarfile.open(name=ROOTFS, mode='r:gz') as t:
-            # t.extractall(rfs,numeric_owner=True)
-            t.extractall(tmp)
-
-        logging.info('sussessfully - 12311212')
-
-        
-        # didir = os.path.join(rfs, 'usr/share/rohan/improv/Diff.Install/AppServ')
-        didir = os.path.join(rfs, 'usr/share/rohan/PreInstall')
-
-        cur_pack = self._find_file(didir, "DI-AppServices-Package")
-        logger.info("wrapped DI package being replaced: %s", cur_pack)
-
-        shutil.rmtree(didir)
-        os.mkdir(didir)
-
-        # extract scripts
-        with MyZipFile(di_scripts, "r") as z:
-            z.extractall(didir)
-
-        # extract DI package
-        ok = False
-        with MyZipFile(di_package, "r") as z:
-            for zf in z.filelist:
-                if zf.filename.find(".gz") != -1:
-                    z.extract(zf, didir)
-                    ok = True
-                    break
+        # new PreInstall contents: the scripts and the DI package
+        preinstall = Repack.TarEdit(Repack.PREINSTALL_DIR)
+        preinstall.add_zip(di_scripts)
+        ok = preinstall.add_zip(di_package, match=r"\.gz", count=1)
         assert ok, "Couldn't find .gz file in di appserv package"
 
-        # re-tar rootfs
-        logging.info("tar create %s with %s", ROOTFS, rfs)
-        with tarfile.open(ROOTFS, 'w:gz') as t:
-            t.add(rfs, './')
-
-        # re-tar layer 2
-        logging.info("tar create %s with %s", INNER, l2)
-        with tarfile.open(INNER, "w:xz") as t:
-            t.add(l2, "./")
-
         TARGET_NAME = f'repacked-{di_version}-{FILENAME}'
         TARGET = os.path.join(workdir, TARGET_NAME)
         TARGET_TMP = os.path.join(rohan, "decrypted.tar.gz")
-        # PRE_SIGNED = os.path.join(TMP, FILENAME)
         SIGNED_NAME = pkg_name
 
-        # re-tar layer 1
-        logging.info("tar create %s with %s", TARGET_TMP, l1)
-        subprocess.check_call(f"tar czf {TARGET_TMP} *", shell=True, cwd=l1)
-        # with tarfile.open(TARGET_TMP, 'w:gz') as t:
-        #    t.add(l1, './')
+        # layer 1 (gz) -> layer 2 (xz) -> rootfs.tar.gz (gz)
+        logging.info("rewrite %s to %s", SRC, TARGET_TMP)
+        with open(SRC, 'rb') as src, open(TARGET_TMP, 'wb') as dst:
+            Repack.rewrite_tar(src, dst, preinstall, layers=Repack.PACKAGE_LAYERS, compression=('gz', 'xz', 'gz'),
+                               member_filter=Repack.normalize_permissions)
+        assert preinstall.applied, f"rootfs.tar.gz not found in {SRC}"
+
+        cur_pack = [x for x in preinstall.dropped if "DI-AppServices-Package" in x]
+        logger.info("wrapped DI package being replaced: %s", cur_pack)
 
         cmd = ' '.join([otapack, os.path.basename(TARGET_TMP), SIGNED_NAME])
         subprocess.check_call(cmd, shell=True, cwd=rohan)
@@ -500,8 +407,6 @@ class SSHGen5Meter(AbstractMeter):
         shutil.copyfile(os.path.join(rohan, SIGNED), TARGET)
         return TARGET
 
-        # unreachable: return ret
-
 
     def repack_image(self,image_file,workdir):
 
@@ -556,51 +461,6 @@ class SSHGen5Meter(AbstractMeter):
 
 
 
-def extract_tar(tar_file):
-            
-    logging.info(tar_file)
-    assert os.path.exists(tar_file), f"{tar_file} does not exist"
-
-    tar = tarfile.open(tar_file, mode="r:gz")
-    members = tar.getmembers()
-    file_permission = stat.S_IRUSR | stat.S_IWUSR
-    folder_permission = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR
-    # Let's pretend we want to edit, and write to new tar
-    if len(members) > 0:
-        fd, tmp_tar = tempfile.mkstemp(prefix=("%s.fixed." % tar_file))
-        os.close(fd)
-        fixed_tar = tarfile.open(tmp_tar, "w:gz")
-        # Then process members
-        for member in members:
-            # add o+rwx for directories
-            if member.isdir() and not member.issym():
-                member.mode = folder_permission | member.mode
-                extracted = tar.extractfile(member)
-                fixed_tar.addfile(member, extracted)
-            # add o+rw for plain files
-            elif member.isfile() and not member.issym():
-                member.mode = file_permission | member.mode
-                extracted = tar.extractfile(member)
-                fixed_tar.addfile(member, extracted)
-            else:
-                fixed_tar.addfile(member)
-
-  
-                
-        fixed_tar.close()
-
-        os.remove(tar_file)
-        logging.info('remove sussessful')
-
-        # Rename the fixed tar to be the old name
-        os.rename(tmp_tar,tar_file)
-
-    tar.close()
-    assert os.path.exists(tar_file), f"{tar_file} does not exist"
-
-    logging.info('sussessful')
-    logging.info(tar_file)
-
 class AdvancedMeter(SSHGen5Meter):
     """
     An advanced meter contains more than just the IP address. It includes the database information
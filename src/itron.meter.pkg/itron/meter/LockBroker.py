@@ -0,0 +1,274 @@
+"""
+Meter lock broker
+
+The controller process owns the meter database connection and serves the
+locks to its forked worker processes over a unix socket:
+
+    broker = LockBroker(dbclient)
+    ...                                         # in the worker process
+    client = LockBrokerClient(broker.path)
+    meter = MeterInstanceDB(info, client)
+    meter.lock()
+
+Requests and replies are single JSON lines, [id, method, args] and
+[id, result] or [id, None, exception name, message].  lock_node and
+unlock_node requests that arrive together are run as one lock_nodes or
+unlock_nodes statement.  The database object tracks the locks in its
+ledger, see rohan.meter.LockLedger.
+"""
+import os
+import json
+import queue
+import socket
+import shutil
+import builtins
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# most lock_node or unlock_node requests run as one statement
+BATCH_MAX = 64
+
+# calls served by the broker, lock_node and unlock_node are batched
+METHODS = ('lock_group', 'lock_any', 'unlock_seen', 'wait_unlock',
+           'request_locks', 'grant_locks', 'cancel_request')
+
+
+class LockBroker:
+    """ serve the locks of one meter database to other processes """
+    def __init__(self, db, path=None):
+        """
+        @param db    MeterDBBase the locks are taken in
+        @param path  unix socket path, default is a new temporary directory
+        """
+        self.db = db
+        self.tmpdir = None
+        if path is None:
+            self.tmpdir = tempfile.mkdtemp(prefix="meterlocks-")
+            path = os.path.join(self.tmpdir, "broker.sock")
+        self.path = path
+        self.requests = queue.Queue()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(64)
+        self.closed = False
+        self.threads = [threading.Thread(target=self._accept, name="lock-broker", daemon=True),
+                        threading.Thread(target=self._batch, name="lock-broker-batch", daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+        elif os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), name="lock-broker-client", daemon=True).start()
+
+    def _serve(self, conn):
+        """ read the requests of one client, replies can go back in any order """
+        send_lock = threading.Lock()
+
+        def reply(request_id, result=None, error=None):
+            message = [request_id, result] if error is None else [request_id, None, type(error).__name__, str(error)]
+            data = (json.dumps(message) + '\n').encode()
+            with send_lock:
+                try:
+                    conn.sendall(data)
+                except OSError:
+                    pass
+
+        with conn, conn.makefile('rb') as reader:
+            for line in reader:
+                try:
+                    request_id, method, args = json.loads(line)
+                except ValueError:
+                    logger.error("lock broker: bad request %r", line)
+                    return
+                if method in ('lock_node', 'unlock_node'):
+                    self.requests.put((method, str(args[0]), request_id, reply))
+                elif method in METHODS:
+                    # wait_unlock can block for a while, do not hold up the other requests
+                    threading.Thread(target=self._call, args=(method, args, request_id, reply), daemon=True).start()
+                else:
+                    reply(request_id, error=AttributeError(f"lock broker has no method {method}"))
+
+    def _call(self, method, args, request_id, reply):
+        try:
+            result = getattr(self.db, method)(*args)
+        except Exception as e:
+            reply(request_id, error=e)
+            return
+        if method == 'lock_any':
+            result = [str(m) for m in result]
+        reply(request_id, result)
+
+    def _batch(self):
+        """ run the lock_node and unlock_node requests waiting together as one statement each """
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < BATCH_MAX:
+                try:
+                    item = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.requests.put(None)
+                    break
+                batch.append(item)
+
+            # releases first, a lock in the same batch can take the node
+            unlocks = [entry for entry in batch if entry[0] == 'unlock_node']
+            if unlocks:
+                self._unlock_batch(unlocks)
+            locks = [entry for entry in batch if entry[0] == 'lock_node']
+            if locks:
+                self._lock_batch(locks)
+
+    def _unlock_batch(self, unlocks):
+        try:
+            released = set(self.db.unlock_nodes([node for _, node, _, _ in unlocks]))
+        except Exception as e:
+            for _, _, request_id, reply in unlocks:
+                reply(request_id, error=e)
+            return
+        for _, node, request_id, reply in unlocks:
+            if node in released:
+                reply(request_id)
+                continue
+            try:
+                # quiet if the lease expired and another session has it, an error otherwise
+                self.db._lost_lease(node)
+                reply(request_id)
+            except Exception as e:
+                reply(request_id, error=e)
+
+    def _lock_batch(self, locks):
+        try:
+            locked = set(self.db.lock_nodes([node for _, node, _, _ in locks]))
+        except Exception as e:
+            logger.error("Error in locking meters: %s", e)
+            locked = set()
+        for _, node, request_id, reply in locks:
+            # two requests for one node, the first one gets it
+            reply(request_id, node in locked)
+            locked.discard(node)
+
+
+class LockBrokerClient:
+    """ stands in for the meter database in a worker process, the calls go to a LockBroker
+
+    Safe to share between the threads of a process, their requests are
+    sent on one connection and matched to the replies by id.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        self.closed = False
+        self.reader = threading.Thread(target=self._read, name="lock-broker-reader", daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        with self.sock.makefile('rb') as reader:
+            for line in reader:
+                message = json.loads(line)
+                with self.pending_lock:
+                    waiter = self.pending.pop(message[0], None)
+                if waiter:
+                    waiter[1] = message
+                    waiter[0].set()
+        # broker gone, fail whoever still waits
+        with self.pending_lock:
+            self.closed = True
+            waiters, self.pending = self.pending, {}
+        for waiter in waiters.values():
+            waiter[0].set()
+
+    def _call(self, method, *args):
+        waiter = [threading.Event(), None]
+        with self.pending_lock:
+            if self.closed:
+                raise ConnectionError("lock broker connection is closed")
+            self.next_id += 1
+            request_id = self.next_id
+            self.pending[request_id] = waiter
+        with self.send_lock:
+            self.sock.sendall((json.dumps([request_id, method, args]) + '\n').encode())
+        waiter[0].wait()
+        message = waiter[1]
+        if message is None:
+            raise ConnectionError(f"lock broker closed the connection during {method}")
+        if len(message) > 2:
+            exc = getattr(builtins, message[2], None)
+            if not (isinstance(exc, type) and issubclass(exc, Exception)):
+                exc = RuntimeError
+            raise exc(message[3])
+        return message[1]
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.reader.join()
+
+    def lock_node(self, node):
+        return self._call('lock_node', str(node))
+
+    def unlock_node(self, node):
+        return self._call('unlock_node', str(node))
+
+    def lock_group(self, nodes):
+        return self._call('lock_group', [str(node) for node in nodes])
+
+    def lock_any(self, n, nodes=None):
+        return self._call('lock_any', n, [str(node) for node in nodes] if nodes is not None else None)
+
+    def unlock_seen(self):
+        return self._call('unlock_seen')
+
+    def wait_unlock(self, seen, timeout):
+        return self._call('wait_unlock', seen, timeout)
+
+    def request_locks(self, nodes, count=None, priority=0):
+        return self._call('request_locks', [str(node) for node in nodes], count, priority)
+
+    def grant_locks(self, request_id):
+        return self._call('grant_locks', request_id)
+
+    def cancel_request(self, request_id):
+        return self._call('cancel_request', request_id)
@@ -0,0 +1,152 @@
+"""
+Meter lock ledger
+
+LockLedger is the set of nodes a meter database object holds locked.  With
+a LockJournal attached every lock and release is also appended to a file
+and synced to disk, so the locks of a session that crashed can be found
+and freed afterwards:
+
+    journal = LockJournal("parallel.locks.journal", truncate=True)
+    dbclient.journal_locks(journal)
+    ...
+    for db, owner, nodes in LockJournal.held("parallel.locks.journal"):
+        mgr.unlock_nodes(nodes, owner=owner)
+
+A journal line is {"op": "lock" or "unlock", "nodes": [...], "owner": lock
+owner token, "db": --dut-db spec, "time": ...}.
+"""
+import os
+import json
+import threading
+import time
+
+
+class LockJournal:
+    """ append only record of the locks taken and released, one JSON line each """
+    def __init__(self, filename, truncate=False, sync=True):
+        """
+        @param filename  journal file
+        @param truncate  start a new journal instead of appending to an old one
+        @param sync      fsync every line, the journal survives a crash of the host
+        """
+        self.filename = filename
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.fh = open(filename, "w" if truncate else "a")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def append(self, op, nodes, owner=None, db=None):
+        """ record nodes locked or unlocked, ignored once the journal is closed """
+        if not nodes:
+            return
+        line = json.dumps({'op': op, 'nodes': [str(node) for node in nodes], 'owner': owner, 'db': db,
+                           'time': time.time()})
+        with self.lock:
+            if self.fh is None:
+                return
+            self.fh.write(line + '\n')
+            self.fh.flush()
+            if self.sync:
+                os.fsync(self.fh.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+
+    @staticmethod
+    def held(filename):
+        """! replay a journal
+
+        @return [(db, owner, [nodes])] still locked, in lock order
+        """
+        nodes = {}
+        with open(filename) as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of a killed session can be cut short
+                    continue
+                key = (entry.get('db'), entry.get('owner'))
+                for node in entry['nodes']:
+                    if entry['op'] == 'lock':
+                        nodes[(key, node)] = True
+                    else:
+                        nodes.pop((key, node), None)
+        result = {}
+        for key, node in nodes:
+            result.setdefault(key, []).append(node)
+        return [(db, owner, held) for (db, owner), held in result.items()]
+
+
+class LockLedger:
+    """ nodes held by one database object, in lock order, with the lock owner that took each one
+
+    A forked child locks under an owner token of its own, so the ledger it
+    inherited can hold nodes of the parent's owner next to its own.
+    """
+    def __init__(self):
+        self.nodes = {}         # node: lock owner
+        self.journal = None
+        self.db = None
+
+    def attach(self, journal, db=None):
+        """ journal from now on, the nodes already held are recorded first """
+        self.journal = journal
+        self.db = db
+        for owner, nodes in self._by_owner(self.nodes).items():
+            journal.append('lock', nodes, owner, db)
+
+    def _by_owner(self, nodes):
+        result = {}
+        for node in nodes:
+            result.setdefault(self.nodes[node], []).append(node)
+        return result
+
+    def add(self, nodes, owner=None):
+        new = []
+        for node in nodes:
+            node = str(node)
+            if node not in self.nodes:
+                self.nodes[node] = owner
+                new.append(node)
+        if self.journal:
+            self.journal.append('lock', new, owner, self.db)
+
+    def remove(self, nodes):
+        """! stop tracking nodes
+
+        @return the nodes that were tracked
+        """
+        gone = [node for node in dict.fromkeys(str(node) for node in nodes) if node in self.nodes]
+        owners = self._by_owner(gone)
+        for node in gone:
+            del self.nodes[node]
+        if self.journal:
+            for owner, released in owners.items():
+                self.journal.append('unlock', released, owner, self.db)
+        return gone
+
+    def owner(self, node):
+        """ lock owner that took node, None if it is not tracked """
+        return self.nodes.get(str(node))
+
+    def owned(self, owner):
+        """ nodes taken by one lock owner """
+        return [node for node, node_owner in self.nodes.items() if node_owner == owner]
+
+    def __contains__(self, node):
+        return str(node) in self.nodes
+
+    def __iter__(self):
+        return iter(list(self.nodes))
+
+    def __len__(self):
+        return len(self.nodes)
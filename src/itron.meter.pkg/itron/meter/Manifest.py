@@ -0,0 +1,242 @@
+"""
+Package content manifests
+
+Indexes every member of every layer of a firmware package once, keyed by
+the SHA-256 of the signed package, so questions like "which DI and HAN
+versions are in FW 10.5.633" are answered without downloading, decrypting
+or unpacking the package again.
+
+Layers are named by the path of the tarball that holds them:
+
+    ''                                      members of the signed zip
+    '<pkg>.tar.gz'                          members of the decrypted package
+    '<pkg>.tar.gz/<inner>.tar.xz'           members of the inner tarball
+    '<pkg>.tar.gz/<inner>.tar.xz/rootfs.tar.gz'
+
+The index is a sqlite database in the host cache directory (see
+rohan.meter.utils.cache_dir) and is safe to share between processes.
+
+Usage:
+    manifest = PackageManifest()
+    sha = manifest.lookup(url)
+    if sha:
+        print(manifest.versions(sha))
+"""
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import tarfile
+import zipfile
+from collections import namedtuple
+from . import Repack
+from .utils import cache_dir
+
+logger = logging.getLogger(__name__)
+
+Member = namedtuple('Member', ['layer', 'path', 'size', 'digest'])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS package (
+    sha256 TEXT PRIMARY KEY,
+    name TEXT,
+    fw_version TEXT,
+    indexed REAL
+);
+CREATE TABLE IF NOT EXISTS source (
+    source TEXT PRIMARY KEY,
+    sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS member (
+    sha256 TEXT,
+    layer TEXT,
+    path TEXT,
+    size INTEGER,
+    digest TEXT
+);
+CREATE INDEX IF NOT EXISTS member_sha ON member (sha256, layer);
+CREATE INDEX IF NOT EXISTS package_version ON package (fw_version);
+"""
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def sha256_file(name):
+    """ SHA-256 hex digest of a file """
+    digest = hashlib.sha256()
+    with open(name, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_key(fw_package):
+    """ key for a package location, local files include size and mtime so a rebuilt file is not trusted """
+    if fw_package.startswith("http://") or fw_package.startswith("https://"):
+        return fw_package
+    st = os.stat(fw_package)
+    return f"{os.path.abspath(fw_package)}:{st.st_size}:{int(st.st_mtime)}"
+
+
+def preinstall_versions(files):
+    """ find the DI AppServices and HAN agent versions in a list of PreInstall files
+
+    @return dict with 'as_ver' and 'han_ver' when found
+    """
+    data = {}
+    for file in files:
+        if re.search('DI-AppServices', file):
+            as_ver = re.search("Package-([0123456789.]+)", file)[1]
+            if as_ver.endswith('.'):
+                as_ver = as_ver[:-1]
+            data['as_ver'] = as_ver
+
+        if re.search('HANAgent', file):
+            data['han_ver'] = re.search("HANAgent_([0123456789.]+)", file)[1]
+    return data
+
+
+class _HashReader:
+    """ read-through file object that hashes everything read """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        while self.read(CHUNK_SIZE):
+            pass
+        return self.digest.hexdigest()
+
+
+class PackageManifest:
+    """ index of package members keyed by package SHA-256 """
+    def __init__(self, db_file=None):
+        self.db_file = db_file if db_file else os.path.join(cache_dir(), "manifest.db")
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _query(self, query, args=()):
+        conn = self._connect()
+        try:
+            return conn.execute(query, args).fetchall()
+        finally:
+            conn.close()
+
+    def has(self, sha):
+        """ True if the package has been indexed """
+        return bool(self._query("SELECT 1 FROM package WHERE sha256 = ?", (sha,)))
+
+    def lookup(self, fw_package):
+        """ SHA-256 of an indexed package from its url or file name, None if not known """
+        try:
+            key = source_key(fw_package)
+        except FileNotFoundError:
+            return None
+        rows = self._query("SELECT source.sha256 FROM source JOIN package USING (sha256) WHERE source = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def add_source(self, fw_package, sha):
+        """ remember that url or file `fw_package` is the package `sha` """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO source VALUES (?, ?)", (source_key(fw_package), sha))
+        finally:
+            conn.close()
+
+    def index(self, sha, zip_name, decrypted, layers=Repack.PACKAGE_LAYERS, fw_package=None):
+        """! index every member of every layer of a package
+
+        @param sha         SHA-256 of the signed package
+        @param zip_name    signed package (zip) file
+        @param decrypted   decrypted copy of the tarball in the zip
+        @param layers      regex for the nested tarball at each level (see rohan.meter.Repack)
+        @param fw_package  url or file name the package came from
+        """
+        start = time.time()
+        rows = []
+        encrypted = None
+        with zipfile.ZipFile(zip_name) as z:
+            for zi in z.infolist():
+                if zi.is_dir():
+                    continue
+                with z.open(zi) as f:
+                    reader = _HashReader(f)
+                    rows.append(('', zi.filename, zi.file_size, reader.hexdigest()))
+                if zi.filename.find("tar.gz") != -1 and encrypted is None:
+                    encrypted = zi.filename
+
+        with open(decrypted, 'rb') as f:
+            self._scan(f, encrypted or os.path.basename(decrypted), layers, rows)
+
+        name = os.path.basename(fw_package if fw_package else zip_name)
+        version = re.search("FW(10[0123456789.]+)", name)
+        version = version[1].rstrip('.') if version else None
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM member WHERE sha256 = ?", (sha,))
+                conn.executemany("INSERT INTO member VALUES (?, ?, ?, ?, ?)", [(sha,) + row for row in rows])
+                conn.execute("INSERT OR REPLACE INTO package VALUES (?, ?, ?, ?)", (sha, name, version, time.time()))
+                if fw_package:
+                    conn.execute("INSERT OR REPLACE INTO source VALUES (?, ?)", (source_key(fw_package), sha))
+        finally:
+            conn.close()
+        logger.info("indexed %s members of %s in %.1fs", len(rows), name, time.time() - start)
+
+    def _scan(self, fileobj, layer, layers, rows):
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tin:
+            descended = False
+            for member in tin:
+                digest = None
+                if member.isreg():
+                    reader = _HashReader(tin.extractfile(member))
+                    if layers and not descended and re.search(layers[0], member.name):
+                        descended = True
+                        self._scan(reader, layer + '/' + Repack.member_path(member.name), layers[1:], rows)
+                    digest = reader.hexdigest()
+                rows.append((layer, member.name, member.size, digest))
+
+    def members(self, sha, match=None, layer=None):
+        """! members of an indexed package
+
+        @param sha    SHA-256 of the package
+        @param match  regex the member path must contain
+        @param layer  only members of this layer, or the innermost layer when layer is -1
+
+        @return list of Member
+        """
+        if layer == -1:
+            rows = self._query("SELECT layer FROM member WHERE sha256 = ? ORDER BY length(layer) DESC LIMIT 1", (sha,))
+            layer = rows[0][0] if rows else ''
+        if layer is None:
+            rows = self._query("SELECT layer, path, size, digest FROM member WHERE sha256 = ? ORDER BY rowid", (sha,))
+        else:
+            rows = self._query("SELECT layer, path, size, digest FROM member WHERE sha256 = ? AND layer = ? ORDER BY rowid",
+                               (sha, layer))
+        return [Member(*row) for row in rows if not match or re.search(match, row[1])]
+
+    def preinstall(self, sha):
+        """ PreInstall paths in the rootfs, same as FwMan.get_preinstall() returns """
+        return [m.path for m in self.members(sha, match=Repack.PREINSTALL_DIR, layer=-1)]
+
+    def versions(self, sha):
+        """ DI AppServices and HAN agent versions in the package """
+        return preinstall_versions(self.preinstall(sha))
+
+    def packages(self, fw_version):
+        """ SHA-256 of every indexed package for a firmware version """
+        return [row[0] for row in self._query("SELECT sha256 FROM package WHERE fw_version = ?", (fw_version,))]
@@ -2,34 +2,278 @@ from kaizenbot.Misc.kbotdbconfig import DB_Dict as DB_Dict_default
 
 # sadly, these should have been derived from base class of abstract db server
 import io
-import datetime
 import logging
 import abc
 from rohan.meter.MeterInstance import MeterInstanceBase, MeterInstanceDB
+from rohan.meter.LockLedger import LockLedger
+from rohan.meter.MeterInventory import get_inventory, select as select_records, group as group_records
 from psycopg2 import sql
 import psycopg2
 import base64
+import threading
 from threading import RLock
 import sqlite3
+import select
+import uuid
+import weakref
+import re
+from contextlib import contextmanager
 import os
+import math
 import time
 
 
+logger = logging.getLogger(__name__)
+
 # make a copy of the base dictionary, and allow additions here
 DB_Dict = DB_Dict_default.copy()
 
+def build_id():
+    """ pipeline build id, None outside a pipeline """
+    return os.getenv("BUILD_BUILDID")
+
+def lock_host():
+    """ recorded as the owner of a lock, host name and the pipeline build id """
+    hostname = os.uname()[1]
+    if build_id():
+        hostname += "-" + build_id()
+    return hostname
+
+# locks taken by a session carry a lease, renewed by a heartbeat thread of the holder.
+# a lease that is not renewed can be taken over, so a dead session frees its meters.
+LEASE_SECONDS = int(os.getenv("METERDB_LEASE", 60))
+LEASE_RENEW = LEASE_SECONDS / 4
+
+# lock request, grant and release events for mdb stats, mdb migrate drops those older than EVENT_DAYS days.
+# METERDB_EVENTS=0 turns the recording off.
+LOCK_EVENTS = os.getenv("METERDB_EVENTS", "1") != "0"
+EVENT_DAYS = float(os.getenv("METERDB_EVENT_DAYS", 30))
+
+# the lease columns, lock queue and lock events are added by mdb migrate, see db.migrate().
+# 1 lease columns, 2 lock queue, 3 lock events, 4 inventory counter
+SCHEMA_VERSION = 4
+# Node columns a lock changes, they do not move the inventory version
+LOCK_COLUMNS = ('node_busy', 'busy_change_count', 'last_busy_change', 'lock_host', 'lock_owner', 'lease_expires')
+# stats read this far before the window for the locks and requests still open at its start
+EVENT_LOOKBACK = 12 * 3600
+
+def owner_token():
+    """ identifies the holder of leased locks, one per database object and process """
+    return re.sub(r"[^\w.:-]", "_", f"{lock_host()}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+
+def _heartbeat(ref, pid):
+    """ renew the leases of a database until it is closed or collected """
+    while True:
+        time.sleep(LEASE_RENEW)
+        database = ref()
+        if database is None or database.heartbeat_pid != pid:
+            return
+        try:
+            database.renew_leases()
+        except Exception as e:
+            logger.warning("Failed to renew meter leases: %s", e)
+        del database
+
+# (leases, queue, events, inventory counter) of each database, read once per process.  A race only reads it twice.
+_schemas = {}
+_SCHEMA_TABLES = ('node', 'lock_queue', 'lock_events', 'meterdb_inventory')
+
+def _lock_schema(columns):
+    """ (leases, queue, events, inventory counter) from the (table, column) names of the Node and lock tables """
+    columns = {(table.lower(), column.lower()) for table, column in columns}
+    tables = {table for table, _ in columns}
+    leases = {('node', 'lock_owner'), ('node', 'lease_expires')} <= columns
+    return leases, 'lock_queue' in tables, 'lock_events' in tables, 'meterdb_inventory' in tables
+
+def _inventory_columns(columns):
+    """ the Node columns that move the inventory version """
+    return [column for column in columns if column.lower() not in LOCK_COLUMNS]
+
+def node_ips(nodes):
+    """ node addresses of meter instances or strings, without duplicates """
+    ips = []
+    for node in nodes:
+        ip = node.ip_address if isinstance(node, MeterInstanceBase) else str(node)
+        if ip not in ips:
+            ips.append(ip)
+    return ips
+
+def plan_grant(queue, free, request_id):
+    """! nodes a queued request can be granted now
+
+    Requests are served highest priority first, then oldest first.  Every
+    request ahead of this one keeps the free nodes it would take: a group
+    request reserves all of its nodes, so it can not be starved by smaller
+    requests taking its nodes one at a time.
+
+    @param queue       [(request_id, [node], count, group)] in queue order
+    @param free        free node addresses, least used first
+    @param request_id  the request to grant
+    @return node addresses to lock for request_id, empty if it has to wait
+    """
+    free = [ip for ip in free]
+    for rid, nodes, count, group in queue:
+        wanted = set(nodes)
+        avail = [ip for ip in free if ip in wanted]
+        if rid == request_id:
+            if group:
+                return avail if len(avail) == len(wanted) else []
+            return avail[:count]
+        taken = wanted if group else set(avail[:count])
+        free = [ip for ip in free if ip not in taken]
+    return []
+
 #
 # since the pgre and psql db code is different
 # create a db class that handles both the same way
 #
+def _literal(value):
+    """ SQL literal of a string or None, for both sqlite and postgres """
+    if value is None:
+        return "NULL"
+    return "'" + str(value).replace("'", "''") + "'"
+
+def percentile(values, pct):
+    """ nearest rank percentile of sorted values, None if there are none """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))]
+
+def lock_stats(events, start, end, nodes=(), top=10):
+    """! summarise lock events over a time window
+
+    A lock runs from its grant to its release, or to the next grant of the
+    meter when the lease was taken over.  The wait of a queued request is
+    the time to its first grant; the meters it named share that wait, the
+    meters with the most waiting and denied lock attempts are the hotspots.
+
+    @param events  (event_time, event, node_ip, request_id, owner, host, build_id) in time order,
+                   the ones before start only tell which locks and requests are open
+    @param start   window start, epoch seconds
+    @param end     window end, epoch seconds
+    @param nodes   meters reported even if they have no events
+    @param top     number of hotspots
+    @return dict of 'window', 'requests', 'waits', 'peak', 'meters', 'hotspots' and 'hosts'
+    """
+    window = max(end - start, 1e-9)
+    meters = {}
+    hosts = {}
+    held = {}       # ip: grant time of the open lock
+    queued = {}     # request_id: [time, nodes, host]
+    waits = []
+    counts = {'made': 0, 'granted': 0, 'cancelled': 0, 'waiting': 0}
+    peak = 0
+
+    def meter(ip):
+        return meters.setdefault(ip, {'grants': 0, 'held': 0.0, 'utilisation': 0.0, 'denies': 0,
+                                      'waits': 0, 'wait_time': 0.0})
+
+    def host_entry(host):
+        return hosts.setdefault(host, {'grants': 0, 'requests': 0, 'waits': [], 'builds': set()})
+
+    def release(ip, t):
+        granted = held.pop(ip, None)
+        if granted is not None and min(t, end) > max(granted, start):
+            meter(ip)['held'] += min(t, end) - max(granted, start)
+
+    def waited(req, t):
+        for ip in req[1]:
+            meter(ip)['waits'] += 1
+            meter(ip)['wait_time'] += t - req[0]
+
+    for ip in nodes:
+        meter(str(ip))
+    for t, event, ip, request_id, owner, host, build in events:
+        if t > end:
+            break
+        inside = t >= start
+        if inside:
+            peak = max(peak, len(held))
+            if build:
+                host_entry(host)['builds'].add(build)
+        if event == 'request':
+            if request_id not in queued:
+                queued[request_id] = [t, [], host]
+                if inside:
+                    counts['made'] += 1
+                    host_entry(host)['requests'] += 1
+            queued[request_id][1].append(ip)
+        elif event == 'grant':
+            release(ip, t)
+            held[ip] = t
+            if inside:
+                meter(ip)['grants'] += 1
+                host_entry(host)['grants'] += 1
+            req = queued.pop(request_id, None) if request_id is not None else None
+            if req and req[0] >= start:
+                counts['granted'] += 1
+                waits.append(t - req[0])
+                host_entry(req[2])['waits'].append(t - req[0])
+                waited(req, t)
+        elif event == 'release':
+            release(ip, t)
+        elif event == 'deny':
+            if inside:
+                meter(ip)['denies'] += 1
+        elif event == 'cancel':
+            req = queued.pop(request_id, None)
+            if req and req[0] >= start:
+                counts['cancelled'] += 1
+                waited(req, t)
+        if inside:
+            peak = max(peak, len(held))
+    for ip in list(held):
+        release(ip, end)
+    counts['waiting'] = sum(1 for req in queued.values() if req[0] >= start)
+
+    waits.sort()
+    for entry in meters.values():
+        entry['utilisation'] = entry['held'] / window
+    hotspots = sorted((ip for ip, entry in meters.items() if entry['wait_time'] or entry['denies']),
+                      key=lambda ip: (meters[ip]['wait_time'], meters[ip]['denies']), reverse=True)
+    for entry in hosts.values():
+        entry['waits'].sort()
+        entry['wait_p50'] = percentile(entry.pop('waits'), 50)
+        entry['builds'] = sorted(entry['builds'])
+    return {
+        'window': (start, end),
+        'requests': counts,
+        'waits': {'count': len(waits), 'p50': percentile(waits, 50), 'p90': percentile(waits, 90),
+                  'p99': percentile(waits, 99), 'max': waits[-1] if waits else None},
+        'peak': peak,
+        'meters': meters,
+        'hotspots': hotspots[:top],
+        'hosts': hosts,
+    }
+
+
 class db(abc.ABC):
 
+    def unlock_node(self, ip, force=False):
+        """ release a node, unless force only while this owner holds it """
+        if isinstance(ip, MeterInstanceBase):
+            ip = ip.ip_address
+        if not self.unlock_nodes([str(ip)], force=force):
+            self._lost_lease(ip)
+
     @abc.abstractmethod
-    def unlock_node(self, node):
+    def lock_node(self, node):
         pass
 
     @abc.abstractmethod
-    def lock_node(self, node):
+    def lock_group(self, nodes):
+        pass
+
+    @abc.abstractmethod
+    def lock_any(self, n, nodes=None, **filters):
+        pass
+
+    @abc.abstractmethod
+    def lock_nodes(self, nodes):
+        pass
+
+    @abc.abstractmethod
+    def unlock_nodes(self, nodes, force=False, owner=None):
         pass
 
     @abc.abstractmethod
@@ -37,13 +281,153 @@ class db(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def read_nodes(self, query):
+    def inventory_rows(self):
+        """ column names and rows of every node of the platform """
+        pass
+
+    @abc.abstractmethod
+    def inventory_version(self):
+        """ changes whenever the nodes of the platform change, but not when they are locked, None if unknown """
+        pass
+
+    def read_nodes(self, node_status='active', number_of_nodes=None, node_type=None, **filters):
+        """! meters of the platform, from the inventory shared in this process
+
+        @param node_status      'active', 'inactive' or '%' for every meter
+        @param number_of_nodes  at most this many meters, None for all of them
+        @param node_type        node_device_type of the meters
+        @param filters          column=value the meters must match, like peer_group='A'
+        @return list of MeterInstanceDB
+        """
+        records = select_records(self.inventory.refresh(self), node_status=node_status,
+                                 node_device_type=node_type, **filters)
+        if number_of_nodes is not None:
+            records = records[:int(number_of_nodes)]
+        return [MeterInstanceDB(record, self) for record in records]
+
+    @abc.abstractmethod
+    def dump(self, file, tables=None, copy=False):
         pass
 
     @abc.abstractmethod
-    def dump(self, file):
+    def renew_leases(self):
+        """ extend the leases and queued requests of this owner, return the node addresses still held """
         pass
 
+    @abc.abstractmethod
+    def migrate(self):
+        """ add the lock tables and columns up to SCHEMA_VERSION, return (version before, version after) """
+        pass
+
+    @abc.abstractmethod
+    def _read_schema(self):
+        """ (leases, queue, events, inventory counter) the database has """
+        pass
+
+    def _check_schema(self, refresh=False):
+        """ what the lock tables of the database support, read once per process """
+        found = None if refresh else _schemas.get(self.schema_key)
+        if found is None:
+            found = self._read_schema()
+            _schemas[self.schema_key] = found
+            missing = [name for name, ok in zip(('lock leases', 'lock queue', 'lock events', 'inventory counter'), found) if not ok]
+            if missing:
+                self.logger.warning("Meter database without %s, run mdb migrate", ', '.join(missing))
+        self.leases, self.queue, events, self.inventory_counter = found
+        self.events = events and LOCK_EVENTS
+
+    def purge_events(self, days=EVENT_DAYS):
+        """ drop the lock events older than days, return how many """
+        if not getattr(self, 'events', False):
+            return 0
+        return self.runquery_update(f"DELETE FROM {self.events_table} WHERE event_time < {time.time() - float(days) * 86400}")
+
+    @property
+    def owner(self):
+        """ lock owner token, a forked child gets its own so its leases lapse when it dies """
+        if getattr(self, '_owner', None) is None or self._owner[0] != os.getpid():
+            self._owner = (os.getpid(), owner_token())
+        return self._owner[1]
+
+    @abc.abstractmethod
+    def request_locks(self, nodes, count=None, priority=0):
+        pass
+
+    @abc.abstractmethod
+    def grant_locks(self, request_id, lease=True):
+        pass
+
+    def cancel_request(self, request_id):
+        """ leave the lock queue, False if the request was already gone """
+        return self.runquery_update(f"DELETE FROM {self.queue_table} WHERE request_id = {int(request_id)}") == 1
+
+    def cancel_requests(self):
+        """ leave the lock queue with every request of this owner """
+        return self.runquery_update(f"DELETE FROM {self.queue_table} WHERE owner = '{self.owner}'")
+
+    def record_events(self, event, nodes=None, request_id=None):
+        """! add lock events for mdb stats, a failure is logged and does not fail the lock
+
+        @param event       'request', 'grant', 'deny', 'release' or 'cancel'
+        @param nodes       node addresses, None for an event of the whole request
+        @param request_id  lock queue request the event belongs to
+        """
+        if not getattr(self, 'events', False):
+            return
+        nodes = [None] if nodes is None else list(nodes)
+        if not nodes:
+            return
+        now = time.time()
+        request_id = "NULL" if request_id is None else int(request_id)
+        host, build = _literal(os.uname()[1]), _literal(build_id())
+        values = ', '.join(f"({now}, '{event}', {_literal(ip)}, {request_id}, '{self.owner}', {host}, {build})"
+                           for ip in nodes)
+        try:
+            self.runquery_update(f"INSERT INTO {self.events_table} "
+                                 f"(event_time, event, node_ip, request_id, owner, host, build_id) VALUES {values}")
+        except Exception as e:
+            self.logger.warning("Meter lock events not recorded, %s", e)
+
+    def read_events(self, since, until, host=None, build=None):
+        """ lock events from since to until, epoch seconds, in time order """
+        if not getattr(self, 'events', False):
+            return []
+        query = (f"SELECT event_time, event, node_ip, request_id, owner, host, build_id FROM {self.events_table} "
+                 f"WHERE event_time >= {float(since)} AND event_time <= {float(until)}")
+        if host:
+            query += f" AND host = {_literal(host)}"
+        if build:
+            query += f" AND build_id = {_literal(build)}"
+        return self.exec(query + " ORDER BY event_time, event_id") or []
+
+    def _lost_lease(self, ip, owner=None):
+        """ return quietly if the lease on ip expired and another session took it over """
+        if self.leases:
+            data = self.exec(f"SELECT lock_owner FROM {self.node_table} WHERE node_ip = '{ip}'")
+            if data and data[0][0] and data[0][0] != (owner or self.owner):
+                self.logger.warning("Lease on %s expired, it is now locked by %s", ip, data[0][0])
+                return
+        raise ValueError("Node not present in database")
+
+    def _start_heartbeat(self):
+        # one heartbeat thread per process, it does not survive fork()
+        if getattr(self, 'heartbeat_pid', None) == os.getpid():
+            return
+        self.heartbeat_pid = os.getpid()
+        threading.Thread(target=_heartbeat, args=(weakref.ref(self), self.heartbeat_pid),
+                         name="meterdb-heartbeat", daemon=True).start()
+
+    def unlock_seen(self):
+        """ count of lock releases seen so far, pass it to wait_unlock() """
+        return self.watcher.seen()
+
+    def wait_unlock(self, seen, timeout):
+        """! wait for a lock release after `seen` was taken
+
+        @return True if a node was released, False on timeout
+        """
+        return self.watcher.wait(seen, timeout)
+
     def _verify_singularity(self, data):
         if not (data and
                 isinstance(data, list) and
@@ -65,6 +449,7 @@ class db(abc.ABC):
             self.conn.commit()
 
     def close(self):
+        self.heartbeat_pid = None
         if self.conn:
             self.conn.close()
 
@@ -76,6 +461,51 @@ class db(abc.ABC):
             self.conn.commit()
 
 
+class UnlockWatcher:
+    """ counts the lock releases of a database
+
+    A background thread calls listen(timeout), which returns True when a
+    node may have been released.  Waiters take seen() before a lock attempt
+    and wait() wakes them as soon as the count moves past it, so a release
+    between the attempt and the wait is not missed.
+    """
+    def __init__(self, listen):
+        self.listen = listen
+        self.cond = threading.Condition()
+        self.generation = 0
+        self.pid = None
+
+    def _start(self):
+        # the thread does not survive fork(), start one per process
+        with self.cond:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=self._run, name="meterdb-unlock-watcher", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                changed = self.listen(5)
+            except Exception as e:
+                logger.warning("Unlock watcher: %s", e)
+                time.sleep(5)
+                changed = True
+            if changed:
+                with self.cond:
+                    self.generation += 1
+                    self.cond.notify_all()
+
+    def seen(self):
+        self._start()
+        return self.generation
+
+    def wait(self, seen, timeout):
+        self._start()
+        with self.cond:
+            return self.cond.wait_for(lambda: self.generation != seen, timeout)
+
+
 class Cursor(object):
     def __init__(self, sqlite):
         self.cursor = sqlite.cursor()
@@ -83,27 +513,237 @@ class Cursor(object):
         return self.cursor
     def __exit__(self, type, value, traceback):
         self.cursor.close()
+# seconds a writer waits for another process to finish its transaction
+SQLITE_BUSY_TIMEOUT = float(os.getenv("METERDB_BUSY_TIMEOUT", 60))
+
+_SQLITE_QUEUE = """
+CREATE TABLE IF NOT EXISTS lock_queue (
+    request_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner TEXT,
+    lock_host TEXT,
+    nodes TEXT,
+    count INTEGER,
+    group_lock INTEGER,
+    priority INTEGER DEFAULT 0,
+    created REAL,
+    expires REAL
+)
+"""
+
+_SQLITE_EVENTS = """
+CREATE TABLE IF NOT EXISTS lock_events (
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_time REAL,
+    event TEXT,
+    node_ip TEXT,
+    request_id INTEGER,
+    owner TEXT,
+    host TEXT,
+    build_id TEXT
+)
+"""
+
 class db_sql(db):
-    def __init__(self, logger, source,platform=None, project=None, number_of_nodes=None, node_type=None, **kwargs):
+    """ meter database in a sqlite file
+
+    The parallel plugin forks processes that all lock meters in the same
+    file, so the database runs in WAL mode, writers wait busy_timeout
+    seconds for each other, and every lock transaction starts with BEGIN
+    IMMEDIATE.  The connection and its lock belong to one process; a
+    forked child opens its own and never touches the parent's.
+    """
+    def __init__(self, logger, source,platform=None, project=None, number_of_nodes=None, node_type=None,
+                 busy_timeout=None, **kwargs):
         self.platform = platform
         self.project = project
         self.number_of_nodes = number_of_nodes
         self.node_type = node_type
         self.kwargs = kwargs
-        self.conn = None
         self.logger = logger
         self.db_file = source
+        self.busy_timeout = float(busy_timeout) if busy_timeout else SQLITE_BUSY_TIMEOUT
+        self._conn = None
+        self._lock = None
+        self.pid = None
         try:
-            self.conn = sqlite3.connect(self.db_file,uri=True, check_same_thread=False)
             self.conn.execute("PRAGMA foreign_keys = ON")
         except Exception as e:
             self.logger.error("Exception %s connecting to database", e)
             raise
 
-        self.lock = RLock()
         self.shared_nodes = {}  # TYPE: DICT{str:int} {shared-node-ip:number of shared instances}
         self.shared_aps = {}    # TYPE: DICT{str:int} {shared-ap-ip:number of shared instances}
         self.plt_id = self.get_platform_id(self.platform, self.project)
+        self.watcher = UnlockWatcher(self._listen)
+        self.listener = None
+        self.node_table = 'Node'
+        self.queue_table = 'lock_queue'
+        self.events_table = 'lock_events'
+        self.schema_key = ('sqlite', self.db_file)
+        self._check_schema()
+        self.inventory = get_inventory(('sqlite', self.db_file, self.plt_id))
+
+    def _connect(self):
+        # autocommit, transactions are started explicitly
+        conn = sqlite3.connect(self.db_file, uri=True, check_same_thread=False,
+                               timeout=self.busy_timeout, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.OperationalError as e:
+            # read only or in memory databases keep their journal
+            self.logger.debug("sqlite: journal mode unchanged, %s", e)
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def _check_process(self):
+        if self.pid != os.getpid():
+            if self._conn is not None:
+                # closing it here could checkpoint or remove the WAL under the parent
+                _inherited.append(self._conn)
+            self._conn = None
+            # the parent may have held the lock when it forked
+            self._lock = RLock()
+            self.pid = os.getpid()
+
+    @property
+    def conn(self):
+        """ connection of this process """
+        self._check_process()
+        if self._conn is None:
+            self._conn = self._connect()
+        return self._conn
+
+    @conn.setter
+    def conn(self, conn):
+        self._check_process()
+        self._conn = conn
+
+    @property
+    def lock(self):
+        self._check_process()
+        return self._lock
+
+    @lock.setter
+    def lock(self, lock):
+        self._check_process()
+        self._lock = lock
+
+    def close(self):
+        self.heartbeat_pid = None
+        if self._conn is not None and self.pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def _read_schema(self):
+        with self.lock:
+            return _lock_schema(self.conn.execute(
+                "SELECT m.name, p.name FROM sqlite_master m, pragma_table_info(m.name) p "
+                f"WHERE m.type = 'table' AND lower(m.name) IN {_SCHEMA_TABLES}").fetchall())
+
+    def migrate(self):
+        """! add the lock tables and columns up to SCHEMA_VERSION, in one write transaction
+
+        Each step can run again on a database an older client already changed.
+
+        @return (version before, version after)
+        """
+        with self.lock:
+            with Cursor(self.conn) as cur:
+                try:
+                    cur.execute("BEGIN IMMEDIATE")
+                    cur.execute("CREATE TABLE IF NOT EXISTS meterdb_schema (version INTEGER)")
+                    cur.execute("SELECT max(version) FROM meterdb_schema")
+                    version = cur.fetchone()[0] or 0
+                    columns = [row[1] for row in cur.execute("PRAGMA table_info(Node)").fetchall()]
+                    if version < 1:
+                        names = {column.lower() for column in columns}
+                        if 'lock_owner' not in names:
+                            cur.execute("ALTER TABLE Node ADD COLUMN lock_owner TEXT")
+                        if 'lease_expires' not in names:
+                            cur.execute("ALTER TABLE Node ADD COLUMN lease_expires REAL")
+                    if version < 2:
+                        cur.execute(_SQLITE_QUEUE)
+                    if version < 3:
+                        cur.execute(_SQLITE_EVENTS)
+                        cur.execute("CREATE INDEX IF NOT EXISTS lock_events_time ON lock_events (event_time)")
+                    if version < 4:
+                        # a lock only sets LOCK_COLUMNS, it does not move the counter
+                        cur.execute("CREATE TABLE IF NOT EXISTS meterdb_inventory (version INTEGER NOT NULL)")
+                        cur.execute("INSERT INTO meterdb_inventory (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM meterdb_inventory)")
+                        watched = ', '.join('"%s"' % column for column in _inventory_columns(columns))
+                        for name, change in (('insert', 'INSERT'), ('delete', 'DELETE'), ('update', f'UPDATE OF {watched}')):
+                            cur.execute(f"CREATE TRIGGER IF NOT EXISTS node_inventory_{name} AFTER {change} ON Node "
+                                        "BEGIN UPDATE meterdb_inventory SET version = version + 1; END")
+                    if version < SCHEMA_VERSION:
+                        cur.execute("INSERT INTO meterdb_schema (version) VALUES (?)", (SCHEMA_VERSION,))
+                    self.conn.commit()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+        self._check_schema(refresh=True)
+        return version, max(version, SCHEMA_VERSION)
+
+    def _free(self):
+        """ condition for a node that can be locked, free or with an expired lease """
+        if self.leases:
+            return f"(node_busy = 'no' OR lease_expires < {time.time()})"
+        return "node_busy = 'no'"
+
+    def _claim(self, lease):
+        """ columns set when locking """
+        if not self.leases:
+            return ""
+        if lease:
+            return f", lock_owner = '{self.owner}', lease_expires = {time.time() + LEASE_SECONDS}"
+        return ", lock_owner = NULL, lease_expires = NULL"
+
+    def renew_leases(self):
+        expires = time.time() + LEASE_SECONDS
+        owner = self.owner
+        renewed = []
+        with self.lock:
+            with Cursor(self.conn) as cur:
+                try:
+                    cur.execute("BEGIN IMMEDIATE")
+                    if self.queue:
+                        cur.execute("UPDATE lock_queue SET expires = ? WHERE owner = ?", (expires, owner))
+                    if self.leases:
+                        cur.execute("UPDATE Node SET lease_expires = ? WHERE lock_owner = ? AND node_busy = 'yes'", (expires, owner))
+                        cur.execute("SELECT node_ip FROM Node WHERE lock_owner = ? AND node_busy = 'yes'", (owner,))
+                        renewed = [row[0] for row in cur.fetchall()]
+                    self.conn.commit()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+        return renewed
+
+    def _waiting_on(self, conn):
+        """ free nodes and queued requests, a waiter wakes when a node is freed or a request leaves """
+        free = {row[0] for row in conn.execute("SELECT node_ip FROM Node WHERE node_busy = 'no'")}
+        queued = {row[0] for row in conn.execute("SELECT request_id FROM lock_queue")} if self.queue else set()
+        return free, queued
+
+    def _listen(self, timeout):
+        """ data_version changes when another connection commits to the file
+
+        Lock events and locks taken are commits too, they do not wake the waiters.
+        """
+        if self.listener is None or self.listener[0] != os.getpid():
+            conn = sqlite3.connect(self.db_file, uri=True, check_same_thread=False)
+            self.listener = (os.getpid(), conn, conn.execute("PRAGMA data_version").fetchone()[0], self._waiting_on(conn))
+        pid, conn, version, (free, queued) = self.listener
+        end = time.time() + timeout
+        while time.time() < end:
+            time.sleep(0.5)
+            current = conn.execute("PRAGMA data_version").fetchone()[0]
+            if current != version:
+                now_free, now_queued = self._waiting_on(conn)
+                self.listener = (pid, conn, current, (now_free, now_queued))
+                if now_free - free or queued - now_queued:
+                    return True
+                version, free, queued = current, now_free, now_queued
+        return False
 
 
     def get_platform_id(self, platform, project):
@@ -124,27 +764,20 @@ class db_sql(db):
         return data[0][0]
 
 
-    def unlock_node(self, ip):
-        query = '''UPDATE Node
-                    SET node_busy = 'no'
-                    WHERE node_ip = '%s' AND node_busy = 'yes'
-                ''' % (str(ip))
-        count = self.runquery_update(query)
-        if count != 1:
-            raise ValueError("Node not present in database")
-
-    def lock_node(self, node):
+    def lock_node(self, node, lease=True):
         """
         attempt to lock a node for use.  retry for timeout seconds if busy
         """
         query = '''
             UPDATE {0} SET node_busy = 'yes',
-                busy_change_count = busy_change_count + 1
-                WHERE {1}'''.format('Node', f"node_busy = 'no' and node_ip = '{node}'")
+                busy_change_count = busy_change_count + 1{2}
+                WHERE {1}'''.format('Node', f"{self._free()} and node_ip = '{node}'", self._claim(lease))
         with self.lock:
             try:
                 count = self.runquery_update(query)
                 if count:
+                    if lease:
+                        self._start_heartbeat()
                     return True
                 else:
                     return False
@@ -152,43 +785,238 @@ class db_sql(db):
                 self.logger.error("Error in locking meter: %s", error)
         return False
 
+    def lock_group(self, nodes, lease=True):
+        """! lock every node or none of them, in one write transaction
 
-    def read_nodes(self, node_status='active', number_of_nodes=None, node_type=None, **kwargs):
-        query = '''SELECT *
-                    FROM Node
-                    WHERE platform_id = '%s' and node_status = '%s'
-                ''' % (self.plt_id,node_status)
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute(query)
-            data = cursor.fetchall()
-            result=[]
-            columns_descr = cursor.description
-            for item in data:
-                line = {}
-                for index in range(len(item)):
-                    name = columns_descr[index][0]
-                    line[name.upper()] = item[index]
-                result.append(MeterInstanceDB(line,self))
-        finally:
-            cursor.close()
-
-        return result
-
-    def dump(self, file):
-        result = file
-        if file is None:
-            result = io.StringIO
-        result = io.StringIO()
+        @return list of the node addresses locked, empty if any of them is busy
+        """
+        ips = node_ips(nodes)
+        marks = ','.join('?' * len(ips))
+        with self.lock:
+            with Cursor(self.conn) as cur:
+                try:
+                    cur.execute("BEGIN IMMEDIATE")
+                    cur.execute(f"SELECT count(*) FROM Node WHERE {self._free()} AND node_ip IN ({marks})", ips)
+                    if cur.fetchone()[0] != len(ips):
+                        self.conn.rollback()
+                        return []
+                    cur.execute(f"UPDATE Node SET node_busy = 'yes', busy_change_count = busy_change_count + 1"
+                                f"{self._claim(lease)} WHERE node_ip IN ({marks})", ips)
+                    self.conn.commit()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+        if lease:
+            self._start_heartbeat()
+        return ips
+
+    def lock_nodes(self, nodes, lease=True):
+        """! lock each of the nodes that is free, in one write transaction
+
+        @return list of the node addresses locked
+        """
+        ips = node_ips(nodes)
+        if not ips:
+            return []
+        marks = ','.join('?' * len(ips))
+        with self.lock:
+            with Cursor(self.conn) as cur:
+                try:
+                    cur.execute("BEGIN IMMEDIATE")
+                    cur.execute(f"SELECT node_ip FROM Node WHERE {self._free()} AND node_ip IN ({marks})", ips)
+                    free = {row[0] for row in cur.fetchall()}
+                    locked = [ip for ip in ips if ip in free]
+                    cur.execute(f"UPDATE Node SET node_busy = 'yes', busy_change_count = busy_change_count + 1"
+                                f"{self._claim(lease)} WHERE node_ip IN ({','.join('?' * len(locked))})", locked)
+                    self.conn.commit()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+        if locked and lease:
+            self._start_heartbeat()
+        return locked
+
+    def unlock_nodes(self, nodes, force=False, owner=None):
+        """! release nodes in one write transaction, unless force only those this owner holds
+
+        @param owner  release only the nodes held by this lock owner
+        @return list of the node addresses released
+        """
+        ips = node_ips(nodes)
+        if not ips:
+            return []
+        release = ""
+        owned = ""
+        if self.leases:
+            release = ", lock_owner = NULL, lease_expires = NULL"
+            if owner:
+                owned = f"AND lock_owner = '{owner}'"
+            elif not force:
+                owned = f"AND (lock_owner IS NULL OR lock_owner = '{self.owner}')"
+        marks = ','.join('?' * len(ips))
+        with self.lock:
+            with Cursor(self.conn) as cur:
+                try:
+                    cur.execute("BEGIN IMMEDIATE")
+                    cur.execute(f"SELECT node_ip FROM Node WHERE node_busy = 'yes' AND node_ip IN ({marks}) {owned}", ips)
+                    held = {row[0] for row in cur.fetchall()}
+                    released = [ip for ip in ips if ip in held]
+                    cur.execute(f"UPDATE Node SET node_busy = 'no'{release} WHERE node_ip IN ({','.join('?' * len(released))})", released)
+                    self.conn.commit()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+        return released
+
+    def request_locks(self, nodes, count=None, priority=0):
+        """! join the lock queue, grant_locks() then hands out the nodes in queue order
+
+        @param nodes     candidate node addresses
+        @param count     nodes wanted, None for all of them as one group
+        @param priority  higher is served first, FIFO within a priority
+        @return request id, None if the database has no lock queue
+        """
+        if not self.queue:
+            return None
+        ips = node_ips(nodes)
+        group = count is None
+        now = time.time()
+        with self.lock:
+            cur = self.conn.execute("INSERT INTO lock_queue (owner, lock_host, nodes, count, group_lock, priority, created, expires) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (self.owner, lock_host(), ','.join(ips), len(ips) if group else count,
+                                     int(group), priority, now, now + LEASE_SECONDS))
+            request_id = cur.lastrowid
+        # the heartbeat keeps the request queued
+        self._start_heartbeat()
+        return request_id
+
+    def grant_locks(self, request_id, lease=True):
+        """! lock the nodes the queue lets request_id have now, in one write transaction
+
+        @return list of the node addresses locked, the request leaves the queue once it has all it wanted
+        """
+        ips = []
+        with self.lock:
+            with Cursor(self.conn) as cur:
+                try:
+                    cur.execute("BEGIN IMMEDIATE")
+                    # requests of dead sessions are no longer renewed
+                    cur.execute("DELETE FROM lock_queue WHERE expires < ?", (time.time(),))
+                    cur.execute("SELECT request_id, nodes, count, group_lock FROM lock_queue ORDER BY priority DESC, request_id")
+                    queue = [(rid, nodes.split(','), count, bool(group)) for rid, nodes, count, group in cur.fetchall()]
+                    mine = [entry for entry in queue if entry[0] == request_id]
+                    if not mine:
+                        raise ValueError(f"lock request {request_id} is not queued")
+                    candidates = sorted({ip for entry in queue for ip in entry[1]})
+                    cur.execute(f"SELECT node_ip FROM Node WHERE {self._free()} AND node_ip IN ({','.join('?' * len(candidates))}) "
+                                "ORDER BY busy_change_count", candidates)
+                    ips = plan_grant(queue, [row[0] for row in cur.fetchall()], request_id)
+                    if ips:
+                        marks = ','.join('?' * len(ips))
+                        cur.execute(f"UPDATE Node SET node_busy = 'yes', busy_change_count = busy_change_count + 1"
+                                    f"{self._claim(lease)} WHERE node_ip IN ({marks})", ips)
+                        _, nodes, count, group = mine[0]
+                        if group or count <= len(ips):
+                            cur.execute("DELETE FROM lock_queue WHERE request_id = ?", (request_id,))
+                        else:
+                            cur.execute("UPDATE lock_queue SET count = ?, nodes = ? WHERE request_id = ?",
+                                        (count - len(ips), ','.join(ip for ip in nodes if ip not in ips), request_id))
+                    self.conn.commit()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+        if ips and lease:
+            self._start_heartbeat()
+        return ips
+
+    def lock_any(self, n, nodes=None, lease=True, **filters):
+        """! lock up to n free active nodes of the platform, in one write transaction
+
+        @param nodes    candidate node addresses, None for any node
+        @param filters  column=value the nodes must match, like peer_group='A'
+        @return list of MeterInstanceDB for the nodes locked
+        """
+        where = ["platform_id = ?", "node_status = 'active'", self._free()]
+        args = [self.plt_id]
+        if nodes is not None:
+            ips = node_ips(nodes)
+            if not ips:
+                return []
+            where.append(f"node_ip IN ({','.join('?' * len(ips))})")
+            args.extend(ips)
+        for column, value in filters.items():
+            assert column.isidentifier(), f"bad column name {column}"
+            where.append(f"{column} = ?")
+            args.append(value)
+        with self.lock:
+            with Cursor(self.conn) as cur:
+                try:
+                    cur.execute("BEGIN IMMEDIATE")
+                    cur.execute(f"SELECT node_ip FROM Node WHERE {' AND '.join(where)} "
+                                "ORDER BY busy_change_count LIMIT ?", args + [n])
+                    ips = [row[0] for row in cur.fetchall()]
+                    marks = ','.join('?' * len(ips))
+                    cur.execute(f"UPDATE Node SET node_busy = 'yes', busy_change_count = busy_change_count + 1"
+                                f"{self._claim(lease)} WHERE node_ip IN ({marks})", ips)
+                    cur.execute(f"SELECT * FROM Node WHERE node_ip IN ({marks})", ips)
+                    data = cur.fetchall()
+                    names = [c[0].upper() for c in cur.description]
+                    self.conn.commit()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+        if data and lease:
+            self._start_heartbeat()
+        return [MeterInstanceDB(dict(zip(names, item)), self) for item in data]
+
+
+    def inventory_rows(self):
+        with self.lock:
+            with Cursor(self.conn) as cur:
+                cur.execute("SELECT * FROM Node WHERE platform_id = ?", (self.plt_id,))
+                return [c[0] for c in cur.description], cur.fetchall()
+
+    def inventory_version(self):
+        """ counter the Node triggers move, None before mdb migrate so the rows are read every time """
+        if not self.inventory_counter:
+            return None
+        with self.lock:
+            return self.conn.execute("SELECT version FROM meterdb_inventory").fetchone()[0]
 
-        for line in self.conn.iterdump():
-            result.write(line)
-            result.write('\n')
+    def dump(self, file, tables=None, copy=False):
+        """! stream the database to file as SQL text, like the sqlite3 .dump command
 
-        if file:
+        @param file    writable text file, None returns the dump as a string
+        @param tables  names of the tables to dump, default all
+        """
+        if copy:
+            raise ValueError("COPY format is only available for postgres databases")
+        if file is None:
+            result = io.StringIO()
+            self.dump(result, tables)
+            return result.getvalue()
+
+        if not tables:
+            for line in self.conn.iterdump():
+                file.write(line)
+                file.write('\n')
             return
-        result.seek(0)
-        return result.read()
+
+        # iterdump has no table filter before python 3.13, quote the rows the same way it does
+        wanted = {name.lower() for name in tables}
+        schema = self.conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' AND sql NOT NULL ORDER BY name").fetchall()
+        file.write('BEGIN TRANSACTION;\n')
+        for name, create in schema:
+            if name.lower() not in wanted:
+                continue
+            file.write('%s;\n' % create)
+            table = name.replace('"', '""')
+            columns = [row[1] for row in self.conn.execute(f'PRAGMA table_info("{table}")')]
+            values = " || ',' || ".join('quote("%s")' % column.replace('"', '""') for column in columns)
+            for row in self.conn.execute(f"""SELECT 'INSERT INTO "{table}" VALUES(' || {values} || ')' FROM "{table}";"""):
+                file.write('%s;\n' % row[0])
+        file.write('COMMIT;\n')
 
     def exec(self, query):
         with Cursor(self.conn) as curpg:
@@ -202,25 +1030,185 @@ class db_sql(db):
         try:
             with self.lock:
                 with Cursor(self.conn) as curpg:
-                    curpg.execute(query)
-                    self.conn.commit()
-                    return curpg.rowcount
+                    # take the write lock first, a deferred transaction can fail
+                    # with "database is locked" when it has to upgrade
+                    curpg.execute("BEGIN IMMEDIATE")
+                    try:
+                        curpg.execute(query)
+                        count = curpg.rowcount
+                        self.conn.commit()
+                    except BaseException:
+                        self.conn.rollback()
+                        raise
+                    return count
         except Exception as e:
             self.logger.error('sqlite: Error %s',e)
             raise e
 
-from contextlib import contextmanager
-@contextmanager
-def sql_connection(database, user, password, host, port):
-    conn = None
-    try:
-        conn = psycopg2.connect(database=database, user=user, password=password,
-                                         host=host, port=port)
-        yield conn
-    finally:
-        if conn:
-            conn.commit()
+# connections idle longer than this are checked with a round trip before use
+POOL_CHECK_IDLE = 30
+POOL_SIZE = int(os.getenv("METERDB_POOL_SIZE", 8))
+# rows fetched per round trip by dump
+DUMP_ROWS = 2000
+
+class ConnectionPool:
+    """ thread safe pool of postgres connections
+
+    Connections are in autocommit mode, so a single statement is one round
+    trip.  Use `with conn:` for a multi statement transaction.
+
+    A connection that has been idle for POOL_CHECK_IDLE seconds is checked
+    before it is handed out, and a broken one is replaced.  After fork() the
+    child starts with an empty pool and never touches the parent's sockets.
+    """
+    def __init__(self, maxsize=POOL_SIZE, **params):
+        self.params = params
+        self.maxsize = maxsize
+        self.cond = threading.Condition()
+        self.idle = []          # (connection, time returned to the pool)
+        self.conns = set()      # opened by the pool in this process, idle or in use
+        self.size = 0
+        self.pid = os.getpid()
+
+    def _connect(self):
+        conn = psycopg2.connect(connect_timeout=30, keepalives=1, keepalives_idle=60, **self.params)
+        conn.autocommit = True
+        with self.cond:
+            self.conns.add(conn)
+        return conn
+
+    def _after_fork(self):
+        # the parent still uses these sockets, keep them referenced so they are never closed here
+        _inherited.extend(self.conns)
+        self.conns = set()
+        self.idle = []
+        self.size = 0
+        self.cond = threading.Condition()
+        self.pid = os.getpid()
+
+    def _healthy(self, conn, returned):
+        if conn.closed:
+            return False
+        if time.time() - returned < POOL_CHECK_IDLE:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def get(self, timeout=120):
+        """ take a connection, waiting up to timeout seconds when maxsize are in use """
+        if self.pid != os.getpid():
+            self._after_fork()
+        end = time.time() + timeout
+        while True:
+            with self.cond:
+                while not self.idle and self.size >= self.maxsize:
+                    if not self.cond.wait(end - time.time()):
+                        raise TimeoutError(f"no database connection available after {timeout}s")
+                if self.idle:
+                    conn, returned = self.idle.pop()
+                else:
+                    self.size += 1
+                    conn = None
+            if conn is None:
+                try:
+                    return self._connect()
+                except BaseException:
+                    self._release_slot()
+                    raise
+            if self._healthy(conn, returned):
+                return conn
+            self.discard(conn)
+
+    def put(self, conn):
+        """ return a connection, a broken or busy one is closed """
+        if self.pid != os.getpid() or conn not in self.conns:
+            # taken before fork(), it belongs to the parent
+            return
+        if not conn.closed and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        if conn.closed or conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self.discard(conn)
+            return
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def discard(self, conn):
+        with self.cond:
+            self.conns.discard(conn)
+        try:
             conn.close()
+        except psycopg2.Error:
+            pass
+        self._release_slot()
+
+    def _release_slot(self):
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.get()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.discard(conn)
+            raise
+        except BaseException:
+            self.put(conn)
+            raise
+        self.put(conn)
+
+    def run(self, func):
+        """ call func(conn), once more on a new connection if the connection failed """
+        for attempt in (1, 2):
+            conn = self.get()
+            try:
+                result = func(conn)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                self.discard(conn)
+                if attempt == 2 or not conn.closed:
+                    raise
+                logger.warning("database connection lost (%s), reconnecting", e)
+                continue
+            except BaseException:
+                self.put(conn)
+                raise
+            self.put(conn)
+            return result
+
+    def close(self):
+        with self.cond:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            self.discard(conn)
+
+
+_inherited = []
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(database, user, password, host, port):
+    """ the pool shared by every db_pgre in this process for a database """
+    key = (database, user, host, port)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(database=database, user=user, password=password, host=host, port=port)
+        return _pools[key]
+
+def _reset_pools_after_fork():
+    for pool in _pools.values():
+        pool._after_fork()
+
+os.register_at_fork(after_in_child=_reset_pools_after_fork)
 
 class db_pgre(db):
     def __init__(self, logger, pgdb=None, pguser=None, pgpswd=None, pghost=None, pgport=None,
@@ -240,61 +1228,184 @@ class db_pgre(db):
         self.pgpswd = base64.b64decode(pgpswd).decode()
         self.pghost = pghost
         self.pgport = pgport
+        self.pool = get_pool(database=self.pgdb, user=self.pguser, password=self.pgpswd,
+                             host=self.pghost, port=self.pgport)
         self.plt_id = self.get_platform_id(schema, platform, project)
+        self.channel = f"meterdb_{schema}".lower()
+        self.watcher = UnlockWatcher(self._listen)
+        self.listener = None
+        self.node_table = self.schema + '.Node'
+        self.queue_table = self.schema + '.lock_queue'
+        self.events_table = self.schema + '.lock_events'
+        self.schema_key = ('psql', self.pghost, self.pgport, self.pgdb, self.schema)
+        self._check_schema()
+        self.inventory = get_inventory(('psql', self.pghost, self.pgport, self.pgdb, self.schema, self.plt_id))
+
+    def _read_schema(self):
+        data, _ = self._fetch(sql.SQL("SELECT table_name, column_name FROM information_schema.columns "
+                                      "WHERE table_schema = {schema} AND table_name IN {tables}").format(
+                                          schema=sql.Literal(self.schema.lower()), tables=sql.Literal(_SCHEMA_TABLES)))
+        return _lock_schema(data)
+
+    def migrate(self):
+        """! add the lock tables and columns up to SCHEMA_VERSION, in one transaction
+
+        Each step can run again on a database an older client already changed.
+
+        @return (version before, version after)
+        """
+        version_tab = sql.SQL(self.schema + '.meterdb_schema')
+        events_tab = sql.SQL(self.events_table)
+        with self.pool.connection() as conn:
+            with conn, conn.cursor() as cur:
+                cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} (version integer)").format(version_tab))
+                # one migration at a time
+                cur.execute(sql.SQL("LOCK TABLE {} IN EXCLUSIVE MODE").format(version_tab))
+                cur.execute(sql.SQL("SELECT max(version) FROM {}").format(version_tab))
+                version = cur.fetchone()[0] or 0
+                if version < 1:
+                    cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS lock_owner text, "
+                                        "ADD COLUMN IF NOT EXISTS lease_expires timestamptz").format(sql.SQL(self.node_table)))
+                if version < 2:
+                    cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} ("
+                                        "request_id bigserial PRIMARY KEY, owner text, lock_host text, nodes text, "
+                                        "count integer, group_lock boolean, priority integer DEFAULT 0, "
+                                        "created timestamptz DEFAULT now(), expires timestamptz)").format(sql.SQL(self.queue_table)))
+                if version < 3:
+                    cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} ("
+                                        "event_id bigserial PRIMARY KEY, event_time double precision, event text, "
+                                        "node_ip text, request_id bigint, owner text, host text, build_id text)").format(events_tab))
+                    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS lock_events_time ON {} (event_time)").format(events_tab))
+                if version < 4:
+                    # a lock only sets LOCK_COLUMNS, it does not move the counter
+                    counter_tab = sql.SQL(self.schema + '.meterdb_inventory')
+                    changed = sql.SQL(self.schema + '.meterdb_inventory_changed')
+                    cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} (version bigint NOT NULL)").format(counter_tab))
+                    cur.execute(sql.SQL("INSERT INTO {tab} (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM {tab})").format(tab=counter_tab))
+                    cur.execute(sql.SQL("CREATE OR REPLACE FUNCTION {}() RETURNS trigger LANGUAGE plpgsql AS "
+                                        "$$ BEGIN UPDATE {} SET version = version + 1; RETURN NULL; END $$").format(changed, counter_tab))
+                    cur.execute(sql.SQL("SELECT column_name FROM information_schema.columns "
+                                        "WHERE table_schema = {} AND table_name = 'node' ORDER BY ordinal_position").format(
+                                            sql.Literal(self.schema.lower())))
+                    watched = sql.SQL(', ').join(map(sql.Identifier, _inventory_columns([row[0] for row in cur.fetchall()])))
+                    cur.execute(sql.SQL("DROP TRIGGER IF EXISTS node_inventory ON {}").format(sql.SQL(self.node_table)))
+                    cur.execute(sql.SQL("CREATE TRIGGER node_inventory AFTER INSERT OR DELETE OR UPDATE OF {} ON {} "
+                                        "FOR EACH STATEMENT EXECUTE PROCEDURE {}()").format(watched, sql.SQL(self.node_table), changed))
+                if version < SCHEMA_VERSION:
+                    cur.execute(sql.SQL("INSERT INTO {} (version) VALUES ({})").format(version_tab, sql.Literal(SCHEMA_VERSION)))
+        self._check_schema(refresh=True)
+        return version, max(version, SCHEMA_VERSION)
+
+    def _free(self):
+        """ condition for a node that can be locked, free or with an expired lease """
+        if self.leases:
+            return sql.SQL("(node_busy = 'no' OR lease_expires < now())")
+        return sql.SQL("node_busy = 'no'")
+
+    def _claim(self, lease):
+        """ columns set when locking """
+        if not self.leases:
+            return sql.SQL("")
+        if lease:
+            return sql.SQL(", lock_owner = {owner}, lease_expires = now() + {seconds} * interval '1 second'").format(
+                owner=sql.Literal(self.owner), seconds=sql.Literal(LEASE_SECONDS))
+        return sql.SQL(", lock_owner = NULL, lease_expires = NULL")
+
+    def renew_leases(self):
+        if self.queue:
+            self.runquery_update(sql.SQL("UPDATE {tab} SET expires = now() + {seconds} * interval '1 second' "
+                                         "WHERE owner = {owner}").format(
+                                             tab=sql.SQL(self.queue_table), seconds=sql.Literal(LEASE_SECONDS), owner=sql.Literal(self.owner)))
+        if not self.leases:
+            return []
+        query = sql.SQL("UPDATE {tab} SET lease_expires = now() + {seconds} * interval '1 second' "
+                        "WHERE lock_owner = {owner} AND node_busy = 'yes' RETURNING node_ip").format(
+                            tab=sql.SQL(self.node_table), seconds=sql.Literal(LEASE_SECONDS), owner=sql.Literal(self.owner))
+        data, _ = self._fetch(query)
+        return [row[0] for row in data]
+
+    def _listen(self, timeout):
+        """ LISTEN on a connection of its own for the NOTIFY sent by unlock_nodes """
+        if self.listener is not None and (self.listener[0] != os.getpid() or self.listener[1].closed):
+            if self.listener[0] != os.getpid():
+                _inherited.append(self.listener[1])
+            self.listener = None
+        if self.listener is None:
+            conn = psycopg2.connect(database=self.pgdb, user=self.pguser, password=self.pgpswd,
+                                    host=self.pghost, port=self.pgport, connect_timeout=30)
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+            self.listener = (os.getpid(), conn)
+            # releases may have been missed while not listening
+            return True
+        conn = self.listener[1]
+        try:
+            if select.select([conn], [], [], timeout) == ([], [], []):
+                return False
+            conn.poll()
+        except (psycopg2.Error, OSError):
+            conn.close()
+            raise
+        changed = bool(conn.notifies)
+        conn.notifies.clear()
+        return changed
 
-    def get_platform_id(self, schema, platform, project):
-
-        with sql_connection(database=self.pgdb, user=self.pguser, password=self.pgpswd,
-                                         host=self.pghost, port=self.pgport) as conn:
+    def _fetch(self, query):
+        """ rows and column names of a query, one round trip on a pooled connection """
+        def run(conn):
+            with conn.cursor() as cursor:
+                cursor.execute(query)
+                if not cursor.description:
+                    return None, None
+                return cursor.fetchall(), [c.name for c in cursor.description]
+        return self.pool.run(run)
 
-            query = '''SELECT platform_id
-                    FROM %s.platform
-                    WHERE platform_name = '%s' and project_name = '%s'
-                    ''' % (schema, platform, project)
-            data = None
-            with conn.cursor() as curpg:
-                curpg.execute(query)
-                data = curpg.fetchall()
-            if not data:
-                return 'NULL'
-            if not self._verify_singularity(data):
-                return 'AMBIGUOUS'
+    def get_platform_id(self, schema, platform, project):
+        query = '''SELECT platform_id
+                FROM %s.platform
+                WHERE platform_name = '%s' and project_name = '%s'
+                ''' % (schema, platform, project)
+        data, _ = self._fetch(query)
+        if not data:
+            return 'NULL'
+        if not self._verify_singularity(data):
+            return 'AMBIGUOUS'
         return data[0][0]
 
     def runquery_update(self, query):
+        def run(conn):
+            with conn.cursor() as curpg:
+                curpg.execute(query)
+                return curpg.rowcount
         try:
-            with sql_connection(database=self.pgdb, user=self.pguser, password=self.pgpswd,
-                                            host=self.pghost, port=self.pgport) as conn:
-
-                with conn.cursor() as curpg:
-                    curpg.execute(query)
-                    conn.commit()
-                    return curpg.rowcount
+            return self.pool.run(run)
         except psycopg2.DatabaseError as e:
             self.logger.error('kbotdbserver_psql: Error %s', e)
             raise e
 
 
-    def lock_node(self, node):
+    def lock_node(self, node, lease=True):
         """
         attempt to lock a node for use.  retry for timeout seconds if busy
         """
         if isinstance(node, MeterInstanceBase):
             node = node.ip_address
 
-        where_condt = sql.SQL(f"node_busy = 'no' and node_ip = '{node}'")
-        hostname = os.uname()[1]
-        if os.getenv("BUILD_BUILDID"):
-            hostname += "-" + os.getenv("BUILD_BUILDID")
+        where_condt = sql.SQL("{free} and node_ip = {node}").format(free=self._free(), node=sql.Literal(str(node)))
+        hostname = lock_host()
 
         query = sql.SQL("UPDATE {tab} SET node_busy = 'yes', "
                         "busy_change_count = busy_change_count + 1, "
                         "last_busy_change = (SELECT now()), "
-                        "lock_host = {host} "
-                        "WHERE {condition}").format(tab=sql.SQL(self.schema + '.Node'), host=sql.Literal(hostname), condition=where_condt)
+                        "lock_host = {host}{claim} "
+                        "WHERE {condition}").format(tab=sql.SQL(self.schema + '.Node'), host=sql.Literal(hostname),
+                                                    claim=self._claim(lease), condition=where_condt)
         try:
             count = self.runquery_update(query)
             if count:
+                if lease:
+                    self._start_heartbeat()
                 return True
             else:
                 return False
@@ -302,115 +1413,274 @@ class db_pgre(db):
             self.logger.error("Error in locking meter: %s", error)
         return False
 
+    def lock_group(self, nodes, lease=True):
+        """! lock every node or none of them, in one statement
 
-    def exec(self, query):
-        with sql_connection(database=self.pgdb, user=self.pguser, password=self.pgpswd,
-                                         host=self.pghost, port=self.pgport) as conn:
+        The free nodes are row locked with SKIP LOCKED, and updated only if
+        that is all of them, so two sessions can never each hold part of a group.
 
-            with conn.cursor() as curpg:
-                curpg.execute(query)
-                conn.commit()
-                if curpg.description:
-                    return curpg.fetchall()
-        return None
+        @return list of the node addresses locked, empty if any of them is busy
+        """
+        ips = node_ips(nodes)
+        query = sql.SQL("WITH free AS (SELECT node_ip FROM {tab} "
+                        "WHERE node_ip = ANY({ips}) AND {free} FOR UPDATE SKIP LOCKED) "
+                        "UPDATE {tab} SET node_busy = 'yes', "
+                        "busy_change_count = busy_change_count + 1, "
+                        "last_busy_change = (SELECT now()), "
+                        "lock_host = {host}{claim} "
+                        "WHERE node_ip IN (SELECT node_ip FROM free) AND (SELECT count(*) FROM free) = {count} "
+                        "RETURNING node_ip").format(tab=sql.SQL(self.schema + '.Node'), ips=sql.Literal(ips),
+                                                    free=self._free(), host=sql.Literal(lock_host()),
+                                                    claim=self._claim(lease), count=sql.Literal(len(ips)))
+        try:
+            data, _ = self._fetch(query)
+        except psycopg2.Error as error:
+            self.logger.error("Error in locking meters: %s", error)
+            return []
+        if len(data) != len(ips):
+            return []
+        if lease:
+            self._start_heartbeat()
+        return ips
+
+    def lock_nodes(self, nodes, lease=True):
+        """! lock each of the nodes that is free, in one statement
+
+        @return list of the node addresses locked
+        """
+        ips = node_ips(nodes)
+        if not ips:
+            return []
+        query = sql.SQL("UPDATE {tab} SET node_busy = 'yes', "
+                        "busy_change_count = busy_change_count + 1, "
+                        "last_busy_change = (SELECT now()), "
+                        "lock_host = {host}{claim} "
+                        "WHERE node_ip IN (SELECT node_ip FROM {tab} WHERE node_ip = ANY({ips}) AND {free} FOR UPDATE SKIP LOCKED) "
+                        "RETURNING node_ip").format(tab=sql.SQL(self.node_table), host=sql.Literal(lock_host()),
+                                                    claim=self._claim(lease), ips=sql.Literal(ips), free=self._free())
+        try:
+            data, _ = self._fetch(query)
+        except psycopg2.Error as error:
+            self.logger.error("Error in locking meters: %s", error)
+            return []
+        free = {row[0] for row in data}
+        locked = [ip for ip in ips if ip in free]
+        if locked and lease:
+            self._start_heartbeat()
+        return locked
+
+    def unlock_nodes(self, nodes, force=False, owner=None):
+        """! release nodes in one statement, unless force only those this owner holds
+
+        @param owner  release only the nodes held by this lock owner
+        @return list of the node addresses released
+        """
+        ips = node_ips(nodes)
+        if not ips:
+            return []
+        release = sql.SQL("")
+        owned = sql.SQL("")
+        if self.leases:
+            release = sql.SQL(", lock_owner = NULL, lease_expires = NULL")
+            if owner:
+                owned = sql.SQL("AND lock_owner = {}").format(sql.Literal(owner))
+            elif not force:
+                owned = sql.SQL("AND (lock_owner IS NULL OR lock_owner = {})").format(sql.Literal(self.owner))
+        # one notification per node, waiters LISTEN for it and it is sent when the update commits
+        query = sql.SQL("WITH released AS ("
+                        "UPDATE {tab} SET node_busy = 'no', last_busy_change = (SELECT now()){release} "
+                        "WHERE node_ip = ANY({ips}) AND node_busy = 'yes' {owned} "
+                        "RETURNING node_ip) "
+                        "SELECT node_ip, pg_notify({channel}, node_ip) FROM released").format(
+                            tab=sql.SQL(self.node_table), release=release, ips=sql.Literal(ips), owned=owned,
+                            channel=sql.Literal(self.channel))
+        data, _ = self._fetch(query)
+        held = {row[0] for row in data}
+        return [ip for ip in ips if ip in held]
+
+    def request_locks(self, nodes, count=None, priority=0):
+        """! join the lock queue, grant_locks() then hands out the nodes in queue order
+
+        @param nodes     candidate node addresses
+        @param count     nodes wanted, None for all of them as one group
+        @param priority  higher is served first, FIFO within a priority
+        @return request id, None if the database has no lock queue
+        """
+        if not self.queue:
+            return None
+        ips = node_ips(nodes)
+        group = count is None
+        query = sql.SQL("INSERT INTO {tab} (owner, lock_host, nodes, count, group_lock, priority, expires) "
+                        "VALUES ({owner}, {host}, {nodes}, {count}, {group}, {priority}, now() + {seconds} * interval '1 second') "
+                        "RETURNING request_id").format(tab=sql.SQL(self.queue_table), owner=sql.Literal(self.owner),
+                                                       host=sql.Literal(lock_host()), nodes=sql.Literal(','.join(ips)),
+                                                       count=sql.Literal(len(ips) if group else count), group=sql.Literal(group),
+                                                       priority=sql.Literal(priority), seconds=sql.Literal(LEASE_SECONDS))
+        data, _ = self._fetch(query)
+        # the heartbeat keeps the request queued
+        self._start_heartbeat()
+        return data[0][0]
 
-    def unlock_node(self, ip):
-        # TODO: could mark instance locked and use index to unlock instead of using addr
-        if isinstance(ip,MeterInstanceBase):
-            ip = ip.ip_address
+    def grant_locks(self, request_id, lease=True):
+        """! lock the nodes the queue lets request_id have now, in one transaction
 
-        query = '''UPDATE %s.Node
-                    SET node_busy = 'no', last_busy_change = (SELECT now())
-                    WHERE node_ip = '%s' AND node_busy = 'yes'
-                ''' % (self.schema, str(ip))
-        retry = 10
-        while retry:
-            try:
-                count = self.runquery_update(query)
-                retry = 0
-            except BaseException as e:
-                retry -= 1
-                if retry:
-                    self.logger.warning("Exception %s connecting to database.  Retry %s more times", e, retry)
-                    time.sleep(20)
-                else:
-                    self.logger.error("Final Exception %s, while unlocking node", e)
-                    raise
+        The queue table is locked for the transaction so grants are decided
+        one at a time, nodes row locked by a direct locker are skipped.
 
-        if count != 1:
-            raise ValueError("Node not present in database")
+        @return list of the node addresses locked, the request leaves the queue once it has all it wanted
+        """
+        queue_tab = sql.SQL(self.queue_table)
+        with self.pool.connection() as conn:
+            with conn, conn.cursor() as cur:
+                cur.execute(sql.SQL("LOCK TABLE {} IN EXCLUSIVE MODE").format(queue_tab))
+                # requests of dead sessions are no longer renewed
+                cur.execute(sql.SQL("DELETE FROM {} WHERE expires < now()").format(queue_tab))
+                cur.execute(sql.SQL("SELECT request_id, nodes, count, group_lock FROM {} "
+                                    "ORDER BY priority DESC, request_id").format(queue_tab))
+                queue = [(rid, nodes.split(','), count, group) for rid, nodes, count, group in cur.fetchall()]
+                mine = [entry for entry in queue if entry[0] == request_id]
+                if not mine:
+                    raise ValueError(f"lock request {request_id} is not queued")
+                candidates = sorted({ip for entry in queue for ip in entry[1]})
+                cur.execute(sql.SQL("SELECT node_ip FROM {tab} WHERE node_ip = ANY(%s) AND {free} "
+                                    "ORDER BY busy_change_count FOR UPDATE SKIP LOCKED").format(
+                                        tab=sql.SQL(self.node_table), free=self._free()), (candidates,))
+                ips = plan_grant(queue, [row[0] for row in cur.fetchall()], request_id)
+                if ips:
+                    cur.execute(sql.SQL("UPDATE {tab} SET node_busy = 'yes', "
+                                        "busy_change_count = busy_change_count + 1, "
+                                        "last_busy_change = (SELECT now()), "
+                                        "lock_host = {host}{claim} "
+                                        "WHERE node_ip = ANY(%s)").format(tab=sql.SQL(self.node_table), host=sql.Literal(lock_host()),
+                                                                         claim=self._claim(lease)), (ips,))
+                    _, nodes, count, group = mine[0]
+                    if group or count <= len(ips):
+                        cur.execute(sql.SQL("DELETE FROM {} WHERE request_id = %s").format(queue_tab), (request_id,))
+                    else:
+                        cur.execute(sql.SQL("UPDATE {} SET count = %s, nodes = %s WHERE request_id = %s").format(queue_tab),
+                                    (count - len(ips), ','.join(ip for ip in nodes if ip not in ips), request_id))
+        if ips and lease:
+            self._start_heartbeat()
+        return ips
+
+    def lock_any(self, n, nodes=None, lease=True, **filters):
+        """! lock up to n free active nodes of the platform, in one statement
+
+        Nodes row locked by another session are skipped instead of waited
+        for, the least used nodes are taken first.
+
+        @param nodes    candidate node addresses, None for any node
+        @param filters  column=value the nodes must match, like peer_group='A'
+        @return list of MeterInstanceDB for the nodes locked
+        """
+        where = [sql.SQL("platform_id = {}").format(sql.Literal(self.plt_id)),
+                 sql.SQL("node_status = 'active'"),
+                 self._free()]
+        if nodes is not None:
+            ips = node_ips(nodes)
+            if not ips:
+                return []
+            where.append(sql.SQL("node_ip = ANY({})").format(sql.Literal(ips)))
+        for column, value in filters.items():
+            where.append(sql.SQL("{} = {}").format(sql.Identifier(column), sql.Literal(value)))
+        query = sql.SQL("UPDATE {tab} SET node_busy = 'yes', "
+                        "busy_change_count = busy_change_count + 1, "
+                        "last_busy_change = (SELECT now()), "
+                        "lock_host = {host}{claim} "
+                        "WHERE node_ip IN (SELECT node_ip FROM {tab} WHERE {condition} "
+                        "ORDER BY busy_change_count LIMIT {n} FOR UPDATE SKIP LOCKED) "
+                        "RETURNING *").format(tab=sql.SQL(self.schema + '.Node'), host=sql.Literal(lock_host()),
+                                              claim=self._claim(lease), condition=sql.SQL(' AND ').join(where),
+                                              n=sql.Literal(n))
+        try:
+            data, names = self._fetch(query)
+        except psycopg2.Error as error:
+            self.logger.error("Error in locking meters: %s", error)
+            return []
+        if data and lease:
+            self._start_heartbeat()
+        names = [name.upper() for name in names]
+        return [MeterInstanceDB(dict(zip(names, item)), self) for item in data]
 
-    def read_nodes(self, node_status='active', number_of_nodes=None, node_type=None, **kwargs):
-        if node_type:
-            query = '''SELECT *
-                       FROM %s.Node
-                       WHERE platform_id = '%s' and node_device_type = %s and node_status LIKE '%s'
-                    ''' % (self.schema, self.plt_id, node_type, node_status)
-        else:
-            query = '''SELECT *
-                       FROM %s.Node
-                       WHERE platform_id = '%s' and node_status LIKE '%s'
-                    ''' % (self.schema, self.plt_id, node_status)
 
-        with sql_connection(database=self.pgdb, user=self.pguser, password=self.pgpswd,
-                                        host=self.pghost, port=self.pgport) as conn:
+    def exec(self, query):
+        data, _ = self._fetch(query)
+        return data
+
+    def inventory_rows(self):
+        data, names = self._fetch(sql.SQL("SELECT * FROM {tab} WHERE platform_id = {plt}").format(
+            tab=sql.SQL(self.node_table), plt=sql.Literal(self.plt_id)))
+        return names, data
+
+    def inventory_version(self):
+        """ counter the Node trigger moves, before mdb migrate a digest of the columns a lock does not change """
+        if self.inventory_counter:
+            data, _ = self._fetch(sql.SQL("SELECT version FROM {}").format(sql.SQL(self.schema + '.meterdb_inventory')))
+            return data[0][0]
+        # computed by the server so only the digest comes back
+        data, _ = self._fetch(sql.SQL("SELECT md5(string_agg((to_jsonb(n) - {lock_columns})::text, ',' ORDER BY n.node_ip)) "
+                                      "FROM {tab} n WHERE platform_id = {plt}").format(
+                                          tab=sql.SQL(self.node_table), plt=sql.Literal(self.plt_id),
+                                          lock_columns=sql.Literal(list(LOCK_COLUMNS))))
+        return data[0][0]
+
+    def dump(self, file, tables=None, copy=False):
+        """! stream the database to file, INSERT statements or COPY blocks per table
+
+        Rows come from a server side cursor, DUMP_ROWS at a time, or straight
+        from COPY ... TO STDOUT, so memory stays flat whatever the table size.
+
+        @param file    writable text file, None returns the dump as a string
+        @param tables  names to dump, `table` or `schema.table`, default all
+        @param copy    write COPY ... FROM stdin blocks as pg_dump does
+        """
+        if file is None:
+            result = io.StringIO()
+            self.dump(result, tables, copy)
+            return result.getvalue()
 
-            with conn.cursor() as cursor:
-                cursor.execute(query)
-                data = cursor.fetchall()
-                result=[]
-                columns_descr = cursor.description
-                for item in data:
-                    line = {}
-                    for index in range(len(item)):
-                        name = columns_descr[index].name
-                        line[name.upper()] = item[index]
-                    result.append(MeterInstanceDB(line,self))
-                del cursor
-
-        return result
-
-    def dump(self, file):
         query = """
-SELECT *
+SELECT schemaname, tablename
 FROM pg_catalog.pg_tables
 WHERE schemaname != 'pg_catalog' AND
-    schemaname != 'information_schema';
+    schemaname != 'information_schema'
+ORDER BY schemaname, tablename;
 """
-        with sql_connection(database=self.pgdb, user=self.pguser, password=self.pgpswd,
-                                        host=self.pghost, port=self.pgport) as conn:
-
+        with self.pool.connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(query)
-                values = cursor.fetchall()
-                result = file
-                if file is None:
-                    result = io.StringIO
-                result = io.StringIO()
-                for table in values:
-                    table_name=table[0] + "." + table[1]
-                    if table_name:
-                        cursor.execute("SELECT * FROM %s" % (table_name))
-                        column_names = []
-                        columns_descr = cursor.description
-                        for c in columns_descr:
-                            column_names.append(c[0])
-                        insert_prefix = 'INSERT INTO %s (%s) VALUES ' % (table_name, ', '.join(column_names))
-                        rows = cursor.fetchall()
-                        for row in rows:
-                            row_data = []
-                            for rd in row:
-                                if rd is None:
-                                    row_data.append('NULL')
-                                elif isinstance(rd, datetime.datetime):
-                                    row_data.append("'%s'" % (rd.strftime('%Y-%m-%d %H:%M:%S') ))
-                                else:
-                                    row_data.append(repr(rd))
-                            result.write('%s (%s);\n\n' % (insert_prefix, ', '.join(row_data)))  # this is the text that will be put in the SQL file
-                if file:
-                    return
-                result.seek(0)
-                return result.read()
+                names = [f"{schema}.{table}" for schema, table in cursor.fetchall()]
+            if tables:
+                wanted = {name.lower() for name in tables}
+                names = [name for name in names if name.lower() in wanted or name.split('.', 1)[1].lower() in wanted]
+
+            for table_name in names:
+                table = sql.Identifier(*table_name.split('.', 1))
+                with conn.cursor() as cursor:
+                    cursor.execute(sql.SQL("SELECT * FROM {} LIMIT 0").format(table))
+                    column_names = [c[0] for c in cursor.description]
+                columns = sql.SQL(', ').join(map(sql.Identifier, column_names)).as_string(conn)
+                if copy:
+                    file.write(f"COPY {table.as_string(conn)} ({columns}) FROM stdin;\n")
+                    with conn.cursor() as cursor:
+                        cursor.copy_expert(sql.SQL("COPY {} TO STDOUT").format(table), file)
+                    file.write("\\.\n\n")
+                    continue
+
+                insert_prefix = 'INSERT INTO %s (%s) VALUES ' % (table.as_string(conn), columns)
+                row_format = '(' + ', '.join(['%s'] * len(column_names)) + ')'
+                # named cursors need a transaction, the pool hands out autocommit connections
+                conn.autocommit = False
+                try:
+                    with conn.cursor() as quote, conn.cursor(name=f"dump_{uuid.uuid4().hex}") as cursor:
+                        cursor.itersize = DUMP_ROWS
+                        cursor.execute(sql.SQL("SELECT * FROM {}").format(table))
+                        for row in cursor:
+                            values = quote.mogrify(row_format, row).decode()
+                            file.write('%s %s;\n\n' % (insert_prefix, values))  # this is the text that will be put in the SQL file
+                finally:
+                    conn.rollback()
+                    conn.autocommit = True
 
     def deactivate_node(self, ip):
         query = '''UPDATE %s.Node
@@ -435,12 +1705,29 @@ WHERE schemaname != 'pg_catalog' AND
 class MeterDBBase():
     def __init__(self, options, logger=logging.getLogger()):
         self.lock = RLock()
-        self.lock_result=[]
+        self.ledger = LockLedger()
+        self.requests = set()   # queued by request_locks, cancelled on close
         self.logger = logger
         self.options = options
 
+    @property
+    def lock_result(self):
+        """ addresses of the nodes locked by this object """
+        return list(self.ledger)
+
+    def journal_locks(self, journal):
+        """ record the locks of this object in a LockJournal, clean_locks replays it after a crash """
+        spec = getattr(self, 'spec', None)
+        if spec and 'pgpswd=' in spec:
+            # never write a password to the journal, clean_locks then uses the default database
+            spec = None
+        self.ledger.attach(journal, spec)
+
     def close(self):
         with self.lock:
+            if getattr(self, 'requests', None):
+                super().cancel_requests()
+                self.requests = set()
             self.unlock_all()
         super().close()
 
@@ -457,48 +1744,195 @@ class MeterDBBase():
         super().activate_node(str(node))
 
     def unlock_all(self):
+        """ release every node locked by this object, one statement per lock owner """
         with self.lock:
-            for x in self.lock_result:
-                self.logger.warning("Unlocking node %s", x)
-                super().unlock_node(x)
-            self.lock_result = []
+            nodes = list(self.ledger)
+            if not nodes:
+                return
+            self.logger.warning("Unlocking nodes %s", ', '.join(nodes))
+            owners = {}
+            for node in nodes:
+                owners.setdefault(self._held_by(node), []).append(node)
+            try:
+                released = []
+                for owner, held in owners.items():
+                    released += super().unlock_nodes(held, owner=owner)
+            except Exception as e:
+                # still in the journal, clean_locks can free them
+                self.logger.error("Failed to unlock nodes %s: %s", nodes, e)
+                return
+            self.ledger.remove(nodes)
+            self.record_events('release', released)
 
     def free_nodes(self, nodes):
         with self.lock:
-            for x in nodes:
-                super().unlock_node(x)
+            self.record_events('release', super().unlock_nodes(nodes))
 
     def unlock_node(self, node):
         with self.lock:
-            for idx in range(len(self.lock_result)):
-                x = self.lock_result[idx]
-                if str(x) == str(node):
-                    super().unlock_node(str(node))
-                    del self.lock_result[idx]
-                    return
+            if node in self.ledger:
+                self._unlock_one(node)
+                return
             logging.warning("Tried to unlock %s there is no record of in the active context,  maybe it was already unlocked", str(node))
 
     def force_unlock_node(self, node):
         with self.lock:
-            for idx in range(len(self.lock_result)):
-                x = self.lock_result[idx]
-                if str(x) == str(node):
-                    super().unlock_node(str(node))
-                    del self.lock_result[idx]
-                    return
+            self._unlock_one(node, force=True)
+
+    def _unlock_one(self, node, force=False):
+        # the same statement as unlock_nodes, a broken connection is replaced by the pool
+        owner = None if force else self._held_by(node)
+        released = super().unlock_nodes([str(node)], force=force, owner=owner)
+        self.ledger.remove([node])
+        self.record_events('release', released)
+        if not released:
+            self._lost_lease(str(node), owner)
+
+    def _held_by(self, node):
+        """ lock owner of a tracked node when it is not this process, like one locked before fork() """
+        owner = self.ledger.owner(node)
+        return owner if owner and owner != self.owner else None
+
+    def renew_leases(self):
+        """ renew the leases of this process, a node whose lease was lost is no longer tracked """
+        with self.lock:
+            renewed = super().renew_leases()
+            if self.leases:
+                held = set(renewed)
+                lost = [node for node in self.ledger.owned(self.owner) if node not in held]
+                if lost:
+                    self.logger.warning("Lease lost on %s, another session took the meters over", ', '.join(lost))
+                    self.ledger.remove(lost)
+            return renewed
+
+    def get_meters(self, node_status='active', **filters):
+        """! meters of the platform, the rows are read only when the database changed
+
+        @param node_status  'active', 'inactive' or '%' for every meter
+        @param filters      column=value the meters must match, like peer_group='A'
+        @return list of MeterInstanceDB
+        """
+        return super().read_nodes(node_status, **filters)
 
-            super().unlock_node(str(node))
+    def get_meter_groups(self, column='peer_group', node_status='active', **filters):
+        """! meters grouped by the value of a column, like the peer groups of multi meter tests
 
-    def get_meters(self, node_status='active'):
-        return super().read_nodes(node_status)
+        @return dict of column value to list of MeterInstanceDB, in order of the value
+        """
+        return group_records(self.get_meters(node_status, **filters), column)
 
     def lock_node(self, node_instance, track=True):
+        """ lock a node, a tracked lock has a lease that is renewed until it is unlocked """
         with self.lock:
-            ok = super().lock_node(node_instance)
+            ok = super().lock_node(node_instance, lease=track)
             if ok and track:
-                self.lock_result.append(node_instance)
+                self.ledger.add([node_instance], self.owner)
+            self.record_events('grant' if ok else 'deny', node_ips([node_instance]))
             return ok
 
+    def lock_group(self, nodes, track=True):
+        """! lock every node or none of them
+
+        @return list of the node addresses locked
+        """
+        with self.lock:
+            locked = super().lock_group(nodes, lease=track)
+            if track:
+                self.ledger.add(locked, self.owner)
+            self.record_events('grant' if locked else 'deny', locked or node_ips(nodes))
+            return locked
+
+    def lock_any(self, n, nodes=None, track=True, **filters):
+        """! lock up to n free active meters
+
+        @param nodes    candidate meters or addresses, None for any meter of the platform
+        @param filters  column=value the meters must match
+        @return list of locked MeterInstanceDB
+        """
+        with self.lock:
+            locked = super().lock_any(n, nodes, lease=track, **filters)
+            for meter in locked:
+                meter.locked = True
+                if track:
+                    self.ledger.add([meter.ip_address], self.owner)
+            self.record_events('grant', node_ips(locked))
+            return locked
+
+    def lock_nodes(self, nodes, track=True):
+        """! lock each of the meters that is free
+
+        @return list of the node addresses locked
+        """
+        with self.lock:
+            locked = super().lock_nodes(nodes, lease=track)
+            if track:
+                self.ledger.add(locked, self.owner)
+            self.record_events('grant', locked)
+            self.record_events('deny', [ip for ip in node_ips(nodes) if ip not in locked])
+            return locked
+
+    def unlock_nodes(self, nodes, force=False, owner=None):
+        """! release meters together, they are no longer tracked even if one was not held
+
+        @param owner  release only the nodes held by this lock owner, like one from a journal
+
+        @return list of the node addresses released
+        """
+        ips = node_ips(nodes)
+        with self.lock:
+            released = super().unlock_nodes(ips, force=force, owner=owner)
+            self.ledger.remove(ips)
+            self.record_events('release', released)
+            return released
+
+    def request_locks(self, nodes, count=None, priority=0):
+        """! join the lock queue for some meters
+
+        @param nodes     candidate meters or addresses
+        @param count     meters wanted, None for all of them as one group
+        @param priority  higher is served first
+        @return request id for grant_locks(), None if the database has no lock queue
+        """
+        with self.lock:
+            request_id = super().request_locks(nodes, count, priority)
+            if request_id is not None:
+                self.requests.add(request_id)
+                self.record_events('request', node_ips(nodes), request_id)
+            return request_id
+
+    def cancel_request(self, request_id):
+        with self.lock:
+            self.requests.discard(request_id)
+            cancelled = super().cancel_request(request_id)
+            if cancelled:
+                self.record_events('cancel', request_id=request_id)
+            return cancelled
+
+    def grant_locks(self, request_id, track=True):
+        """! lock the meters the queue lets a request have now
+
+        @return list of the node addresses locked
+        """
+        with self.lock:
+            locked = super().grant_locks(request_id, lease=track)
+            if track:
+                self.ledger.add(locked, self.owner)
+            self.record_events('grant', locked, request_id)
+            return locked
+
+    def lock_stats(self, since, until=None, nodes=(), host=None, build=None, top=10):
+        """! lock utilisation, wait times and contention over a time window
+
+        @param since  window start, epoch seconds
+        @param until  window end, default now
+        @param nodes  meters reported even if they have no events
+        @param host   only the events of this host
+        @param build  only the events of this pipeline build
+        @return dict, see lock_stats()
+        """
+        until = time.time() if until is None else until
+        events = super().read_events(since - EVENT_LOOKBACK, until, host, build)
+        return lock_stats(events, since, until, nodes, top)
 
     def get_dbinfo(self):
         return DB_Dict
@@ -506,8 +1940,8 @@ class MeterDBBase():
     def execute_sql(self, query):
         return super().exec(query)
 
-    def dump(self, file=None):
-        return super().dump(file)
+    def dump(self, file=None, tables=None, copy=False):
+        return super().dump(file, tables, copy)
 
 class MeterDBpgre(MeterDBBase, db_pgre):
     def __init__(self, options, logger, *args, **kwargs):
@@ -525,6 +1959,7 @@ class MeterDB():
         self.lock_result=[]
         self.db = None
         self.logger = logger
+        spec = options
         options = options.split(',')
 
         # first item is server or file
@@ -550,17 +1985,105 @@ class MeterDB():
                 self.db_user = x[schema]['db_user']
                 self.db_pwd = x[schema]['db_pwd']
                 self.URI = source
-                return MeterDBpgre(options,logger,self.db_name,self.db_user,self.db_pwd,self.URI.split(':')[0],self.URI.split(':')[1], **filters)
+                mdb = MeterDBpgre(options,logger,self.db_name,self.db_user,self.db_pwd,self.URI.split(':')[0],self.URI.split(':')[1], **filters)
+                mdb.spec = spec
+                return mdb
             else:
-                return MeterDBsql(source, **filters)
+                mdb = MeterDBsql(source, **filters)
+                mdb.spec = spec
+                return mdb
         else:
             if source.startswith('file:'):
-                return MeterDBsql(source[5:], **filters)
+                mdb = MeterDBsql(options, logger, source[5:], **filters)
+                mdb.spec = spec
+                return mdb
             else:
                 src=source.split(':')
                 filters['pghost'] = src[0]
                 filters['pgport'] = src[1]
 
-                return MeterDBpgre(options, logger, **filters)
+                mdb = MeterDBpgre(options, logger, **filters)
+                mdb.spec = spec
+                return mdb
+
+        assert False # logic error if we get here
+
+_STRESS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS platform (platform_id INTEGER PRIMARY KEY, platform_name TEXT, project_name TEXT);
+CREATE TABLE IF NOT EXISTS Node (
+    node_ip TEXT PRIMARY KEY,
+    platform_id INTEGER,
+    node_status TEXT,
+    node_busy TEXT,
+    busy_change_count INTEGER DEFAULT 0,
+    peer_group TEXT
+);
+"""
 
-        assert False # logic error if we get here
\ No newline at end of file
+def _stress_worker(database, iterations, results):
+    locks = errors = 0
+    try:
+        for _ in range(iterations):
+            try:
+                for meter in database.lock_any(1, track=False):
+                    locks += 1
+                    database.force_unlock_node(meter.ip_address)
+            except sqlite3.Error as e:
+                errors += 1
+                logger.error("stress: %s", e)
+    finally:
+        results.put((locks, errors))
+
+def stress(db_file, procs=8, iterations=200, nodes=4):
+    """! fork processes that lock and unlock the meters of a sqlite database as fast as they can
+
+    The children use the database object of the parent, as the parallel
+    plugin does, so this also checks the connection handling after fork().
+
+    @return dict with locks, errors, seconds and locks per second
+    """
+    import multiprocessing
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.executescript(_STRESS_SCHEMA)
+        conn.execute("INSERT OR IGNORE INTO platform VALUES (1, 'stress', 'stress')")
+        conn.executemany("INSERT OR IGNORE INTO Node (node_ip, platform_id, node_status, node_busy) VALUES (?, 1, 'active', 'no')",
+                         [(f"10.99.0.{i}",) for i in range(nodes)])
+    conn.close()
+
+    database = MeterDBsql(None, logger, db_file, platform='stress', project='stress')
+    database.migrate()
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    start = time.time()
+    workers = [context.Process(target=_stress_worker, args=(database, iterations, results)) for _ in range(procs)]
+    [p.start() for p in workers]
+    totals = [results.get() for _ in workers]
+    [p.join() for p in workers]
+    seconds = time.time() - start
+
+    locks = sum(t[0] for t in totals)
+    changes = database.execute_sql("SELECT sum(busy_change_count) FROM Node WHERE platform_id = 1")[0][0]
+    busy = database.execute_sql("SELECT count(*) FROM Node WHERE node_busy = 'yes'")[0][0]
+    assert changes - busy == locks, f"{locks} locks counted, {changes} in the database"
+    database.close()
+    return {'locks': locks, 'errors': sum(t[1] for t in totals), 'seconds': seconds, 'rate': locks / seconds}
+
+def main():
+    import argparse
+    import tempfile
+    parser = argparse.ArgumentParser(description='stress the sqlite meter database with forked lockers')
+    parser.add_argument('--db', type=str, help='sqlite file, a new one in a temporary directory by default')
+    parser.add_argument('-p', '--procs', type=int, default=8, help='locking processes')
+    parser.add_argument('-n', '--iterations', type=int, default=200, help='lock attempts per process')
+    parser.add_argument('--nodes', type=int, default=4, help='meters in a new database')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = args.db if args.db else os.path.join(tmp, "stress.db")
+        result = stress(db_file, args.procs, args.iterations, args.nodes)
+    print("%(locks)s locks in %(seconds).1fs, %(rate).0f/s, %(errors)s errors" % result)
+
+if __name__ == '__main__':
+    main()
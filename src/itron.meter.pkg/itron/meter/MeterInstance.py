@@ -1,7 +1,11 @@
 
 import logging
+import time
 import abc
 
+# longest single wait on the database, a RemoteMeter wait holds a thread of the lock broker
+WAIT_SLICE = 20
+
 class MeterInstanceBase(abc.ABC):
     def __repr__(self):
         return f"{str(self.__class__.__name__)}({self.ip_address})"
@@ -58,3 +62,171 @@ class MeterInstanceDB(MeterInstanceBase):
         self.locked = False
         logging.getLogger().info("Meter %s unlocked", self.ip_address)
 
+
+
+def _shared_db(meters, method):
+    """ the database of the meters if they all come from one that has method, else None """
+    if not meters or len({id(getattr(m, 'parent_db', None)) for m in meters}) != 1:
+        return None
+    parent_db = getattr(meters[0], 'parent_db', None)
+    if parent_db is None or not hasattr(parent_db, method):
+        return None
+    return parent_db
+
+
+def lock_group(meters):
+    """! lock every meter of a group or none of them
+
+    Meters from one database are locked together with its lock_group(),
+    so a group is never left partly locked.  Other meters are locked one at
+    a time and released again if any of them fails.
+
+    @return True if every meter is now locked
+    """
+    assert not any(m.locked for m in meters)
+    parent_db = _shared_db(meters, 'lock_group')
+    if parent_db is not None:
+        locked = parent_db.lock_group(tuple(m.ip_address for m in meters))
+        if len(locked) != len({m.ip_address for m in meters}):
+            return False
+        for m in meters:
+            m.locked = True
+            logging.getLogger().info("Meter %s locked", m.ip_address)
+        return True
+
+    locks = [m for m in meters if m.lock()]
+    if len(locks) != len(meters):
+        for m in locks:
+            m.unlock()
+        return False
+    return True
+
+
+def lock_any(meters, n):
+    """! lock up to n of the free meters
+
+    Meters from one database are claimed with a single lock_any() call,
+    others are tried one at a time.
+
+    @return list of the meters now locked
+    """
+    meters = [m for m in meters if not m.locked]
+    if not meters or n < 1:
+        return []
+    parent_db = _shared_db(meters, 'lock_any')
+    if parent_db is not None:
+        locked = {str(m) for m in parent_db.lock_any(n, tuple(m.ip_address for m in meters))}
+        result = [m for m in meters if m.ip_address in locked]
+        for m in result:
+            m.locked = True
+            logging.getLogger().info("Meter %s locked", m.ip_address)
+        return result
+
+    result = []
+    for m in meters:
+        if len(result) >= n:
+            break
+        if m.lock():
+            result.append(m)
+    return result
+
+
+def unlock_seen(meters):
+    """ release count of the database of the meters, None if it does not publish releases """
+    parent_db = _shared_db(meters, 'unlock_seen')
+    return parent_db.unlock_seen() if parent_db is not None else None
+
+
+def wait_unlock(meters, seen, timeout):
+    """! wait until a meter of the database is released, or timeout
+
+    @param seen  unlock_seen() taken before the failed lock attempt, None to just sleep
+    @return True if woken by a release
+    """
+    parent_db = _shared_db(meters, 'wait_unlock')
+    if seen is None or parent_db is None:
+        time.sleep(timeout)
+        return False
+    end = time.time() + timeout
+    while time.time() < end:
+        if parent_db.wait_unlock(seen, min(end - time.time(), WAIT_SLICE)):
+            return True
+    return False
+
+
+class LockRequest:
+    """ a place in the database lock queue for some meters
+
+    Meters are granted in priority then FIFO order as they free up, and a
+    waiting group keeps the meters it needs so it is not starved by
+    requests for single meters.  Meters that do not share a database with
+    a lock queue are locked directly, in no particular order.
+
+    Usage:
+        request = LockRequest(meters, count=2)
+        while not request.done:
+            granted = request.poll()
+            ...
+        request.cancel()
+    """
+    def __init__(self, meters, count=None, priority=0):
+        """
+        @param meters    candidate meters
+        @param count     meters wanted, None for all of them as one group
+        @param priority  higher is served first
+        """
+        self.meters = [m for m in meters]
+        self.group = count is None
+        self.count = len(self.meters) if self.group else count
+        self.priority = priority
+        self.parent_db = _shared_db(self.meters, 'grant_locks')
+        self.request_id = None
+        self._enqueue()
+
+    def _enqueue(self):
+        if self.parent_db is not None and self.count > 0:
+            waiting = [m for m in self.meters if not m.locked]
+            self.request_id = self.parent_db.request_locks(tuple(m.ip_address for m in waiting),
+                                                           None if self.group else self.count, self.priority)
+
+    @property
+    def done(self):
+        return self.count <= 0
+
+    def poll(self):
+        """! lock what the queue grants now
+
+        @return list of the meters locked by this call
+        """
+        if self.done:
+            return []
+        waiting = [m for m in self.meters if not m.locked]
+        if self.request_id is None:
+            if self.group:
+                granted = waiting if lock_group(waiting) else []
+            else:
+                granted = lock_any(waiting, self.count)
+        else:
+            try:
+                ips = set(self.parent_db.grant_locks(self.request_id))
+            except ValueError as e:
+                # dropped from the queue, e.g. the heartbeat stalled past the lease
+                logging.getLogger().warning("%s, queueing again", e)
+                self._enqueue()
+                return []
+            granted = [m for m in waiting if m.ip_address in ips]
+            for m in granted:
+                m.locked = True
+                logging.getLogger().info("Meter %s locked", m.ip_address)
+        self.count -= len(granted)
+        if self.done:
+            # already out of the queue, this forgets it on the database object too
+            self.cancel()
+        return granted
+
+    def cancel(self):
+        """ leave the queue, meters already granted stay locked """
+        if self.request_id is not None:
+            self.parent_db.cancel_request(self.request_id)
+            self.request_id = None
+        self.count = 0
@@ -0,0 +1,123 @@
+"""
+Meter inventory
+
+The Node rows of a platform are read once and shared by every database
+object of the process that asks for the same platform:
+
+    inventory = get_inventory(('sqlite', db_file, plt_id))
+    records = inventory.refresh(db)
+    active = select(records, node_status='active', peer_group='A')
+
+A row is a MeterRecord, a tuple of values read by column name through the
+index that all rows of one load share.  The rows are read again only when
+the version the database reports changed, see db.inventory_version().
+Locking a meter does not change the version, so the lock columns of a
+record (node_busy, lock_owner, ...) are those of the last load.
+"""
+import os
+import re
+import threading
+from collections.abc import Mapping
+
+
+class MeterRecord(Mapping):
+    """ one Node row, read like the dict of upper case column name to value """
+    __slots__ = ('_columns', '_row')
+
+    def __init__(self, columns, row):
+        self._columns = columns
+        self._row = row
+
+    def __getitem__(self, name):
+        return self._row[self._columns[name]]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class MeterInventory:
+    """ cached Node rows of one platform """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.columns = {}
+        self.records = []
+        self.loads = 0
+
+    def refresh(self, db, force=False):
+        """! the rows, read again if the database changed since the last load
+
+        @param db     database with inventory_version() and inventory_rows()
+        @param force  read the rows even if the version did not change
+        @return list of MeterRecord
+        """
+        # the version is taken first, a change during the read only causes another load
+        version = db.inventory_version()
+        with self.lock:
+            if force or version is None or version != self.version or not self.loads:
+                names, rows = db.inventory_rows()
+                columns = {name.upper(): index for index, name in enumerate(names)}
+                self.records = [MeterRecord(columns, tuple(row)) for row in rows]
+                self.columns = columns
+                self.version = version
+                self.loads += 1
+            return self.records
+
+    def invalidate(self):
+        """ read the rows again on the next refresh """
+        with self.lock:
+            self.version = None
+
+
+def _match(value, wanted):
+    if isinstance(wanted, (list, tuple, set, frozenset)):
+        return any(_match(value, item) for item in wanted)
+    if isinstance(wanted, str) and '%' in wanted:
+        # LIKE pattern, node_status='%' is every meter
+        return re.fullmatch(re.escape(wanted).replace('%', '.*'), str(value), re.DOTALL) is not None
+    return value == wanted or (value is not None and str(value) == str(wanted))
+
+
+def select(records, **filters):
+    """! records matching every column=value filter
+
+    A value can be a list of accepted values or a LIKE pattern with %,
+    a filter of None is ignored.
+    """
+    filters = {column.upper(): wanted for column, wanted in filters.items() if wanted is not None}
+    return [record for record in records
+            if all(_match(record.get(column), wanted) for column, wanted in filters.items())]
+
+
+def group(items, column):
+    """ records, or meters by their info, by the value of a column, in order of the value """
+    groups = {}
+    for item in items:
+        groups.setdefault(getattr(item, 'info', item).get(column.upper()), []).append(item)
+    return dict(sorted(groups.items(), key=lambda item: '' if item[0] is None else str(item[0])))
+
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+def get_inventory(key):
+    """ the inventory shared by every database object in this process with the same key """
+    with _inventories_lock:
+        if key not in _inventories:
+            _inventories[key] = MeterInventory()
+        return _inventories[key]
+
+def _reset_after_fork():
+    # another thread may have held a lock when the process forked
+    global _inventories_lock
+    _inventories_lock = threading.Lock()
+    for inventory in _inventories.values():
+        inventory.lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,5 +1,273 @@
-from . import RemoteSSH
-from . import AsMan
-import tempfile
+"""
+Streaming tar rewrite for firmware packages
+
+A firmware package is a tarball of tarballs:
+
+    decrypted.tar.gz
+        <inner>.tar.gz (gz or xz compressed)
+            rootfs.tar.gz
+                usr/share/rohan/PreInstall/...
+
+Rather than extracting every layer to disk, changing a few files and
+re-compressing the directory trees, `rewrite_tar` copies the members of
+each layer straight through to the new tarball.  Members that are
+themselves a layer are rewritten recursively into a temporary spool (the
+tar header needs the final size), and the deepest layer has a `TarEdit`
+applied to it.  Each layer is decompressed and compressed exactly once,
+the compression is spread over all cores, and no layer is ever unpacked
+on disk.
+
+Members can be passed through a filter on the way (`permission_filter`),
+which is how modes and ownership are normalized.  The same filters work
+for `extract`, which unpacks a layer without repacking it first.
+
+Usage:
+    edit = TarEdit(PREINSTALL_DIR)
+    edit.add_zip(di_scripts)
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        rewrite_tar(fin, fout, edit, layers=PACKAGE_LAYERS, compression=('gz', 'xz', 'gz'),
+                    member_filter=normalize_permissions)
+"""
 import os
+import re
+import stat
+import time
+import tarfile
+import tempfile
+import logging
+import zipfile
+from . import compress
+
+logger = logging.getLogger(__name__)
+
+# the filter is applied by extract(), so don't let python 3.12+ apply its own
+_TRUSTED = 'fully_trusted' if hasattr(tarfile, 'fully_trusted_filter') else None
+
+PREINSTALL_DIR = 'usr/share/rohan/PreInstall'
+
+# regex for each nested layer in a firmware package, outermost first
+PACKAGE_LAYERS = (r'\.(tar\.gz|tar\.xz|xz)$', r'(^|/)rootfs\.tar\.gz$')
+
+
+def permission_filter(file_mode=stat.S_IRUSR | stat.S_IWUSR,
+                      dir_mode=stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR,
+                      owner=(0, 0, 'root', 'root')):
+    """! create a member filter that normalizes modes and ownership
+
+    The filter has the same signature as the python 3.12 tarfile
+    extraction filters, filter(tarinfo, path) -> tarinfo, so it can be used
+    for extraction and for rewriting.
+
+    @param file_mode   mode bits or'd into regular files
+    @param dir_mode    mode bits or'd into directories
+    @param owner       (uid, gid, uname, gname) for every member, None to keep the owner
+
+    @return filter function
+    """
+    def member_filter(tarinfo, path=None):
+        if tarinfo.isdir():
+            tarinfo.mode |= dir_mode
+        elif tarinfo.isreg():
+            tarinfo.mode |= file_mode
+        if owner:
+            tarinfo.uid, tarinfo.gid, tarinfo.uname, tarinfo.gname = owner
+        return tarinfo
+    return member_filter
+
+
+# u+rw for files, u+rwx for directories, owned by root
+normalize_permissions = permission_filter()
+
+
+def member_path(name):
+    """ normalize a tar member name ('./usr/x', '/usr/x' and 'usr/x' are the same file) """
+    while name.startswith('./'):
+        name = name[2:]
+    return name.strip('/')
+
+
+class TarEdit:
+    """ Replace the contents of a directory inside a tarball
+
+    Every member below `directory` is dropped and the members added with
+    `add_zip` are written in their place.  The directory entry itself is
+    kept, so its owner and mode are preserved.
+    """
+    def __init__(self, directory):
+        self.directory = member_path(directory)
+        self.prefix = None
+        self.sources = []
+        self.dropped = []
+        self.added = []
+        self.applied = False
+
+    def add_zip(self, zip_name, match=None, count=None):
+        """! add members of a zip file to the directory
+
+        @param zip_name   zip file to read
+        @param match      regex the member name must contain, None for all members
+        @param count      maximum number of members to take
+
+        @return number of members selected
+        """
+        with zipfile.ZipFile(zip_name) as z:
+            names = [zi.filename for zi in z.infolist() if not match or re.search(match, zi.filename)]
+        if count is not None:
+            names = names[:count]
+        self.sources.append((zip_name, names))
+        return len(names)
+
+    def drops(self, tarinfo):
+        """ True if the member is replaced by this edit """
+        path = member_path(tarinfo.name)
+        if path == self.directory:
+            # add new members with the same spelling as the archive uses ('./usr/...')
+            self.prefix = tarinfo.name.rstrip('/')
+            return False
+        if path.startswith(self.directory + '/'):
+            self.dropped.append(path)
+            return True
+        return False
+
+    def additions(self):
+        """ generate (TarInfo, fileobj) for each new member """
+        prefix = self.prefix if self.prefix else self.directory
+        for zip_name, names in self.sources:
+            with zipfile.ZipFile(zip_name) as z:
+                for name in names:
+                    zi = z.getinfo(name)
+                    info = tarfile.TarInfo(prefix + '/' + zi.filename.rstrip('/'))
+                    info.mtime = int(time_from_zip(zi))
+                    info.uname = info.gname = 'root'
+                    attr = (zi.external_attr >> 16) & 0o7777
+                    if zi.is_dir():
+                        info.type = tarfile.DIRTYPE
+                        info.mode = attr or 0o755
+                        yield info, None
+                    else:
+                        info.size = zi.file_size
+                        info.mode = attr or 0o644
+                        with z.open(zi) as fobj:
+                            yield info, fobj
+                    self.added.append(member_path(info.name))
+
+
+def time_from_zip(zi):
+    """ convert the zip date_time tuple to seconds since the epoch """
+    return time.mktime(zi.date_time + (0, 0, -1))
+
+
+def _open_layer(tin, layers):
+    """ find the nested layer in tin, returns the TarFile of the innermost layer or None """
+    for member in tin:
+        if member.isfile() and re.search(layers[0], member.name):
+            inner = tarfile.open(fileobj=tin.extractfile(member), mode='r|*')
+            if len(layers) == 1:
+                return inner
+            return _open_layer(inner, layers[1:])
+    return None
+
+
+def rewrite_tar(src, dst, edit=None, layers=(), compression=('gz',), member_filter=None):
+    """! copy tarball `src` to `dst` one member at a time, applying `edit`
+
+    @param src            readable file object of the source tarball (any compression)
+    @param dst            writable file object for the new tarball
+    @param edit           TarEdit applied to the innermost layer, None to copy it unchanged
+    @param layers         regex for the nested tarball to descend into at each level.
+                          The first member matching is rewritten, all others are copied.
+    @param compression    compression ('gz', 'xz' or '') for this layer followed by each
+                          nested layer.  Compression runs on all cores (rohan.meter.compress)
+    @param member_filter  filter(tarinfo) applied to members of the innermost layer,
+                          returning None drops the member
+
+    @return the edit, `edit.applied` is False if the layers were not found
+    """
+    with tarfile.open(fileobj=src, mode='r|*') as tin, \
+            compress.open_writer(dst, compression[0]) as zout, \
+            tarfile.open(fileobj=zout, mode='w|') as tout:
+        descended = False
+        for member in tin:
+            if layers and not descended and member.isfile() and re.search(layers[0], member.name):
+                descended = True
+                logger.info("rewriting layer %s", member.name)
+                with tempfile.TemporaryFile() as spool:
+                    inner = compression[1] if len(compression) > 1 else compression[0]
+                    rewrite_tar(tin.extractfile(member), spool, edit, layers[1:], (inner,) + tuple(compression[2:]),
+                                member_filter)
+                    member.size = spool.tell()
+                    spool.seek(0)
+                    tout.addfile(member, spool)
+            elif layers:
+                tout.addfile(member, tin.extractfile(member) if member.isreg() else None)
+            elif not edit or not edit.drops(member):
+                fobj = tin.extractfile(member) if member.isreg() else None
+                if member_filter:
+                    member = member_filter(member)
+                if member:
+                    tout.addfile(member, fobj)
+
+        if not layers and edit:
+            for info, fobj in edit.additions():
+                if member_filter:
+                    info = member_filter(info)
+                if info:
+                    tout.addfile(info, fobj)
+            edit.applied = True
+    return edit
+
+
+def extract(src, path, layers=(), match=None, member_filter=normalize_permissions):
+    """! stream the innermost layer of a tarball into a directory
+
+    Filtering is done member by member as they are extracted, so the
+    tarball does not have to be repacked to fix permissions first.
+
+    @param src            tarball file name or readable file object
+    @param path           directory to extract to
+    @param layers         regex for the nested tarball to descend into at each level
+    @param match          regex the member name must contain, None for all members
+    @param member_filter  filter(tarinfo, path) applied before extracting each member
+
+    @return list of member names extracted
+    """
+    return _walk_layer(src, layers, match, path, member_filter)
+
+
+def list_members(src, layers=(), match=None):
+    """! list the members of the innermost layer of a tarball without extracting
+
+    @param src     tarball file name or readable file object
+    @param layers  regex for the nested tarball to descend into at each level
+    @param match   regex the member name must contain, None for all members
+
+    @return list of member names
+    """
+    return _walk_layer(src, layers, match)
+
+
+def _walk_layer(src, layers, match, path=None, member_filter=None):
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, 'rb') as fobj:
+            return _walk_layer(fobj, layers, match, path, member_filter)
+
+    names = []
+    with tarfile.open(fileobj=src, mode='r|*') as tin:
+        layer = _open_layer(tin, layers) if layers else tin
+        if layer is None:
+            raise FileNotFoundError(f"layer {layers} not found")
+        for member in layer:
+            if match and not re.search(match, member.name):
+                continue
+            if path:
+                if member_filter:
+                    member = member_filter(member, path)
+                    if not member:
+                        continue
+                if _TRUSTED:
+                    layer.extract(member, path, filter=_TRUSTED)
+                else:
+                    layer.extract(member, path)
+            names.append(member.name)
+    return names
 
@@ -0,0 +1,156 @@
+"""
+Firmware version catalog
+
+Maps a firmware version (10.5.633.1) to its build directory, coldstart
+package and the DI AppServices / HAN agent versions inside it.  The catalog
+is a sqlite database, opened on first use, so importing FwMan costs nothing
+and a lookup reads one row.
+
+The database is ROHAN_VERSION_DB, or version_data.db in the host cache
+directory.  A version_data.json in the current directory (the old format)
+is imported the first time it is seen and again whenever it changes.
+
+Versions are also stored with a sort key where every field is zero padded,
+so prefix and range queries are index range scans in version order.
+
+Usage:
+    store = VersionStore()
+    if '10.5.633' in store:
+        coldstart = store['10.5.633']['coldstart']
+    for data in store.prefix('10.5'):
+        print(data['fw_version'], data.get('as_ver'))
+"""
+import os
+import json
+import sqlite3
+import logging
+from .utils import cache_dir
+
+logger = logging.getLogger(__name__)
+
+JSON_FILE = "version_data.json"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS version (
+    fw_version TEXT PRIMARY KEY,
+    sort_key TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS version_sort ON version (sort_key);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def sort_key(version):
+    """ key that sorts versions numerically, '10.5.63' -> '000010.000005.000063' """
+    return '.'.join(part.zfill(6) for part in version.split('.') if part)
+
+
+class VersionStore:
+    """ firmware version catalog, see module documentation """
+    def __init__(self, db_file=None, json_file=JSON_FILE):
+        """
+        @param db_file    sqlite database, default is ROHAN_VERSION_DB or the host cache
+        @param json_file  version_data.json to import when it changes, None to ignore
+        """
+        self.db_file = db_file
+        self.json_file = json_file
+        self.ready = False
+
+    def _connect(self):
+        if not self.ready:
+            if not self.db_file:
+                self.db_file = os.getenv("ROHAN_VERSION_DB") or os.path.join(cache_dir(), "version_data.db")
+            conn = sqlite3.connect(self.db_file, timeout=60)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                self._import_json(conn)
+            finally:
+                conn.close()
+            self.ready = True
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def _import_json(self, conn):
+        if not self.json_file or not os.path.exists(self.json_file):
+            return
+        stamp = f"{os.path.abspath(self.json_file)}:{os.stat(self.json_file).st_mtime_ns}"
+        row = conn.execute("SELECT value FROM meta WHERE name = 'json'").fetchone()
+        if row and row[0] == stamp:
+            return
+        logger.info("Importing %s", self.json_file)
+        with open(self.json_file, 'r') as f:
+            index = json.load(f)
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO version VALUES (?, ?, ?)",
+                             [(ver, sort_key(ver), json.dumps(data)) for ver, data in index.items()])
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('json', ?)", (stamp,))
+
+    def _query(self, query, args=()):
+        conn = self._connect()
+        try:
+            return conn.execute(query, args).fetchall()
+        finally:
+            conn.close()
+
+    def get(self, version, default=None):
+        """ catalog entry for an exact version """
+        rows = self._query("SELECT data FROM version WHERE fw_version = ?", (version,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def __getitem__(self, version):
+        data = self.get(version)
+        if data is None:
+            raise KeyError(version)
+        return data
+
+    def __contains__(self, version):
+        return bool(self._query("SELECT 1 FROM version WHERE fw_version = ?", (version,)))
+
+    def __len__(self):
+        return self._query("SELECT count(*) FROM version")[0][0]
+
+    def put(self, data):
+        """ add or replace an entry, data must have 'fw_version' """
+        version = data['fw_version']
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO version VALUES (?, ?, ?)",
+                             (version, sort_key(version), json.dumps(data)))
+        finally:
+            conn.close()
+
+    def range(self, low=None, high=None):
+        """! entries with low <= version < high, in version order
+
+        @param low   first version, None for no lower bound
+        @param high  version after the last, None for no upper bound
+        @return list of entries
+        """
+        query = "SELECT data FROM version WHERE sort_key >= ? AND sort_key < ? ORDER BY sort_key"
+        low = sort_key(low) if low else ''
+        high = sort_key(high) if high else '~'
+        return [json.loads(row[0]) for row in self._query(query, (low, high))]
+
+    def prefix(self, prefix):
+        """ entries for prefix and every version below it ('10.5' matches 10.5.633 but not 10.50), in version order """
+        key = sort_key(prefix)
+        query = "SELECT data FROM version WHERE sort_key >= ? AND sort_key < ? ORDER BY sort_key"
+        return [json.loads(row[0]) for row in self._query(query, (key, key + '/'))]
+
+    def latest(self, prefix=None):
+        """ newest entry, optionally below a version prefix, None if there is none """
+        entries = self.prefix(prefix) if prefix else self.range()
+        return entries[-1] if entries else None
+
+    def versions(self):
+        """ every version in the catalog, in version order """
+        return [row[0] for row in self._query("SELECT fw_version FROM version ORDER BY sort_key")]
+
+    def items(self):
+        for data in self.range():
+            yield data['fw_version'], data
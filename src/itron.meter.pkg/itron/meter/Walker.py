@@ -1,16 +1,301 @@
-from bs4 import BeautifulSoup
+"""
+Walk the OWI_Builds tree, from the mount point when it is present,
+otherwise from the web server.
+
+Web directory listings are fetched by a Crawler: one pooled HTTP session,
+a bounded number of listings fetched in parallel ahead of the caller, and
+glob patterns applied while descending so only matching directories are
+listed.  Results are returned in the same order as a sequential walk.
+
+Listings are kept in a ListingCache on disk, shared by every process on the
+host.  A listing younger than the TTL (WALKER_CACHE_TTL seconds) is used as
+is; an older one is revalidated with If-None-Match / If-Modified-Since, so an
+unchanged directory costs a 304.  Pass refresh=True to listdir(), glob() or
+walk(), or set WALKER_REFRESH=1, to fetch everything again.
+
+BuildTreeServer serves a synthetic build tree locally, so the crawler can
+be tested and benchmarked without the build server:
+
+    python -m rohan.meter.Walker --delay 0.05
+"""
 import requests
 import os
-from glob import glob as original_glob
 import re
+import html
+import json
+import time
+import zlib
+import sqlite3
+import weakref
+import argparse
+import threading
+from glob import glob as original_glob
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .utils import cache_dir
 
 OWI_URL = 'http://vm-rdgbuild-03.rohan.com/OWI_Builds/'
 OWI_MOUNT = '/mnt/ral-rdgbuild-03/'
 
+CRAWL_WORKERS = 8
+CACHE_TTL = int(os.getenv("WALKER_CACHE_TTL", 15 * 60))
+
+_HREF = re.compile(r'<a\s[^>]*?href\s*=\s*["\']([^"\']*)["\']', re.IGNORECASE)
+_GLOB_CHARS = set('*?[]()|+^$\\{}')
+
+
+def parse_links(page):
+    """ links in a directory listing page, without sort links (?C=N) and links out of the directory """
+    items = []
+    for ref in _HREF.findall(page):
+        ref = html.unescape(ref)
+        if ref and '?' not in ref and not ref.startswith('/') and not ref.startswith('..') and '://' not in ref:
+            items.append(ref)
+    return items
+
+
+def _level_regex(level):
+    return re.compile(level.replace('*', '.+'))
+
+
+class ListingCache:
+    """ directory listings on disk, keyed by url, with the validators to revalidate them """
+    def __init__(self, db_file=None, ttl=CACHE_TTL):
+        """
+        @param db_file  sqlite database, default is crawl.db in the host cache directory
+        @param ttl      seconds a listing is used without asking the server
+        """
+        self.db_file = db_file if db_file else os.path.join(cache_dir(), "crawl.db")
+        self.ttl = ttl
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS listing (url TEXT PRIMARY KEY, fetched REAL, "
+                         "etag TEXT, modified TEXT, dirs TEXT, files TEXT)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def _execute(self, query, args=()):
+        conn = self._connect()
+        try:
+            with conn:
+                return conn.execute(query, args).fetchall()
+        finally:
+            conn.close()
+
+    def get(self, url):
+        """ (fetched, etag, modified, dirs, files) or None """
+        rows = self._execute("SELECT fetched, etag, modified, dirs, files FROM listing WHERE url = ?", (url,))
+        if not rows:
+            return None
+        fetched, etag, modified, dirs, files = rows[0]
+        return fetched, etag, modified, json.loads(dirs), json.loads(files)
+
+    def fresh(self, entry):
+        return entry is not None and time.time() - entry[0] < self.ttl
+
+    def put(self, url, etag, modified, dirs, files):
+        self._execute("INSERT OR REPLACE INTO listing VALUES (?, ?, ?, ?, ?, ?)",
+                      (url, time.time(), etag, modified, json.dumps(dirs), json.dumps(files)))
+
+    def touch(self, url):
+        """ the server said the listing has not changed """
+        self._execute("UPDATE listing SET fetched = ? WHERE url = ?", (time.time(), url))
+
+    def clear(self):
+        self._execute("DELETE FROM listing")
+
+
+class Crawler:
+    """ fetch web directory listings with a pooled session and a thread pool
+
+    Usage:
+        crawler = Crawler()
+        dirs, files = crawler.list(OWI_URL)
+        for url in crawler.walk(OWI_URL + 'DI_Agents/', depth=2):
+            print(url)
+    """
+    def __init__(self, base_url=OWI_URL, workers=CRAWL_WORKERS, timeout=60, cache=None, refresh=False):
+        """
+        @param base_url  root of the tree that glob patterns are relative to
+        @param workers   listings fetched at the same time
+        @param timeout   seconds to wait for one listing
+        @param cache     ListingCache, None to always fetch
+        @param refresh   ignore cached listings (they are still updated)
+        """
+        self.base_url = base_url
+        self.cache = cache
+        self.refresh = refresh
+        self.workers = workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = weakref.WeakSet()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        # shutdown(cancel_futures=True) needs python 3.9
+        with self.lock:
+            pending = list(self.pending)
+        for future in pending:
+            future.cancel()
+        self.executor.shutdown()
+        self.session.close()
+
+    def list(self, url, refresh=False):
+        """! list a directory
+
+        @param refresh  fetch the listing even if it is cached
+        @return (dirs, files) as full urls, dirs end with '/'.  A missing directory is empty.
+        """
+        if not url.endswith('/'):
+            url += '/'
+        refresh = refresh or self.refresh
+        entry = self.cache.get(url) if self.cache else None
+        headers = {}
+        if entry and not refresh:
+            if self.cache.fresh(entry):
+                return entry[3], entry[4]
+            if entry[1]:
+                headers['If-None-Match'] = entry[1]
+            if entry[2]:
+                headers['If-Modified-Since'] = entry[2]
+
+        resp = self.session.get(url, headers=headers, timeout=self.timeout)
+        if resp.status_code == 304 and headers:
+            self.cache.touch(url)
+            return entry[3], entry[4]
+        if resp.status_code == 404:
+            dirs, files = [], []
+        else:
+            resp.raise_for_status()
+            items = parse_links(resp.text)
+            dirs = [url + item for item in items if item.endswith('/')]
+            files = [url + item for item in items if not item.endswith('/')]
+        if self.cache:
+            self.cache.put(url, resp.headers.get('ETag'), resp.headers.get('Last-Modified'), dirs, files)
+        return dirs, files
+
+    def stat(self, url):
+        """ (size, last modified) of a file from a HEAD request, None if it does not exist """
+        resp = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return int(resp.headers.get('Content-Length', -1)), resp.headers.get('Last-Modified')
+
+    def submit(self, url, refresh=False):
+        future = self.executor.submit(self.list, url, refresh)
+        with self.lock:
+            self.pending.add(future)
+        return future
+
+    def walk(self, url, depth=99, filter=lambda x: True, refresh=False):
+        """ yield files and directories under url, directories that fail filter are not entered """
+        yield from self._walk(self.submit(url, refresh), depth, filter, refresh)
+
+    def _walk(self, future, depth, filter, refresh=False):
+        dirs, files = future.result()
+        for file in files:
+            if filter(file):
+                yield file
+
+        depth -= 1
+        dirs = [dir for dir in dirs if filter(dir)]
+        # list the subdirectories ahead of the caller, in parallel
+        futures = [self.submit(dir, refresh) for dir in dirs] if depth else []
+        try:
+            for idx, dir in enumerate(dirs):
+                yield dir
+                if depth:
+                    yield from self._walk(futures[idx], depth, filter, refresh)
+        finally:
+            for f in futures:
+                f.cancel()
+
+    def glob(self, pattern, recurse=False, refresh=False):
+        """! glob against the tree
+
+        @param pattern  path relative to base_url, each level may contain '*'
+        @param recurse  also return everything below the matches
+        @param refresh  fetch listings even if they are cached
+        @return list of matching urls
+        """
+        levels = [x for x in pattern.split('/') if x]
+        if not levels:
+            return []
+        return list(self._glob(self.base_url, levels, 0, recurse, refresh))
+
+    def _glob(self, url, levels, idx, recurse, refresh, future=None):
+        last = idx == len(levels) - 1
+        # a plain name above the last level does not need the parent listing
+        if not last and not (_GLOB_CHARS & set(levels[idx])):
+            yield from self._glob(url + levels[idx] + '/', levels, idx + 1, recurse, refresh)
+            return
 
-def glob(path, recurse=False):
+        dirs, files = (future if future else self.submit(url, refresh)).result()
+        regex = _level_regex(levels[idx])
+        dirs = [dir for dir in dirs if regex.fullmatch(dir[:-1].rsplit('/', 1)[-1])]
+        if last:
+            for file in files:
+                if regex.fullmatch(file.rsplit('/', 1)[-1]):
+                    yield file
+
+        futures = [self.submit(dir, refresh) for dir in dirs] if not last or recurse else []
+        try:
+            for n, dir in enumerate(dirs):
+                if not last:
+                    yield from self._glob(dir, levels, idx + 1, recurse, refresh, futures[n])
+                    continue
+                yield dir
+                if recurse:
+                    yield from self._walk(futures[n], 999, lambda x: True, refresh)
+        finally:
+            for f in futures:
+                f.cancel()
+
+
+_crawler = None
+_crawler_lock = threading.Lock()
+
+
+def get_crawler():
+    """ the crawler shared by everything in this process """
+    global _crawler
+    with _crawler_lock:
+        if _crawler is None:
+            _crawler = Crawler(cache=ListingCache(), refresh=bool(os.getenv("WALKER_REFRESH")))
+        return _crawler
+
+
+def _reset_after_fork():
+    # the pool threads of the parent do not exist in a child and its sessions share the parent's sockets
+    global _crawler, _crawler_lock
+    _crawler = None
+    _crawler_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def glob(path, recurse=False, refresh=False):
     """ works like glob.glob() for URL if mount point
-        is not present """
+        is not present, refresh ignores cached listings """
     dirs = original_glob(path)
     if not dirs:
         if path.startswith(OWI_MOUNT):
@@ -20,72 +305,158 @@ def glob(path, recurse=False):
         else:
             dir = path
 
-        if dir.endswith('/'):
-            dir = dir[:-1]
-
-        matches = []
-        match_levels = [re.compile(x.replace('*','.+')) for x in dir.split('/')]
-
-        def splitup(path):
-            paths = path.replace(OWI_URL, '').split('/')
-            if paths[-1] == '':
-                del paths[-1]
-            return paths
-
-        def dirmatch(path):
-            paths = splitup(path)
-            for idx in range(len(paths)):
-                if idx < len(match_levels) and not match_levels[idx].fullmatch(paths[idx]):
-                    return False
-            return True
-
-        depth = len(dir.split('/')) if not recurse else 999
-        for item in walk_url(OWI_URL, depth=depth, filter=dirmatch):
-            matches.append(item)
-
-        dirs = [x for x in matches if len(splitup(x)) >= len(match_levels)]
+        dirs = get_crawler().glob(dir, recurse, refresh)
 
     return dirs
 
-def get_url_items(url):
-    if not url.endswith('/'):
-        url += '/'
-    page = requests.get(url).text
-    soup = BeautifulSoup(page, 'html.parser')
-    items = []
-    for node in soup.find_all('a'):
-        ref = node.get('href')
-        if ref and '?' not in ref and ref != '/':
-            items.append(ref)
-    dirs = [url + item for item in items if item.endswith('/')]
-    files = [url + item for item in items if not item.endswith('/')]
-    return dirs, files
+def get_url_items(url, refresh=False):
+    return get_crawler().list(url, refresh)
 
-def walk(path, depth=99, filter=lambda x: True):
+def walk(path, depth=99, filter=lambda x: True, refresh=False):
     if os.path.exists(path):
         yield from os.walk(path)
     else:
-        yield from walk_url(path, depth, filter)
+        yield from walk_url(path, depth, filter, refresh)
 
-def walk_url(path, depth, filter):
+def walk_url(path, depth, filter, refresh=False):
     path = path.replace(OWI_MOUNT, OWI_URL)
-    dirs, files = get_url_items(path)
-    for file in files:
-        if filter(file):
-            yield file
-
-    depth -= 1
-    for dir in dirs:
-        if filter(dir):
-            yield dir
-            if depth:
-                yield from walk_url(dir, depth, filter)
-
-def listdir(path):
+    yield from get_crawler().walk(path, depth, filter, refresh)
+
+def stat(path):
+    """ (size, modified) of a file on the mount or the web server, None if it does not exist """
+    if path.startswith('http://'):
+        return get_crawler().stat(path)
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return st.st_size, int(st.st_mtime)
+
+def listdir(path, refresh=False):
     if path.startswith('http://'):
-        dirs, files = get_url_items(path)
-        dirs.extend(files)
+        dirs, files = get_url_items(path, refresh)
+        dirs = dirs + files
         return [ os.path.basename(name[:-1])+'/' if name.endswith('/') else os.path.basename(name)
             for name in dirs]
     else:
         return os.listdir(path)
+
+
+def synthetic_tree(releases=8, builds=20):
+    """ build tree shaped like OWI_Builds: {name: subtree, or bytes for a file} """
+    tree = {}
+    for r in range(releases):
+        latest = {}
+        for b in range(builds):
+            version = f"10_5_{100 + b}_{r}"
+            dotted = version.replace('_', '.')
+            latest[f"FW_{version}/"] = {
+                "Distribution-Files/": {"Gen5RivaMeter-Dev/": {
+                    "ColdStartPackage/": {f"signed-SecureBoot_FW{dotted}.zip": f"coldstart {dotted}".encode()},
+                    "DowngradePackage/": {f"signed-Downgrade_FW{dotted}.zip": f"downgrade {dotted}".encode()},
+                    "UpgradeWithinSR_10-5/": {f"signed-Test_FWDL_d_SecureBoot_FW10.5.1.0-{dotted}.zip": b"diff"},
+                }},
+                "build.log": b"log",
+            }
+        tree[f"GEN5_RIVA_SR_10-{r}_REL/"] = {"Latest/": latest, "Archive/": {"old.zip": b"old"}}
+    tree["DI_Agents/"] = {f"Agent{n}/": {f"1.{n}.{v}/": {"Release/": {f"Agent{n}_1.{n}.{v}_TS.zip": b"agent"}}
+                                          for v in range(10)} for n in range(5)}
+    return tree
+
+
+class BuildTreeServer:
+    """ serve a tree of directories as Apache style listings
+
+    Listings carry an ETag and answer If-None-Match with 304.
+
+    Usage:
+        with BuildTreeServer(synthetic_tree(), delay=0.01) as server:
+            Crawler(server.url).glob('GEN5_RIVA_SR_10*/Latest')
+    """
+    def __init__(self, tree, delay=0.0, port=0):
+        """
+        @param tree   {name: subtree}, directory names end with '/', files map to their contents
+        @param delay  seconds added to every request, to model a remote server
+        """
+        self.requests = 0
+        self.not_modified = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+            def do_GET(self, head=False):
+                server.requests += 1
+                time.sleep(delay)
+                node = tree
+                for part in self.path.strip('/').split('/')[1:]:
+                    node = node.get(part + '/', node.get(part)) if isinstance(node, dict) else None
+                if isinstance(node, bytes):
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(len(node)))
+                    self.send_header('Last-Modified', 'Mon, 02 Jan 2023 00:00:00 GMT')
+                    self.end_headers()
+                    if not head:
+                        self.wfile.write(node)
+                    return
+                if not isinstance(node, dict):
+                    self.send_error(404)
+                    return
+                links = ''.join(f'<tr><td><a href="{name}">{name}</a></td></tr>\n' for name in node)
+                body = (f'<html><body><table><tr><th><a href="?C=N;O=D">Name</a></th></tr>\n'
+                        f'<tr><td><a href="/">Parent Directory</a></td></tr>\n{links}</table></body></html>').encode()
+                etag = '"%x"' % zlib.crc32(body)
+                if self.headers.get('If-None-Match') == etag:
+                    server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('localhost', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://localhost:{self.httpd.server_address[1]}/OWI_Builds/'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the crawler against a local synthetic build tree')
+    parser.add_argument('--delay', type=float, default=0.02, help='server latency per listing (seconds)')
+    parser.add_argument('--pattern', type=str, default='GEN5_RIVA_SR_10*/Latest/*', help='glob pattern')
+    args = parser.parse_args()
+
+    with BuildTreeServer(synthetic_tree(), delay=args.delay) as server:
+        for workers in (1, CRAWL_WORKERS):
+            with Crawler(server.url, workers=workers) as crawler:
+                server.requests = 0
+                start = time.time()
+                found = crawler.glob(args.pattern)
+                print(f"workers={workers}: {len(found)} matches, {server.requests} listings, {time.time() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
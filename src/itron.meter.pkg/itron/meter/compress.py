@@ -0,0 +1,254 @@
+"""
+Block parallel gzip and xz compression
+
+The input is split into blocks and each block is compressed on a thread
+pool (zlib and lzma release the GIL while compressing).  The output is a
+single standard stream, so it can be read by anything that reads gzip or
+xz, including tarfile in stream mode ('r|gz', 'r|xz') and the meter.
+
+    gzip:  one gzip member.  Each block is raw deflate primed with the last
+           32K of the previous block and ended with a sync flush, the same
+           way pigz does it, so the blocks join into one deflate stream.
+    xz:    one xz stream with one block per input block, CRC32 check.
+
+Usage:
+    with open_writer(open('out.tar.gz', 'wb'), 'gz') as out:
+        with tarfile.open(fileobj=out, mode='w|') as t:
+            t.add(...)
+"""
+import os
+import abc
+import lzma
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+GZ_BLOCK_SIZE = 1024 * 1024
+XZ_DICT_SIZE = 8 * 1024 * 1024
+XZ_BLOCK_SIZE = 3 * XZ_DICT_SIZE
+
+
+def default_threads():
+    """ number of compression threads, REPACK_THREADS overrides the cpu count """
+    threads = os.getenv("REPACK_THREADS")
+    return int(threads) if threads else (os.cpu_count() or 1)
+
+
+class ParallelWriter(abc.ABC):
+    """ write-only file object that compresses blocks on a thread pool
+
+    Derived classes implement header(), compress_block() and trailer().
+    Blocks are written to `fileobj` in order; at most 2 blocks per thread
+    are held in memory.
+    """
+    def __init__(self, fileobj, block_size, threads=None):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.threads = threads if threads else default_threads()
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.size = 0
+        self.closed = False
+        self.fileobj.write(self.header())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(bytes(self.buffer), last=True)
+            self.buffer = bytearray()
+            while self.pending:
+                self._write_oldest()
+            self.fileobj.write(self.trailer())
+        finally:
+            self.executor.shutdown()
+
+    def _submit(self, block, last):
+        future = self.submit_block(block, last)
+        if future:
+            self.pending.append(future)
+        while len(self.pending) > 2 * self.threads:
+            self._write_oldest()
+
+    def _write_oldest(self):
+        self.fileobj.write(self.pending.popleft().result())
+
+    def submit_block(self, block, last):
+        return self.executor.submit(self.compress_block, block, last)
+
+    @abc.abstractmethod
+    def header(self):
+        pass
+
+    @abc.abstractmethod
+    def compress_block(self, block, last):
+        pass
+
+    @abc.abstractmethod
+    def trailer(self):
+        pass
+
+
+class ParallelGzipWriter(ParallelWriter):
+    """ gzip compress to a single gzip member using all cores """
+    def __init__(self, fileobj, level=9, block_size=GZ_BLOCK_SIZE, threads=None):
+        self.level = level
+        self.crc = 0
+        self.dictionary = b''
+        super().__init__(fileobj, block_size, threads)
+
+    def header(self):
+        # magic, deflate, no flags, no mtime, xfl, unix
+        xfl = 2 if self.level == 9 else 4 if self.level == 1 else 0
+        return struct.pack('<BBBBLBB', 0x1f, 0x8b, 8, 0, 0, xfl, 3)
+
+    def submit_block(self, block, last):
+        # the running crc and the dictionary depend on the order of the data
+        self.crc = zlib.crc32(block, self.crc)
+        dictionary = self.dictionary
+        self.dictionary = (dictionary + block)[-32768:] if len(block) < 32768 else block[-32768:]
+        return self.executor.submit(self.compress_block, block, last, dictionary)
+
+    def compress_block(self, block, last, dictionary=None):
+        if dictionary:
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+        else:
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return c.compress(block) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def trailer(self):
+        return struct.pack('<LL', self.crc, self.size & 0xffffffff)
+
+
+def _varint(value):
+    """ xz multibyte integer """
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _pad4(length):
+    return b'\0' * (-length % 4)
+
+
+def _lzma2_dict_byte(dict_size):
+    """ encode the LZMA2 dictionary size property """
+    for bits in range(40):
+        if (2 | (bits & 1)) << (bits // 2 + 11) >= dict_size:
+            return bits
+    return 40
+
+
+class ParallelXzWriter(ParallelWriter):
+    """ xz compress to a single xz stream with one block per thread job """
+    CHECK_CRC32 = 1
+    STREAM_FLAGS = bytes([0, CHECK_CRC32])
+
+    def __init__(self, fileobj, preset=6, dict_size=XZ_DICT_SIZE, block_size=XZ_BLOCK_SIZE, threads=None):
+        self.filters = [{'id': lzma.FILTER_LZMA2, 'preset': preset, 'dict_size': dict_size}]
+        self.dict_byte = _lzma2_dict_byte(dict_size)
+        self.records = []
+        super().__init__(fileobj, block_size, threads)
+
+    def header(self):
+        return b'\xfd7zXZ\0' + self.STREAM_FLAGS + struct.pack('<L', zlib.crc32(self.STREAM_FLAGS))
+
+    def submit_block(self, block, last):
+        if not block:
+            return None
+        return super().submit_block(block, last)
+
+    def compress_block(self, block, last):
+        c = lzma.LZMACompressor(format=lzma.FORMAT_RAW, filters=self.filters)
+        data = c.compress(block) + c.flush()
+
+        # flags: one filter, compressed and uncompressed sizes present
+        header = bytearray(b'\0' + bytes([0xc0]) + _varint(len(data)) + _varint(len(block)))
+        header += bytes([0x21, 1, self.dict_byte])
+        header += _pad4(len(header) + 4)
+        header[0] = (len(header) + 4) // 4 - 1
+        header += struct.pack('<L', zlib.crc32(header))
+
+        record = (len(header) + len(data) + 4, len(block))
+        return bytes(header) + data + _pad4(len(data)) + struct.pack('<L', zlib.crc32(block)), record
+
+    def _write_oldest(self):
+        # the index must list the blocks in the order they are written
+        data, record = self.pending.popleft().result()
+        self.records.append(record)
+        self.fileobj.write(data)
+
+    def trailer(self):
+        index = bytearray(b'\0' + _varint(len(self.records)))
+        for unpadded, size in self.records:
+            index += _varint(unpadded) + _varint(size)
+        index += _pad4(len(index))
+        index += struct.pack('<L', zlib.crc32(index))
+
+        backward = struct.pack('<L', len(index) // 4 - 1) + self.STREAM_FLAGS
+        return bytes(index) + struct.pack('<L', zlib.crc32(backward)) + backward + b'YZ'
+
+
+class _Passthrough:
+    """ uncompressed output with the same interface as the parallel writers """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+    def close(self):
+        pass
+
+
+def open_writer(fileobj, compression, threads=None):
+    """! open a parallel compressing writer on `fileobj`
+
+    closing the writer finishes the stream, it does not close `fileobj`
+
+    @param fileobj      writable binary file object
+    @param compression  'gz', 'xz' or '' for no compression
+    @param threads      number of compression threads, default is the cpu count
+
+    @return file object to write uncompressed data to
+    """
+    if compression == 'gz':
+        return ParallelGzipWriter(fileobj, threads=threads)
+    if compression == 'xz':
+        return ParallelXzWriter(fileobj, threads=threads)
+    if not compression:
+        return _Passthrough(fileobj)
+    raise ValueError(f"unsupported compression {compression}")
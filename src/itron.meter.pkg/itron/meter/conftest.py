@@ -0,0 +1,42 @@
+import sqlite3
+import logging
+import pytest
+from rohan.meter.MeterDB import MeterDBsql
+
+SCHEMA = """
+CREATE TABLE platform (platform_id INTEGER PRIMARY KEY, platform_name TEXT, project_name TEXT);
+CREATE TABLE Node (
+    node_ip TEXT PRIMARY KEY,
+    platform_id INTEGER,
+    node_status TEXT,
+    node_busy TEXT,
+    busy_change_count INTEGER DEFAULT 0,
+    peer_group TEXT
+);
+INSERT INTO platform VALUES (1, 'gen5', 'riva');
+"""
+
+
+def _create(db_file):
+    conn = sqlite3.connect(db_file)
+    conn.executescript(SCHEMA)
+    with conn:
+        for i in range(6):
+            conn.execute("INSERT INTO Node (node_ip, platform_id, node_status, node_busy, peer_group) VALUES (?, 1, 'active', 'no', ?)",
+                         (f"10.0.0.{i}", f"group{i // 3}"))
+    conn.close()
+    return MeterDBsql(db_file, logging.getLogger(), db_file, platform='gen5', project='riva')
+
+
+@pytest.fixture
+def new_meter_db(tmp_path):
+    """ sqlite meter database with six meters, before mdb migrate """
+    mdb = _create(str(tmp_path / "meters.db"))
+    yield mdb
+    mdb.close()
+
+
+@pytest.fixture
+def meter_db(new_meter_db):
+    new_meter_db.migrate()
+    return new_meter_db
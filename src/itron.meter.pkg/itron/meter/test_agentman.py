@@ -0,0 +1,53 @@
+import os
+import pytest
+
+from rohan.meter import Walker
+from rohan.meter.AgentMan import AgentMan, AgentCatalog, AgentInfo, rohan_CONTAINER_ID
+from rohan.meter.Walker import BuildTreeServer, synthetic_tree
+
+
+@pytest.fixture
+def agentman(tmp_path, monkeypatch):
+    with BuildTreeServer(synthetic_tree(releases=1, builds=1)) as server, Walker.Crawler(server.url) as crawler:
+        monkeypatch.setattr(Walker, '_crawler', crawler)
+        yield AgentMan(AgentCatalog(os.path.join(tmp_path, 'agents.db'))), server
+
+
+def test_install_plan(agentman):
+    mgr, server = agentman
+    lib = AgentInfo('Agent0', '1.0.2', rohan_CONTAINER_ID, None, has_daemon=False)
+    app = AgentInfo('Agent1', None, rohan_CONTAINER_ID, None, depends_on=[lib])
+
+    plan = mgr.install_plan([app, ('Agent2', '1.2.5'), 'Agent0'])
+    assert [(a.name, a.version) for a in plan] == [('Agent0', '1.0.2'), ('Agent1', '1.1.9'), ('Agent2', '1.2.5')]
+    assert plan[2].url.endswith('DI_Agents/Agent2/1.2.5/Release/Agent2_1.2.5_TS.zip')
+    # the plan is built from copies, the agents passed in are unchanged
+    assert app.url is None and app.version is None and lib.url is None
+    assert plan[1].depends_on == [plan[0]] and app.depends_on == [lib]
+
+    # served from the catalog
+    requests = server.requests
+    assert mgr.get_versions('Agent1')[-1].endswith('DI_Agents/Agent1/1.1.9/')
+    assert server.requests == requests
+
+
+def test_install_plan_conflicts(agentman):
+    mgr, _ = agentman
+    with pytest.raises(ValueError):
+        mgr.install_plan([('Agent0', '1.0.1'), ('Agent0', '1.0.2')])
+
+    a = AgentInfo('Agent0', '1.0.1', rohan_CONTAINER_ID, None)
+    b = AgentInfo('Agent1', '1.1.1', rohan_CONTAINER_ID, None, depends_on=[a])
+    a.depends_on = [b]
+    with pytest.raises(ValueError):
+        mgr.install_plan([a])
+
+
+def test_latest_version(tmp_path, monkeypatch):
+    tree = synthetic_tree(releases=1, builds=1)
+    tree['DI_Agents/']['Agent1/']['1.1.10/'] = {"Release/": {"Agent1_1.1.10_TS.zip": b"agent"}}
+    with BuildTreeServer(tree) as server, Walker.Crawler(server.url) as crawler:
+        monkeypatch.setattr(Walker, '_crawler', crawler)
+        mgr = AgentMan(AgentCatalog(os.path.join(tmp_path, 'agents.db')))
+        assert mgr.catalog.versions('Agent1')[-2:] == ['1.1.9', '1.1.10']
+        assert mgr.install_plan(['Agent1'])[0].version == '1.1.10'
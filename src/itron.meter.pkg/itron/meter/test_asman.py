@@ -1,4 +1,5 @@
 import pytest
+import os
 
 from rohan.meter import AsMan
 import re
@@ -8,4 +9,28 @@ def test_asman():
     assert bld
     assert re.search(".zip$", bld)
     bld=AsMan.get_build('1.3.470.0')
-    assert bld
\ No newline at end of file
+    assert bld
+
+
+def test_asindex(tmp_path):
+    latest = os.path.join(tmp_path, 'Latest')
+
+    def add(entry, version, kind):
+        path = os.path.join(latest, entry, AsMan.SUFFIX[kind])
+        os.makedirs(path)
+        open(os.path.join(path, f'DI-AppServices-Package-{version}_TS.zip'), 'w').close()
+
+    add('2023_01_01', '1.5.317.0', 'debug')
+    add('2023_01_01', '1.5.317.0', 'release')
+    add('2023_01_02', '1.5.318.0', 'debug')
+
+    index = AsMan.AsIndex(latest, os.path.join(tmp_path, 'asman.db'))
+    assert index.update() == 2
+    assert index.find('1.5.31', release=False).endswith('Package-1.5.318.0_TS.zip')
+    assert 'TargetRelease' in index.find('1.5.317', release=True)
+    assert index.find('1.5.318', release=True) is None
+
+    # the incomplete recent directory is scanned again, the complete one is not
+    add('2023_01_03', '1.5.319.0', 'debug')
+    assert index.update() == 2
+    assert index.find('1.5.319').endswith('Package-1.5.319.0_TS.zip')
@@ -0,0 +1,46 @@
+import io
+import os
+import gzip
+import lzma
+import tarfile
+
+import pytest
+
+from rohan.meter import compress
+
+
+@pytest.mark.parametrize("compression", ['gz', 'xz'])
+def test_roundtrip_multiple_blocks(compression):
+    data = os.urandom(200000) + b'rohan meter ' * 100000
+    out = io.BytesIO()
+    with compress.open_writer(out, compression, threads=4) as w:
+        w.block_size = 65536
+        for i in range(0, len(data), 10000):
+            w.write(data[i:i + 10000])
+
+    raw = out.getvalue()
+    assert (gzip.decompress(raw) if compression == 'gz' else lzma.decompress(raw)) == data
+
+
+@pytest.mark.parametrize("compression", ['gz', 'xz'])
+def test_tarfile_stream_reads_output(compression):
+    out = io.BytesIO()
+    with compress.open_writer(out, compression, threads=2) as w:
+        with tarfile.open(fileobj=w, mode='w|') as t:
+            for n in range(3):
+                payload = os.urandom(50000)
+                info = tarfile.TarInfo(f'file{n}')
+                info.size = len(payload)
+                t.addfile(info, io.BytesIO(payload))
+
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode='r|' + compression) as t:
+        assert [m.name for m in t] == ['file0', 'file1', 'file2']
+
+
+def test_empty_output():
+    for compression in ('gz', 'xz'):
+        out = io.BytesIO()
+        compress.open_writer(out, compression).close()
+        raw = out.getvalue()
+        assert (gzip.decompress(raw) if compression == 'gz' else lzma.decompress(raw)) == b''
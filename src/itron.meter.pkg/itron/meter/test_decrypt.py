@@ -0,0 +1,69 @@
+import os
+
+from rohan.meter.DecryptClient import DecryptClient, DecryptStore, StandInServer
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_decrypt_streams_and_caches(tmp_path):
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    src = _write(os.path.join(tmp_path, 'package.tar.gz'), data)
+    cache = os.path.join(tmp_path, 'cache')
+
+    with StandInServer() as server, DecryptClient(server.url, cache=cache) as client:
+        target = os.path.join(tmp_path, 'decrypted.tar.gz')
+        assert client.decrypt(src, target) == target
+        with open(target, 'rb') as f:
+            assert f.read() == data
+
+        # same content under another name is served from the cache
+        copy = _write(os.path.join(tmp_path, 'copy.tar.gz'), data)
+        client.decrypt(copy, os.path.join(tmp_path, 'again.tar.gz'))
+        assert server.requests == 1
+        assert not [f for _, _, files in os.walk(cache) for f in files if f.endswith('.part')]
+
+
+def test_decrypt_many(tmp_path):
+    jobs = []
+    for i in range(4):
+        src = _write(os.path.join(tmp_path, f'p{i}.tar.gz'), bytes([i]) * (100000 + i))
+        jobs.append((src, src + '.decrypted'))
+    jobs.append(jobs[0])
+
+    with StandInServer(delay=0.1) as server, DecryptClient(server.url, cache=None, workers=4) as client:
+        assert client.decrypt_many(jobs) == [target for _, target in jobs]
+        for i, (_, target) in enumerate(jobs[:4]):
+            with open(target, 'rb') as f:
+                assert f.read() == bytes([i]) * (100000 + i)
+
+
+def test_decrypt_shares_upload(tmp_path):
+    data = os.urandom(100000)
+    jobs = [(_write(os.path.join(tmp_path, f'p{i}.tar.gz'), data), os.path.join(tmp_path, f'p{i}.decrypted')) for i in range(3)]
+
+    # without a cache the callers waiting on the first upload copy its result
+    with StandInServer(delay=0.5) as server, DecryptClient(server.url, cache=None, workers=3) as client:
+        assert client.decrypt_many(jobs) == [target for _, target in jobs]
+        assert server.requests == 1
+        assert client.inflight.inflight == {}
+        for _, target in jobs:
+            with open(target, 'rb') as f:
+                assert f.read() == data
+
+
+def test_store_key_class(tmp_path):
+    store = DecryptStore(os.path.join(tmp_path, 'store'))
+    src = _write(os.path.join(tmp_path, 'decrypted'), b'payload')
+    target = os.path.join(tmp_path, 'out')
+
+    assert store.get('ab' * 32, 'meter-1', target) is None
+    store.put(src, 'ab' * 32, 'meter-1')
+    assert store.has('ab' * 32, 'meter-1')
+    assert not store.has('ab' * 32, 'meter-2')
+    assert store.get('ab' * 32, 'meter-1', target) == target
+    with open(target, 'rb') as f:
+        assert f.read() == b'payload'
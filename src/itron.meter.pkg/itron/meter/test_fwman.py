@@ -3,6 +3,12 @@ import os
 
 from rohan.meter import FwMan
 from rohan.meter.FwMan import get_build_path
+from rohan.meter.Manifest import preinstall_versions
+from rohan.meter.VersionStore import VersionStore
+from rohan.meter.BuildCatalog import BuildIndexer
+from rohan.meter.Walker import BuildTreeServer, synthetic_tree
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import re
 import json
 import glob
@@ -18,101 +24,53 @@ def test_fwdir():
     fw_image = os.path.join(coldpath, coldfile)
     logger.info(f"getting preinstall")
     files = FwMan.get_preinstall(fw_image)
-    data = {}
     logger.info(f"finding files")
-    for file in files:
-        if re.search('DI-AppServices', file):
-            as_ver = re.search("Package-([0123456789.]+)",file)[1]
-            if as_ver.endswith('.'):
-                as_ver = as_ver[:-1]
-            data['as_ver'] = as_ver
-
-        if re.search('HANAgent', file):
-            data['han_ver'] = re.search("HANAgent_([0123456789.]+)",file)[1]
+    data = preinstall_versions(files)
     assert data['as_ver'] == "1.7.327.0"
 
-#@pytest.mark.not_normal
-def test_make_fw_dict():
-    index = {}
-    if os.path.exists("version_data.json"):
-        logger.info(f"Using version_data.json")
-        with open("version_data.json", 'r') as f:
-            index = json.load(f)
-    rfs = 'Distribution-Files/Gen5RivaMeter-Dev/images-signed/rfs/rootfs.tar.gz'
-    coldstart_dir = 'Distribution-Files/Gen5RivaMeter-Dev/ColdStartPackage'
-    my_build_path = get_build_path().copy()
-    #my_build_path.sort(reverse=True)
-    #my_build_path = []
-    #my_build_path.extend(glob.glob("/mnt/ral-rdgbuild-03/GEN5_RIVA_SR_10-5_REL_3_1/Latest"))
-    #my_build_path.extend(glob.glob("/mnt/ral-rdgbuild-03/GEN5_RIVA_SR_10-5_REL_3_1_EARLY/Latest"))
-    #my_build_path.extend(glob.glob("/mnt/ral-rdgbuild-03/GEN5_RIVA_SR_10-8_REL_3_1_1/Latest"))
-    #my_build_path.extend(glob.glob("/mnt/ral-rdgbuild-03/GEN5_RIVA_SR_10-8_REL_3_1_1_ALPHA1/Latest"))
-
-    for path in my_build_path:
-        try:
-            logger.info(f"Trying directory {path}")
-            dirs = Walker.listdir(path)
-            dirs.sort(reverse=True)
-
-            for build in dirs:
-                if not build.startswith(path):
-                    cwd = os.path.join(path, build)
-                else:
-                    cwd = build
-                coldpath = os.path.join(cwd, coldstart_dir)
-                cold_dir = Walker.listdir(coldpath)
-                if cold_dir:
-                    r = re.compile(".*zip")
-                    newlist = list(filter(r.match, cold_dir)) # Read Note below
-                    if len(newlist) > 1:
-                        continue
-                    elif len(newlist) < 1:
-                        continue
-                    else:
-                        coldstart_file = os.path.join(coldpath, newlist[0])
-
-                    fw_ver = re.search("FW_(10[0123456789_]+)",build)
-                    if fw_ver:
-                        fw_ver = fw_ver[1]
-                    else:
-                        continue
-                    fw_ver = fw_ver.replace('_','.')
-
-                    if fw_ver not in index:
-                        logger.info("Adding %s to index", fw_ver)
-                        files = FwMan.get_preinstall(coldstart_file)
-                        data = {
-                            'fw_version': fw_ver,
-                            'fw_path': cwd,
-                            'coldstart': coldstart_file
-                        }
-                        for file in files:
-                            if re.search('DI-AppServices', file):
-                                as_ver = re.search("Package-([0123456789.]+)",file)[1]
-                                if as_ver.endswith('.'):
-                                    as_ver = as_ver[:-1]
-                                logger.info("%s has AS version %s", fw_ver,as_ver)
-                                data['as_ver'] = as_ver
-
-                            if re.search('HANAgent', file):
-                                data['han_ver'] = re.search("HANAgent_([0123456789.]+)",file)[1]
-
-                        index[fw_ver] = data
-                        with open('version_data.json',"w") as f:
-                            json.dump(index, f, indent=4)
-                    else:
-                        logger.info("%s is already in index", fw_ver)
-
-
-        except FileNotFoundError:
-            logger.info(f"empty {path}")
-            pass
+def test_build_catalog(tmp_path, monkeypatch):
+    tree = synthetic_tree(releases=2, builds=3)
+    with BuildTreeServer(tree) as server, Walker.Crawler(server.url) as crawler:
+        monkeypatch.setattr(Walker, '_crawler', crawler)
+        store = VersionStore(os.path.join(tmp_path, 'version_data.db'), None)
+        monkeypatch.setattr(FwMan, 'version_tree', store)
+        paths = [server.url + 'GEN5_RIVA_SR_10-0_REL/Latest/', server.url + 'GEN5_RIVA_SR_10-1_REL/Latest/']
+
+        indexer = BuildIndexer(store, jobs=4, agents=False)
+        assert set(indexer.run(paths).values()) == {'added'}
+        assert len(store) == 6
+
+        info = FwMan.get_build_ex('10.5.101.1')
+        assert info['ColdStartPackage'].endswith('signed-SecureBoot_FW10.5.101.1.zip')
+        assert info['UpgradeWithinSR_10-5'].endswith('-10.5.101.1.zip')
+        package = store['10.5.101.1']['packages']['DowngradePackage']
+        assert package['size'] == len(b'downgrade 10.5.101.1')
+        assert package['sha256'] == hashlib.sha256(b'downgrade 10.5.101.1').hexdigest()
+
+        # only the rebuilt build is indexed again
+        build = tree['GEN5_RIVA_SR_10-0_REL/']['Latest/']['FW_10_5_100_0/']
+        build['Distribution-Files/']['Gen5RivaMeter-Dev/']['ColdStartPackage/'] = {'signed-SecureBoot_FW10.5.100.0.zip': b'rebuilt'}
+        results = indexer.run(paths)
+        assert results.pop('10.5.100.0') == 'updated'
+        assert set(results.values()) == {'unchanged'}
+
+def test_build_ex_parallel_and_coalesced(tmp_path, monkeypatch):
+    with BuildTreeServer(synthetic_tree(releases=1, builds=2), delay=0.2) as server, Walker.Crawler(server.url) as crawler:
+        monkeypatch.setattr(Walker, '_crawler', crawler)
+        monkeypatch.setattr(FwMan, 'version_tree', VersionStore(os.path.join(tmp_path, 'version_data.db'), None))
+        distro = server.url + 'GEN5_RIVA_SR_10-0_REL/Latest/FW_10_5_101_0/Distribution-Files/Gen5RivaMeter-Dev/'
+        monkeypatch.setattr(FwMan, 'get_build', lambda version: (distro + 'ColdStartPackage/',
+                                                                 'signed-SecureBoot_FW10.5.101.0.zip', None, None))
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(FwMan.get_build_ex, ['10.5.101.0'] * 4))
+        assert all(info == results[0] for info in results)
+        assert results[0]['DowngradePackage'] == distro + 'DowngradePackage/signed-Downgrade_FW10.5.101.0.zip'
+        # distro listing plus the three package listings, once for all callers
+        assert server.requests == 4
 
 def test_make_fw_csv():
-    index = {}
-    if os.path.exists("version_data.json"):
-        with open("version_data.json", 'r') as f:
-            index = json.load(f)
+    index = FwMan.version_tree
 
     csv_columns = ['fw_version','as_ver','han_ver','fw_path','coldstart']
     dict_data = []
@@ -122,13 +80,29 @@ def test_make_fw_csv():
     csv_file = "version_data.csv"
     try:
         with open(csv_file, 'w') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
+            writer = csv.DictWriter(csvfile, fieldnames=csv_columns, extrasaction='ignore')
             writer.writeheader()
             for data in dict_data:
                 writer.writerow(data)
     except IOError:
         print("I/O error")
 
+def test_version_store(tmp_path):
+    json_file = os.path.join(tmp_path, 'version_data.json')
+    with open(json_file, 'w') as f:
+        json.dump({v: {'fw_version': v, 'coldstart': f'/builds/{v}/cold.zip'}
+                   for v in ['10.5.633', '10.5.63.1', '10.50.1', '10.4.9']}, f)
+
+    store = VersionStore(os.path.join(tmp_path, 'version_data.db'), json_file)
+    assert '10.5.633' in store and '10.5.6' not in store
+    assert store['10.5.633']['coldstart'] == '/builds/10.5.633/cold.zip'
+    assert [d['fw_version'] for d in store.prefix('10.5')] == ['10.5.63.1', '10.5.633']
+    assert [d['fw_version'] for d in store.range('10.4', '10.6')] == ['10.4.9', '10.5.63.1', '10.5.633']
+    assert store.latest()['fw_version'] == '10.50.1'
+
+    store.put({'fw_version': '10.5.700'})
+    assert VersionStore(store.db_file, json_file).latest('10.5')['fw_version'] == '10.5.700'
+
 def test_connection():
     from kaizenbot.kbotdbclient_psql import _KBotDBClient_psql
 
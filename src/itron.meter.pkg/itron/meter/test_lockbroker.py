@@ -0,0 +1,73 @@
+import os
+import threading
+import pytest
+from rohan.meter.MeterInstance import MeterInstanceDB, lock_group
+from rohan.meter.LockBroker import LockBroker, LockBrokerClient
+from rohan.meter.LockLedger import LockJournal
+
+
+@pytest.fixture
+def broker(meter_db, tmp_path):
+    journal = LockJournal(str(tmp_path / "locks.journal"))
+    meter_db.journal_locks(journal)
+    with LockBroker(meter_db) as broker:
+        broker.journal = journal
+        yield broker
+    journal.close()
+
+
+def test_lock_unlock(broker, meter_db):
+    client = LockBrokerClient(broker.path)
+    meters = [MeterInstanceDB(m.info, client) for m in meter_db.get_meters()]
+    assert meters[0].lock()
+    assert not client.lock_node('10.0.0.0')
+    assert lock_group(meters[3:])
+    assert meter_db.execute_sql("SELECT count(*) FROM Node WHERE node_busy = 'yes'") == [(4,)]
+    assert LockJournal.held(broker.journal.filename) == [(None, meter_db.owner, ['10.0.0.0', '10.0.0.3', '10.0.0.4', '10.0.0.5'])]
+
+    meters[0].unlock()
+    with pytest.raises(ValueError):
+        client.unlock_node('10.0.0.0')
+    for m in meters[3:]:
+        m.unlock()
+    assert LockJournal.held(broker.journal.filename) == []
+    assert meter_db.lock_result == []
+    client.close()
+
+
+def test_batching(broker, meter_db, monkeypatch):
+    batches = []
+    lock_nodes = meter_db.lock_nodes
+
+    def record(nodes, **kwargs):
+        batches.append(len(nodes))
+        return lock_nodes(nodes, **kwargs)
+    monkeypatch.setattr(meter_db, 'lock_nodes', record)
+
+    client = LockBrokerClient(broker.path)
+    results = {}
+    start = threading.Barrier(24)
+
+    def worker(i):
+        start.wait()
+        results[i] = client.lock_node(f"10.0.0.{i % 6}")
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(24)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    # every node is granted to exactly one caller, in fewer statements than requests
+    assert sum(results.values()) == 6
+    assert sum(batches) == 24 and len(batches) < 24
+    client.close()
+
+
+def test_forked_worker(broker, meter_db):
+    pid = os.fork()
+    if pid == 0:
+        client = LockBrokerClient(broker.path)
+        ok = client.lock_node('10.0.0.1') and client.unlock_seen() is not None
+        client.close()
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert meter_db.execute_sql("SELECT node_busy FROM Node WHERE node_ip = '10.0.0.1'") == [('yes',)]
@@ -0,0 +1,53 @@
+import io
+import hashlib
+import os
+import tarfile
+import zipfile
+
+from rohan.meter import Manifest
+
+
+def _tar_bytes(members, compression):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:' + compression) as t:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            t.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def test_index_and_query(tmp_path):
+    rootfs = _tar_bytes({
+        './usr/share/rohan/PreInstall/DI-AppServices-Package-1.7.327.0_TS.tar.gz': b'di',
+        './usr/share/rohan/PreInstall/HANAgent_1.4.17.51365124_TS.tar.gz': b'han',
+        './etc/hostname': b'meter',
+    }, 'gz')
+    inner = _tar_bytes({'rootfs.tar.gz': rootfs}, 'xz')
+    decrypted = os.path.join(tmp_path, 'decrypted.tar.gz')
+    with open(decrypted, 'wb') as f:
+        f.write(_tar_bytes({'image.tar.xz': inner}, 'gz'))
+
+    package = os.path.join(tmp_path, 'signed-Test_FWDL_ColdStart_SecureBoot_FW10.5.633.1.Asic.zip')
+    with zipfile.ZipFile(package, 'w') as z:
+        z.writestr('Test_FWDL_ColdStart.tar.gz', b'encrypted')
+        z.writestr('signature', b'sig')
+
+    manifest = Manifest.PackageManifest(os.path.join(tmp_path, 'manifest.db'))
+    sha = Manifest.sha256_file(package)
+    assert not manifest.has(sha)
+    assert manifest.lookup(package) is None
+
+    manifest.index(sha, package, decrypted, fw_package=package)
+
+    assert manifest.lookup(package) == sha
+    assert manifest.packages('10.5.633.1') == [sha]
+    assert manifest.versions(sha) == {'as_ver': '1.7.327.0', 'han_ver': '1.4.17.51365124'}
+    assert len(manifest.preinstall(sha)) == 2
+
+    layers = {m.layer for m in manifest.members(sha)}
+    assert layers == {'', 'Test_FWDL_ColdStart.tar.gz', 'Test_FWDL_ColdStart.tar.gz/image.tar.xz',
+                      'Test_FWDL_ColdStart.tar.gz/image.tar.xz/rootfs.tar.gz'}
+    inner_member = manifest.members(sha, match='rootfs', layer='Test_FWDL_ColdStart.tar.gz/image.tar.xz')[0]
+    assert inner_member.size == len(rootfs)
+    assert inner_member.digest == hashlib.sha256(rootfs).hexdigest()
@@ -0,0 +1,329 @@
+import os
+import sqlite3
+import logging
+import threading
+import time
+from rohan.meter import MeterDB
+from rohan.meter.MeterDB import MeterDB as MeterDBFactory, MeterDBsql
+from rohan.meter.LockLedger import LockJournal
+from rohan.meter.MeterInstance import lock_group, lock_any, unlock_seen, wait_unlock, LockRequest
+
+
+def test_migrate(new_meter_db):
+    mdb = new_meter_db
+    # connecting changes nothing, locks work without the lock tables
+    assert not (mdb.leases or mdb.queue or mdb.events)
+    assert mdb.execute_sql("SELECT name FROM sqlite_master WHERE name LIKE 'lock%' OR name = 'meterdb_schema'") == []
+    assert mdb.lock_node('10.0.0.0')
+    mdb.unlock_node('10.0.0.0')
+
+    assert mdb.migrate() == (0, MeterDB.SCHEMA_VERSION)
+    assert mdb.leases and mdb.queue and mdb.events
+    assert mdb.migrate() == (MeterDB.SCHEMA_VERSION, MeterDB.SCHEMA_VERSION)
+    # the next connection finds the lock tables without reading them again
+    other = MeterDBsql(mdb.db_file, logging.getLogger(), mdb.db_file, platform='gen5', project='riva')
+    assert other.leases and other.queue and other.events
+
+    mdb.record_events('release', ['10.0.0.0'])
+    mdb.execute_sql(f"UPDATE lock_events SET event_time = {time.time() - 40 * 86400}")
+    mdb.record_events('release', ['10.0.0.1'])
+    assert mdb.purge_events(days=30) == 1
+    assert mdb.execute_sql("SELECT node_ip FROM lock_events") == [('10.0.0.1',)]
+    other.close()
+
+
+def test_lock_group(meter_db):
+    assert meter_db.lock_node('10.0.0.1')
+
+    # one busy node fails the whole group, nothing else is left locked
+    assert meter_db.lock_group(['10.0.0.0', '10.0.0.1', '10.0.0.2']) == []
+    assert meter_db.execute_sql("SELECT node_ip FROM Node WHERE node_busy = 'yes'") == [('10.0.0.1',)]
+
+    assert meter_db.lock_group(['10.0.0.3', '10.0.0.4', '10.0.0.5']) == ['10.0.0.3', '10.0.0.4', '10.0.0.5']
+    assert len(meter_db.lock_result) == 4
+    meter_db.unlock_all()
+    assert meter_db.execute_sql("SELECT count(*) FROM Node WHERE node_busy = 'yes'") == [(0,)]
+
+
+def test_lock_group_instances(meter_db):
+    meters = meter_db.get_meters()
+    group = [m for m in meters if m.info['PEER_GROUP'] == 'group0']
+    assert lock_group(group)
+    assert all(m.locked for m in group)
+    assert not lock_group([m for m in meters if m.info['PEER_GROUP'] == 'group1'] + [group[0].__class__(group[0].info, meter_db)])
+    for m in group:
+        m.unlock()
+    assert meter_db.execute_sql("SELECT count(*) FROM Node WHERE node_busy = 'yes'") == [(0,)]
+
+
+def test_lock_any(meter_db):
+    assert meter_db.lock_node('10.0.0.0')
+    meter_db.execute_sql("UPDATE Node SET node_status = 'inactive' WHERE node_ip = '10.0.0.5'")
+
+    locked = meter_db.lock_any(2, peer_group='group0')
+    assert sorted(m.ip_address for m in locked) == ['10.0.0.1', '10.0.0.2']
+    assert all(m.locked for m in locked)
+    # only 10.0.0.3 and 10.0.0.4 are left, 10.0.0.5 is inactive
+    assert sorted(m.ip_address for m in meter_db.lock_any(5)) == ['10.0.0.3', '10.0.0.4']
+    assert meter_db.lock_any(1) == []
+    meter_db.unlock_all()
+
+    meters = meter_db.get_meters()
+    assert len(lock_any(meters, 3)) == 3
+    assert len(lock_any(meters, 3)) == 2
+
+
+def test_wait_unlock(meter_db):
+    other = MeterDBsql(meter_db.db_file, logging.getLogger(), meter_db.db_file, platform='gen5', project='riva')
+    assert other.lock_node('10.0.0.0')
+    meters = [m for m in meter_db.get_meters() if m.ip_address == '10.0.0.0']
+
+    seen = unlock_seen(meters)
+    assert not meters[0].lock()
+    assert not wait_unlock(meters, seen, 1)
+
+    threading.Timer(0.5, other.unlock_node, ('10.0.0.0',)).start()
+    start = time.time()
+    assert wait_unlock(meters, seen, 60)
+    assert time.time() - start < 10
+    assert meters[0].lock()
+    meters[0].unlock()
+    other.close()
+
+
+def test_lease(meter_db, monkeypatch):
+    monkeypatch.setattr(MeterDB, 'LEASE_SECONDS', 1)
+    monkeypatch.setattr(MeterDB, 'LEASE_RENEW', 0.2)
+    other = MeterDBsql(meter_db.db_file, logging.getLogger(), meter_db.db_file, platform='gen5', project='riva')
+
+    # the heartbeat keeps the lease
+    assert meter_db.lock_node('10.0.0.0')
+    time.sleep(1.5)
+    assert not other.lock_node('10.0.0.0')
+
+    # a dead holder stops renewing, the node can be taken over
+    meter_db.heartbeat_pid = None
+    time.sleep(1.5)
+    assert other.lock_node('10.0.0.0')
+    # the next renewal finds the lease gone and stops tracking the node
+    assert meter_db.renew_leases() == []
+    assert meter_db.lock_result == []
+    # the old holder does not release the new lock
+    assert meter_db.unlock_nodes(['10.0.0.0']) == []
+    assert meter_db.execute_sql("SELECT lock_owner FROM Node WHERE node_ip = '10.0.0.0'") == [(other.owner,)]
+    other.unlock_node('10.0.0.0')
+
+    # an untracked lock has no lease
+    assert meter_db.lock_node('10.0.0.1', track=False)
+    time.sleep(1.5)
+    assert not other.lock_node('10.0.0.1')
+    meter_db.force_unlock_node('10.0.0.1')
+    other.close()
+
+
+def test_lease_per_process(meter_db, monkeypatch):
+    monkeypatch.setattr(MeterDB, 'LEASE_SECONDS', 1)
+    monkeypatch.setattr(MeterDB, 'LEASE_RENEW', 0.2)
+    assert meter_db.lock_node('10.0.0.0')
+    parent_owner = meter_db.owner
+    children = {}
+    for ip in ('10.0.0.1', '10.0.0.2'):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            ok = meter_db.lock_node(ip) and meter_db.owner != parent_owner
+            os.write(write, b'1' if ok else b'0')
+            if ip == '10.0.0.1':
+                # dies holding the meter
+                os._exit(0)
+            time.sleep(3)
+            # the sibling kept renewing, its lease was never lost
+            ok = ip in meter_db.lock_result and meter_db.lock_result == ['10.0.0.0', ip]
+            meter_db.unlock_node(ip)
+            os._exit(0 if ok else 1)
+        os.close(write)
+        assert os.read(read, 1) == b'1'
+        os.close(read)
+        children[ip] = pid
+
+    os.waitpid(children['10.0.0.1'], 0)
+    time.sleep(1.5)
+    other = MeterDBsql(meter_db.db_file, logging.getLogger(), meter_db.db_file, platform='gen5', project='riva')
+    # only the meter of the dead child can be taken over
+    assert other.lock_node('10.0.0.1')
+    assert not other.lock_node('10.0.0.2')
+    assert not other.lock_node('10.0.0.0')
+    _, status = os.waitpid(children['10.0.0.2'], 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert meter_db.lock_result == ['10.0.0.0']
+    other.close()
+
+
+def test_plan_grant():
+    queue = [(1, ['a', 'b', 'c'], 3, True), (2, ['a', 'b', 'c', 'd'], 2, False), (3, ['d'], 1, False)]
+    # the group ahead keeps a, b, c even though one of them is busy
+    assert MeterDB.plan_grant(queue, ['a', 'b', 'd'], 2) == ['d']
+    assert MeterDB.plan_grant(queue, ['a', 'b', 'd'], 1) == []
+    assert MeterDB.plan_grant(queue, ['a', 'b', 'd'], 3) == []
+    assert MeterDB.plan_grant(queue, ['d', 'a', 'b', 'c'], 1) == ['a', 'b', 'c']
+    assert MeterDB.plan_grant(queue[1:], ['d', 'a', 'b'], 2) == ['d', 'a']
+    assert MeterDB.plan_grant(queue[1:], ['d', 'a', 'b'], 3) == []
+
+
+def test_lock_queue(meter_db):
+    other = MeterDBsql(meter_db.db_file, logging.getLogger(), meter_db.db_file, platform='gen5', project='riva')
+    assert other.lock_node('10.0.0.2')
+
+    meters = meter_db.get_meters()
+    group = LockRequest([m for m in meters if m.info['PEER_GROUP'] == 'group0'])
+    singles = LockRequest(meters, count=2)
+    assert group.poll() == []
+    # the waiting group keeps 10.0.0.0 and 10.0.0.1 from the single meter request
+    assert sorted(m.ip_address for m in singles.poll()) == ['10.0.0.3', '10.0.0.4']
+    assert singles.done
+
+    # a higher priority request is served before the group
+    urgent = other.request_locks(['10.0.0.0'], 1, priority=1)
+    other.unlock_node('10.0.0.2')
+    assert group.poll() == []
+    assert other.grant_locks(urgent) == ['10.0.0.0']
+    other.unlock_node('10.0.0.0')
+    assert len(group.poll()) == 3 and group.done
+    assert meter_db.execute_sql("SELECT count(*) FROM lock_queue") == [(0,)]
+
+    late = LockRequest([m for m in meters if not m.locked], count=1)
+    late.cancel()
+    assert meter_db.execute_sql("SELECT count(*) FROM lock_queue") == [(0,)]
+    other.close()
+
+
+def test_journal_replay(meter_db, tmp_path):
+    journal_file = str(tmp_path / "locks.journal")
+    pid = os.fork()
+    if pid == 0:
+        # a session that dies holding locks
+        mdb = MeterDBsql(meter_db.db_file, logging.getLogger(), meter_db.db_file, platform='gen5', project='riva')
+        mdb.journal_locks(LockJournal(journal_file, truncate=True))
+        mdb.lock_group(['10.0.0.0', '10.0.0.1'])
+        mdb.lock_node('10.0.0.2')
+        mdb.unlock_node('10.0.0.1')
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    [(db, owner, nodes)] = LockJournal.held(journal_file)
+    assert nodes == ['10.0.0.0', '10.0.0.2']
+    # 10.0.0.2 was taken over after the lease expired, it is not freed
+    meter_db.execute_sql(f"UPDATE Node SET lock_owner = '{meter_db.owner}' WHERE node_ip = '10.0.0.2'")
+    assert meter_db.unlock_nodes(nodes, owner=owner) == ['10.0.0.0']
+    assert meter_db.execute_sql("SELECT node_ip FROM Node WHERE node_busy = 'yes'") == [('10.0.0.2',)]
+
+
+def test_unlock_all(meter_db):
+    assert len(meter_db.lock_any(4)) == 4
+    assert len(meter_db.lock_result) == 4
+    meter_db.unlock_all()
+    assert meter_db.lock_result == []
+    assert meter_db.execute_sql("SELECT count(*) FROM Node WHERE node_busy = 'yes'") == [(0,)]
+
+
+def test_file_source(meter_db):
+    mdb = MeterDBFactory(f"file:{meter_db.db_file},platform=gen5,project=riva")
+    assert isinstance(mdb, MeterDBsql)
+    assert len(mdb.get_meters()) == 6
+    assert mdb.execute_sql("PRAGMA journal_mode") == [('wal',)]
+    mdb.close()
+
+
+def test_stress(tmp_path):
+    result = MeterDB.stress(str(tmp_path / "stress.db"), procs=4, iterations=50)
+    assert result['errors'] == 0
+    assert result['locks'] > 0
+
+
+def test_dump(meter_db, tmp_path):
+    out = tmp_path / "dump.sql"
+    with open(out, 'w') as f:
+        assert meter_db.dump(f, tables=['node']) is None
+    text = out.read_text()
+    assert 'CREATE TABLE Node' in text and 'CREATE TABLE platform' not in text
+    assert text.count('INSERT INTO "Node"') == 6
+
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(text)
+    assert conn.execute("SELECT count(*) FROM Node").fetchone() == (6,)
+    assert 'INSERT INTO "platform"' in meter_db.dump()
+
+
+def test_lock_stats():
+    events = [
+        (0, 'grant', 'a', None, 'o1', 'h1', None),      # held since before the window
+        (10, 'request', 'a', 1, 'o2', 'h2', 'b7'),
+        (10, 'request', 'b', 1, 'o2', 'h2', 'b7'),
+        (15, 'deny', 'a', None, 'o3', 'h1', None),
+        (20, 'release', 'a', None, 'o1', 'h1', None),
+        (30, 'grant', 'a', 1, 'o2', 'h2', 'b7'),
+        (40, 'request', 'b', 2, 'o3', 'h1', None),
+        (50, 'cancel', None, 2, 'o3', 'h1', None),
+    ]
+    stats = MeterDB.lock_stats(events, 10, 110, nodes=['c'])
+    assert stats['requests'] == {'made': 2, 'granted': 1, 'cancelled': 1, 'waiting': 0}
+    assert stats['waits']['p50'] == 20 and stats['waits']['max'] == 20
+    assert stats['peak'] == 1
+    a, b = stats['meters']['a'], stats['meters']['b']
+    # 10-20 by the first holder, 30 to the end of the window by the second
+    assert a['held'] == 90 and a['utilisation'] == 0.9 and a['grants'] == 1 and a['denies'] == 1
+    assert b['waits'] == 2 and b['wait_time'] == 30
+    assert stats['meters']['c']['utilisation'] == 0
+    assert stats['hotspots'] == ['b', 'a']
+    assert stats['hosts']['h2'] == {'grants': 1, 'requests': 1, 'builds': ['b7'], 'wait_p50': 20}
+
+
+def test_lock_events(meter_db):
+    start = time.time()
+    assert meter_db.lock_node('10.0.0.0')
+    assert not meter_db.lock_node('10.0.0.0')
+    request = LockRequest([m for m in meter_db.get_meters() if m.ip_address == '10.0.0.1'])
+    assert len(request.poll()) == 1
+    meter_db.unlock_all()
+
+    events = [row[1] for row in meter_db.read_events(start, time.time())]
+    assert events == ['grant', 'deny', 'request', 'grant', 'release', 'release']
+    stats = meter_db.lock_stats(start, nodes=['10.0.0.5'])
+    assert stats['meters']['10.0.0.0']['grants'] == 1 and stats['meters']['10.0.0.0']['denies'] == 1
+    assert stats['requests']['granted'] == 1 and stats['peak'] == 2
+    assert stats['meters']['10.0.0.5']['grants'] == 0
+
+
+def test_inventory(meter_db):
+    other = MeterDBsql(meter_db.db_file, logging.getLogger(), meter_db.db_file, platform='gen5', project='riva')
+    assert other.inventory is meter_db.inventory
+    meters = meter_db.get_meters()
+    loads = meter_db.inventory.loads
+    # nothing changed, the rows are not read again and the records are shared
+    assert [m.info for m in other.get_meters()] == [m.info for m in meters]
+    assert other.get_meters()[0].info is meters[0].info
+    assert meter_db.inventory.loads == loads
+    assert dict(meters[0].info)['PEER_GROUP'] == 'group0'
+
+    assert [m.ip_address for m in meter_db.get_meters(peer_group='group1')] == ['10.0.0.3', '10.0.0.4', '10.0.0.5']
+    groups = meter_db.get_meter_groups()
+    assert list(groups) == ['group0', 'group1'] and all(len(g) == 3 for g in groups.values())
+
+    # locks, releases and lease renewals do not move the version
+    assert other.lock_node('10.0.0.0')
+    assert len(other.lock_any(2)) == 2
+    other.renew_leases()
+    other.unlock_all()
+    assert meter_db.get_meters()[0].info is meters[0].info
+    assert meter_db.inventory.loads == loads
+
+    # a change from another connection is seen on the next call
+    conn = sqlite3.connect(meter_db.db_file)
+    with conn:
+        conn.execute("UPDATE Node SET node_status = 'inactive' WHERE node_ip = '10.0.0.5'")
+    conn.close()
+    assert len(meter_db.get_meters()) == 5
+    assert meter_db.inventory.loads == loads + 1
+    assert len(meter_db.get_meters(node_status='%')) == 6
+    other.close()
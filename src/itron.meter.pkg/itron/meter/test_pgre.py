@@ -0,0 +1,268 @@
+import os
+import base64
+import logging
+import threading
+import time
+import types
+import psycopg2
+import pytest
+from rohan.meter import MeterDB
+from rohan.meter.MeterDB import ConnectionPool, MeterDBpgre
+from rohan.meter.MeterInstance import LockRequest, unlock_seen, wait_unlock
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def execute(self, query):
+        if self.conn.broken:
+            self.conn.closed = 2
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.conn.queries.append(query)
+
+
+class FakeConnection:
+    def __init__(self, **params):
+        self.params = params
+        self.closed = 0
+        self.broken = False
+        self.autocommit = False
+        self.queries = []
+        self.info = types.SimpleNamespace(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    created = []
+
+    def connect(**params):
+        conn = FakeConnection(**params)
+        created.append(conn)
+        return conn
+    monkeypatch.setattr(MeterDB.psycopg2, 'connect', connect)
+    return created
+
+
+def test_pool_reuse(connections):
+    pool = ConnectionPool(maxsize=2, database='meters')
+    conn = pool.get()
+    assert conn.autocommit and conn.params['database'] == 'meters'
+    pool.put(conn)
+    assert pool.get() is conn
+    pool.put(conn)
+
+    # a connection left in a transaction is rolled back before it is reused
+    conn.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    pool.put(conn)
+    assert pool.get() is conn and len(connections) == 1
+
+
+def test_pool_replaces_broken(connections, monkeypatch):
+    pool = ConnectionPool(maxsize=2)
+    conn = pool.get()
+    conn.closed = 2
+    pool.put(conn)
+    assert pool.size == 0
+    assert pool.get() is connections[1]
+    pool.put(connections[1])
+
+    # an idle connection is checked with a round trip, a dead one is replaced
+    monkeypatch.setattr(MeterDB, 'POOL_CHECK_IDLE', 0)
+    connections[1].broken = True
+    assert pool.get() is connections[2]
+    assert connections[1].closed and pool.size == 1
+
+    # run() retries once on a new connection when the server went away
+    pool.put(connections[2])
+    calls = []
+
+    def query(conn):
+        calls.append(conn)
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        return len(calls)
+    monkeypatch.setattr(MeterDB, 'POOL_CHECK_IDLE', 3600)
+    connections[2].broken = True
+    assert pool.run(query) == 2
+    assert calls == [connections[2], connections[3]] and pool.size == 1
+
+
+def test_pool_size_cap(connections):
+    pool = ConnectionPool(maxsize=2)
+    first, second = pool.get(), pool.get()
+    with pytest.raises(TimeoutError):
+        pool.get(timeout=0.2)
+
+    threading.Timer(0.2, pool.put, (first,)).start()
+    start = time.time()
+    assert pool.get(timeout=10) is first
+    assert time.time() - start < 5
+    assert len(connections) == 2 and pool.size == 2
+    pool.put(first)
+    pool.put(second)
+
+
+def test_pool_after_fork(connections):
+    pool = ConnectionPool(maxsize=1)
+    parent = pool.get()
+    pid = os.fork()
+    if pid == 0:
+        # the parent's connection is neither used nor closed, the child opens its own
+        conn = pool.get(timeout=1)
+        ok = conn is not parent and not parent.closed and pool.size == 1
+        pool.put(parent)
+        ok = ok and pool.idle == [] and not parent.closed
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert not parent.closed and pool.size == 1
+    pool.put(parent)
+
+
+# db_pgre against a server, METERDB_TEST_PG=host:port of a postgres the tests can create a schema in
+PG_SERVER = os.getenv("METERDB_TEST_PG")
+needs_pg = pytest.mark.skipif(not PG_SERVER, reason="METERDB_TEST_PG not set")
+SCHEMA = "meterdb_test"
+
+
+def _encode(value):
+    return base64.b64encode(value.encode())
+
+
+def _pg_db():
+    host, port = PG_SERVER.rsplit(':', 1)
+    return MeterDBpgre({}, logging.getLogger(), _encode(os.getenv("METERDB_TEST_PGDB", "postgres")),
+                       _encode(os.getenv("METERDB_TEST_PGUSER", "postgres")), _encode(os.getenv("METERDB_TEST_PGPSWD", "")),
+                       host, port, schema=SCHEMA, platform='gen5', project='riva')
+
+
+@pytest.fixture
+def pg_db():
+    host, port = PG_SERVER.rsplit(':', 1)
+    conn = psycopg2.connect(host=host, port=port, dbname=os.getenv("METERDB_TEST_PGDB", "postgres"),
+                            user=os.getenv("METERDB_TEST_PGUSER", "postgres"), password=os.getenv("METERDB_TEST_PGPSWD", ""))
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SCHEMA}")
+        cur.execute(f"CREATE TABLE {SCHEMA}.platform (platform_id serial PRIMARY KEY, platform_name text, project_name text)")
+        cur.execute(f"INSERT INTO {SCHEMA}.platform (platform_name, project_name) VALUES ('gen5', 'riva')")
+        cur.execute(f"CREATE TABLE {SCHEMA}.node (node_ip text PRIMARY KEY, platform_id int, node_status text, node_busy text, "
+                    "busy_change_count int DEFAULT 0, last_busy_change timestamptz, dns_name text, peer_group text, "
+                    "lock_host text, node_device_type int)")
+        for i in range(6):
+            cur.execute(f"INSERT INTO {SCHEMA}.node (node_ip, platform_id, node_status, node_busy, peer_group, node_device_type) "
+                        "VALUES (%s, 1, 'active', 'no', %s, 1)", (f"10.0.0.{i}", f"group{i // 3}"))
+    mdb = _pg_db()
+    mdb.migrate()
+    yield mdb
+    mdb.close()
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    conn.close()
+
+
+@needs_pg
+def test_pg_migrate(pg_db):
+    assert pg_db.leases and pg_db.queue and pg_db.events
+    assert pg_db.migrate() == (MeterDB.SCHEMA_VERSION, MeterDB.SCHEMA_VERSION)
+    pg_db.record_events('release', ['10.0.0.0'])
+    pg_db.execute_sql(f"UPDATE {SCHEMA}.lock_events SET event_time = {time.time() - 40 * 86400} RETURNING event_id")
+    pg_db.record_events('release', ['10.0.0.1'])
+    assert pg_db.purge_events(days=30) == 1
+
+
+@needs_pg
+def test_pg_inventory(pg_db):
+    other = _pg_db()
+    meters = pg_db.get_meters()
+    loads = pg_db.inventory.loads
+    # locks, releases and lease renewals do not move the version
+    assert other.lock_node('10.0.0.0')
+    assert len(other.lock_any(2)) == 2
+    other.renew_leases()
+    other.unlock_all()
+    assert pg_db.get_meters()[0].info is meters[0].info
+    assert pg_db.inventory.loads == loads
+
+    other.deactivate('10.0.0.5')
+    assert len(pg_db.get_meters()) == 5 and pg_db.inventory.loads == loads + 1
+    other.close()
+
+
+@needs_pg
+def test_pg_lock_any(pg_db):
+    other = _pg_db()
+    results = {}
+
+    def take(name, db):
+        results[name] = {m.ip_address for m in db.lock_any(3)}
+    threads = [threading.Thread(target=take, args=(name, db)) for name, db in (('a', pg_db), ('b', other))]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    # SKIP LOCKED hands every meter to one of them
+    assert not results['a'] & results['b'] and len(results['a'] | results['b']) == 6
+    assert set(pg_db.renew_leases()) == results['a']
+    other.close()
+    assert pg_db.execute_sql(f"SELECT count(*) FROM {SCHEMA}.node WHERE node_busy = 'yes'") == [(3,)]
+
+
+@needs_pg
+def test_pg_lock_queue(pg_db):
+    other = _pg_db()
+    assert other.lock_node('10.0.0.2')
+    meters = pg_db.get_meters()
+    group = LockRequest([m for m in meters if m.info['PEER_GROUP'] == 'group0'])
+    assert group.poll() == []
+    urgent = other.request_locks(['10.0.0.0'], 1, priority=1)
+    other.unlock_node('10.0.0.2')
+    assert group.poll() == []
+    assert other.grant_locks(urgent) == ['10.0.0.0']
+    other.unlock_node('10.0.0.0')
+    assert len(group.poll()) == 3 and group.done
+    other.close()
+
+
+@needs_pg
+def test_pg_wait_unlock(pg_db):
+    other = _pg_db()
+    assert other.lock_node('10.0.0.0')
+    meters = [m for m in pg_db.get_meters() if m.ip_address == '10.0.0.0']
+    # waiters wake once when the LISTEN starts, for the releases missed before it
+    assert wait_unlock(meters, unlock_seen(meters), 10)
+
+    seen = unlock_seen(meters)
+    assert not meters[0].lock()
+    assert not wait_unlock(meters, seen, 1)
+    threading.Timer(0.5, other.unlock_node, ('10.0.0.0',)).start()
+    start = time.time()
+    # LISTEN wakes the waiter as soon as the release commits
+    assert wait_unlock(meters, seen, 60)
+    assert time.time() - start < 10
+    assert meters[0].lock()
+    meters[0].unlock()
+    other.close()
+
+
+@needs_pg
+def test_pg_dump(pg_db):
+    text = pg_db.dump(tables=[f"{SCHEMA}.node"], copy=True)
+    assert text.startswith(f'COPY "{SCHEMA}"."node"') and text.count('10.0.0.') == 6
+    text = pg_db.dump(tables=['node'])
+    assert text.count(f'INSERT INTO "{SCHEMA}"."node"') == 6
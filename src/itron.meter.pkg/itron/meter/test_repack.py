@@ -0,0 +1,106 @@
+import io
+import os
+import tarfile
+import zipfile
+
+from rohan.meter import Repack
+
+
+def _tar_bytes(members, compression):
+    """ build a tarball in memory from {name: bytes or None (directory)} """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:' + compression) as t:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                t.addfile(info)
+            else:
+                info.size = len(data)
+                info.mode = 0o600
+                t.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _make_package(path):
+    rootfs = _tar_bytes({
+        './usr/share/rohan/PreInstall': None,
+        './usr/share/rohan/PreInstall/DI-AppServices-Package-1.0.0.0_TS.tar.gz': b'old di',
+        './usr/share/rohan/PreInstall/script.sh': b'old script',
+        './etc/hostname': b'meter',
+    }, 'gz')
+    inner = _tar_bytes({'rootfs.tar.gz': rootfs, 'manifest.txt': b'inner'}, 'xz')
+    outer = _tar_bytes({'image.tar.xz': inner, 'signature': b'sig'}, 'gz')
+    with open(path, 'wb') as f:
+        f.write(outer)
+
+
+def _read_layers(path):
+    with tarfile.open(path, 'r:gz') as outer:
+        names = outer.getnames()
+        inner = outer.extractfile('image.tar.xz').read()
+    with tarfile.open(fileobj=io.BytesIO(inner), mode='r:xz') as t:
+        rootfs = t.extractfile('rootfs.tar.gz').read()
+    with tarfile.open(fileobj=io.BytesIO(rootfs), mode='r:gz') as t:
+        files = {m.name: t.extractfile(m).read() if m.isfile() else None for m in t.getmembers()}
+    return names, files
+
+
+def test_rewrite_replaces_preinstall(tmp_path):
+    src = os.path.join(tmp_path, 'decrypted.tar.gz')
+    dst = os.path.join(tmp_path, 'repacked.tar.gz')
+    di_zip = os.path.join(tmp_path, 'DI-AppServices-Package-2.0.0.0_TS.zip')
+    _make_package(src)
+    with zipfile.ZipFile(di_zip, 'w') as z:
+        z.writestr('DI-AppServices-Package-2.0.0.0_TS.tar.gz', b'new di')
+        z.writestr('readme.txt', b'ignored')
+
+    edit = Repack.TarEdit(Repack.PREINSTALL_DIR)
+    assert edit.add_zip(di_zip, match=r'\.gz', count=1) == 1
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        Repack.rewrite_tar(fin, fout, edit, layers=Repack.PACKAGE_LAYERS, compression=('gz', 'xz', 'gz'))
+
+    assert edit.applied
+    assert len(edit.dropped) == 2
+    names, files = _read_layers(dst)
+    assert names == ['image.tar.xz', 'signature']
+    assert files['./etc/hostname'] == b'meter'
+    assert files['./usr/share/rohan/PreInstall'] is None
+    assert files['./usr/share/rohan/PreInstall/DI-AppServices-Package-2.0.0.0_TS.tar.gz'] == b'new di'
+    assert not any('1.0.0.0' in name or 'script.sh' in name for name in files)
+
+
+def test_rewrite_missing_layer(tmp_path):
+    src = os.path.join(tmp_path, 'plain.tar.gz')
+    with open(src, 'wb') as f:
+        f.write(_tar_bytes({'readme': b'nothing here'}, 'gz'))
+
+    edit = Repack.TarEdit(Repack.PREINSTALL_DIR)
+    with open(src, 'rb') as fin:
+        Repack.rewrite_tar(fin, io.BytesIO(), edit, layers=Repack.PACKAGE_LAYERS, compression=('gz', 'xz', 'gz'))
+    assert not edit.applied
+
+
+def test_extract_normalizes_permissions(tmp_path):
+    src = os.path.join(tmp_path, 'decrypted.tar.gz')
+    _make_package(src)
+
+    names = Repack.list_members(src, layers=Repack.PACKAGE_LAYERS, match=Repack.PREINSTALL_DIR)
+    assert len(names) == 3
+
+    outdir = os.path.join(tmp_path, 'out')
+    extracted = Repack.extract(src, outdir, layers=Repack.PACKAGE_LAYERS, match='script')
+    assert extracted == ['./usr/share/rohan/PreInstall/script.sh']
+    mode = os.stat(os.path.join(outdir, extracted[0])).st_mode
+    assert mode & 0o600 == 0o600
+
+
+def test_permission_filter_on_rewrite():
+    data = _tar_bytes({'ro_dir': None, 'ro_dir/file': b'x'}, 'gz')
+    out = io.BytesIO()
+    Repack.rewrite_tar(io.BytesIO(data), out, member_filter=Repack.permission_filter(file_mode=0o044, owner=None))
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode='r:gz') as t:
+        assert t.getmember('ro_dir/file').mode == 0o644
+        assert t.getmember('ro_dir').mode == 0o755
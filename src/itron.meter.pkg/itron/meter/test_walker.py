@@ -0,0 +1,86 @@
+import os
+
+from rohan.meter import Walker
+from rohan.meter.Walker import Crawler, BuildTreeServer, ListingCache, parse_links, synthetic_tree
+
+
+def _sequential_glob(crawler, levels, recurse):
+    """ reference: walk everything, then filter like the original Walker.glob """
+    import re
+    match = [re.compile(x.replace('*', '.+')) for x in levels]
+
+    def parts(url):
+        return [p for p in url.replace(crawler.base_url, '').split('/') if p]
+
+    found = []
+    for url in crawler.walk(crawler.base_url, depth=999 if recurse else len(levels)):
+        p = parts(url)
+        if len(p) >= len(levels) and all(match[i].fullmatch(p[i]) for i in range(len(levels))):
+            found.append(url)
+    return found
+
+
+def test_parse_links():
+    page = '<a href="?C=N;O=D">Name</a><a href="/">Parent</a><a HREF="a&amp;b/">x</a><a href="f.zip">f</a>'
+    assert parse_links(page) == ['a&b/', 'f.zip']
+
+
+def test_glob_prunes_and_keeps_order():
+    with BuildTreeServer(synthetic_tree(releases=3, builds=4)) as server, Crawler(server.url, workers=4) as crawler:
+        for pattern, recurse in [('GEN5_RIVA_SR_10*/Latest', False),
+                                 ('GEN5_RIVA_SR_10*/Latest/*', False),
+                                 ('DI_Agents/Agent1/*', True)]:
+            server.requests = 0
+            found = crawler.glob(pattern, recurse)
+            pruned = server.requests
+            assert found and found == _sequential_glob(crawler, pattern.split('/'), recurse)
+            assert pruned < server.requests
+
+        assert crawler.glob('DI_Agents/Missing/*') == []
+
+
+def test_listing_cache_revalidates(tmp_path):
+    tree = synthetic_tree(releases=2, builds=2)
+    cache = ListingCache(os.path.join(tmp_path, 'crawl.db'), ttl=3600)
+    with BuildTreeServer(tree) as server, Crawler(server.url, cache=cache) as crawler:
+        url = server.url + 'DI_Agents/'
+        dirs, _ = crawler.list(url)
+        assert crawler.list(url) == (dirs, [])
+        assert server.requests == 1
+
+        # expired: a conditional request answered with 304
+        cache.ttl = 0
+        assert crawler.list(url) == (dirs, [])
+        assert server.requests == 2 and server.not_modified == 1
+
+        # changed on the server
+        tree['DI_Agents/']['NewAgent/'] = {}
+        assert crawler.list(url)[0] == dirs + [url + 'NewAgent/']
+
+        cache.ttl = 3600
+        crawler.list(url, refresh=True)
+        assert server.requests == 4 and server.not_modified == 1
+
+
+def test_close_cancels_pending():
+    with BuildTreeServer(synthetic_tree(releases=2, builds=2), delay=0.2) as server:
+        crawler = Crawler(server.url, workers=1)
+        futures = [crawler.submit(server.url) for _ in range(5)]
+        crawler.close()
+        assert any(f.cancelled() for f in futures)
+
+
+def test_crawler_after_fork(tmp_path, monkeypatch):
+    monkeypatch.setattr(Walker, 'ListingCache', lambda: ListingCache(os.path.join(tmp_path, 'crawl.db')))
+    monkeypatch.setattr(Walker, '_crawler', None)
+    with BuildTreeServer(synthetic_tree(releases=2, builds=2)) as server:
+        parent = Walker.get_crawler()
+        parent.base_url = server.url
+        pid = os.fork()
+        if pid == 0:
+            crawler = Walker.get_crawler()
+            ok = crawler is not parent and crawler.list(server.url + 'DI_Agents/')[0]
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        parent.close()
+        assert os.WEXITSTATUS(status) == 0
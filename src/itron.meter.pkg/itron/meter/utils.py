@@ -3,6 +3,8 @@ import time
 import datetime
 import subprocess
 import platform    # For getting the operating system name
+import threading
+from concurrent.futures import Future
 from zipfile import ZipFile, ZipInfo
 
 
@@ -84,3 +86,45 @@ def ctime_to_seconds(ctime_str):
     """
 
     return datetime.datetime.strptime(ctime_str, "%a %b %d %H:%M:%S %Z %Y").timestamp()
+
+
+def cache_dir(*subdir):
+    """ directory for caches shared by every process on this host
+
+    ROHAN_CACHE_DIR overrides the default of ~/.cache/rohan
+    """
+    path = os.getenv("ROHAN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "rohan"))
+    path = os.path.join(path, *subdir)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class Coalescer:
+    """ share one in-flight call between concurrent callers with the same key
+
+    Usage:
+        _lookups = Coalescer()
+        def lookup(version):
+            return _lookups.run(version, _lookup, version)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def run(self, key, func, *args, **kwargs):
+        """ call func, or wait for the call already running for key, and return its result """
+        with self.lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+        return future.result()
@@ -1,14 +1,15 @@
 import pytest
-import json
 import time
 import os
 from xdist.workermanage import NodeManager
 import random
 from xdist.dsession import DSession
 from rohan.plugins.affinitysched import LoadAffinityScheduling
+from rohan.meter.MeterInstance import LockRequest, unlock_seen
+from rohan.meter.LockLedger import LockJournal
 
 class MeterScheduler(LoadAffinityScheduling):
-    def __init__(self, config, logger, lock_timeout, max_meters, log=None, meters=None, multi=None):
+    def __init__(self, config, logger, lock_timeout, max_meters, log=None, meters=None, multi=None, priority=0):
         self._meters = [m for m in meters] if meters else []
         self._multi_meters = [m for m in multi] if multi else []
         self.max_meters = max_meters
@@ -23,7 +24,20 @@ class MeterScheduler(LoadAffinityScheduling):
         self.cur_locked = 0
         self.cur_locked_multi = 0
         self.rate_limit_lock_message = time.time() - 10
+        self.unlocks_seen = None
         self.allow_no_nodes = True
+        self.priority = priority
+        # places in the database lock queue, meters are granted in queue order
+        self.single_request = None
+        self.multi_requests = {}
+
+        # the databases journal their locks, clean_locks frees them after a crash
+        path = os.getenv("BUILD_ARTIFACTSTAGINGDIRECTORY", ".")
+        self.journal = LockJournal(os.path.join(path, "parallel.locks.journal"), truncate=True)
+        meters = self._meters + [m for mm in self._multi_meters for m in mm]
+        dbs = {id(m.parent_db): m.parent_db for m in meters if hasattr(getattr(m, 'parent_db', None), 'journal_locks')}
+        for db in dbs.values():
+            db.journal_locks(self.journal)
 
         # initial work must generate the affinity for each task
         super().__init__(config, log)
@@ -32,9 +46,10 @@ class MeterScheduler(LoadAffinityScheduling):
         self.close()
 
     def close(self):
+       self.cancel_requests()
        self.unlock_meters()
        self.unlock_multi_meters()
-       self.update_json()
+       self.journal.close()
 
 
     def remove_node(self, node):
@@ -56,7 +71,6 @@ class MeterScheduler(LoadAffinityScheduling):
                 self.cur_locked -= 1
                 self.locked_meters.remove(track)
         self.check_lock_state()
-        self.update_json()
 
     def check_lock_state(self):
         # update tracking objects
@@ -65,14 +79,14 @@ class MeterScheduler(LoadAffinityScheduling):
         assert self.cur_locked == total
         assert self.cur_locked_multi == sum([len(m) for m in self.locked_multi_meters])
 
-    def update_json(self):
-        path = os.getenv("BUILD_ARTIFACTSTAGINGDIRECTORY", ".")
-        filename = os.path.join(path, "parallel.locks.json")
-
-        with open(filename, "w") as fh:
-            json.dump(self.track_locks, fh, indent=4)
-        with open(filename, "w") as fh:
-            json.dump(self.track_locks, fh, indent=4)
+    def cancel_requests(self):
+        """ leave the lock queue, nothing more is needed """
+        if self.single_request:
+            self.single_request.cancel()
+            self.single_request = None
+        for request in self.multi_requests.values():
+            request.cancel()
+        self.multi_requests = {}
 
     def unlock_meters(self):
         if self.locked_meters:
@@ -97,14 +111,14 @@ class MeterScheduler(LoadAffinityScheduling):
         if not self.collection:
             return
 
-        if time.time() > self.rate_limit_lock_message:
+        # try again right away when a meter was released, the timer is only a fallback
+        seen = (unlock_seen(self._meters), unlock_seen([m for mm in self._multi_meters for m in mm]))
+        if time.time() > self.rate_limit_lock_message or seen != self.unlocks_seen:
+            self.unlocks_seen = seen
             changed,  notify,  needed = self.poll_single(session)
             changed2, notify2, needed = self.poll_multi(session)
             self.rate_limit_lock_message = time.time() + random.randint(50,70)
 
-            if changed or changed2:
-                self.update_json()
-
             if time.time() > self.rate_limit_lock_message:
                 if notify or notify2:
                     # rate limit lock messages
@@ -119,46 +133,50 @@ class MeterScheduler(LoadAffinityScheduling):
             self.logger.info("All schedulers are finished")
 
     def poll_single(self, session: DSession):
-        """ greedy locker, if there are tests left to operate on,
-            try to get as many meters (up to the limit) as we can.
+        """ queue for as many meters (up to the limit) as there are tests left for
 
-            if there are multi-meters configured as the same nodes
-            the multi-meters will be starved until all tests are
-            finished
+            meters are granted in the order sessions asked for them, and a
+            multi-meter group waiting ahead of this session keeps its meters,
+            so multi-meter tests are not starved by single meter tests
         """
         changed = False
         notify = False
         needed = 0
         if 'single_meter' in self.affinity_collections and self.affinity_collections['single_meter']:
-            if not self.affinity_scheduler['single_meter'].tests_finished:
+            if self.affinity_scheduler['single_meter'].tests_finished:
+                if self.single_request:
+                    self.single_request.cancel()
+                    self.single_request = None
+            else:
                 assert self._meters or self.cur_locked, "single meter tests were selected, but no meters were specified"
-                for meter in self._meters:
 
-                    needed = self.max_meters-self.cur_locked
-                    # if we can't lock anymore meters, just skip
-                    if needed < 1:
-                        continue
-
-                    if not meter.locked:
-                        if meter.lock():
-                            self.track_locks.append(meter.ip_address)
-                            env = {
-                                'PYTEST_XDIST_AFFINITY': 'single_meter',
-                                'PYTEST_XDIST_METER_TARGET': meter.ip_address
-                            }
-                            node = session.start_new_node_with_env( env)
-                            self.locked_meters.append(meter)
-                            self._meters.remove(meter)
-                            node.locked_meter = meter
-                            self.cur_locked += 1
-                            changed = True
-                            self.check_lock_state()
-                        else:
-                            if self.lock_timeout < time.time() and self.cur_locked == 0:
-                                self.logger.error("Meter lock timeout %s exceeded", self.lock_timeout_seconds)
-                                raise ValueError("Meter lock timeout.  use --lock_timeout option to extend timeout")
-
-                            notify = True
+                needed = self.max_meters-self.cur_locked
+                candidates = [meter for meter in self._meters if not meter.locked]
+                # if we can't lock anymore meters, just skip
+                if needed > 0 and candidates:
+                    if self.single_request is None or self.single_request.done:
+                        self.single_request = LockRequest(candidates, min(needed, len(candidates)), self.priority)
+                    locked = self.single_request.poll()
+                    for meter in locked:
+                        self.track_locks.append(meter.ip_address)
+                        env = {
+                            'PYTEST_XDIST_AFFINITY': 'single_meter',
+                            'PYTEST_XDIST_METER_TARGET': meter.ip_address
+                        }
+                        node = session.start_new_node_with_env( env)
+                        self.locked_meters.append(meter)
+                        self._meters.remove(meter)
+                        node.locked_meter = meter
+                        self.cur_locked += 1
+                        changed = True
+                        self.check_lock_state()
+
+                    if not self.single_request.done:
+                        if self.lock_timeout < time.time() and self.cur_locked == 0:
+                            self.logger.error("Meter lock timeout %s exceeded", self.lock_timeout_seconds)
+                            raise ValueError("Meter lock timeout.  use --lock_timeout option to extend timeout")
+
+                        notify = True
 
         return changed, notify, needed
 
@@ -170,32 +188,39 @@ class MeterScheduler(LoadAffinityScheduling):
 
         needed = 0
         if 'multi_meter' in self.affinity_collections and self.affinity_collections['multi_meter']:
-            if not self.affinity_scheduler['multi_meter'].tests_finished:
+            if self.affinity_scheduler['multi_meter'].tests_finished:
+                for request in self.multi_requests.values():
+                    request.cancel()
+                self.multi_requests = {}
+            else:
                 assert self._multi_meters or self.cur_locked_multi, "multi_meter tests were selected, but no meters were specified"
 
-                for mm in self._multi_meters:
+                for mm in list(self._multi_meters):
                     if self.max_meters < len(mm):
                         self.logger.warning("The maximum number (--max-meters=%s) of meters is less than the number of multi_meters (%s).  This probably will cause an infinite wait for enough meters to execute the tests.",
                                             self.max_meters, len(mm))
 
+                    key = tuple(m.ip_address for m in mm)
                     needed = self.max_meters-self.cur_locked_multi
-                    # if we can't lock anymore meters, just skip
+                    # if we can't lock anymore meters, just skip, and don't hold a place in the queue
                     if  needed < len(mm):
+                        if key in self.multi_requests:
+                            self.multi_requests.pop(key).cancel()
                         continue
 
                     if not any(m.locked for m in mm):
-                        locks = [m for m in mm if m.lock()]
-                        locked = len(locks) == len(mm)
-                        if not locked:
-                            # unlock and try again later
-                            for x in locks:
-                                x.unlock()
+                        if key not in self.multi_requests:
+                            self.multi_requests[key] = LockRequest(mm, priority=self.priority)
+                        request = self.multi_requests[key]
+                        request.poll()
+                        if not request.done:
                             if self.lock_timeout < time.time() and self.cur_locked_multi == 0:
                                 self.logger.error("Meter lock timeout %s exceeded", self.lock_timeout_seconds)
                                 raise ValueError("Meter lock timeout.  use --lock_timeout option to extend timeout")
 
                             notify = True
                         else:
+                            del self.multi_requests[key]
                             env = {
                                 'PYTEST_XDIST_AFFINITY': 'multi_meter',
                                 'PYTEST_XDIST_MULTI_METER_TARGET': ','.join([i.ip_address for i in mm])
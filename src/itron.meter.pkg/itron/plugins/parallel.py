@@ -17,12 +17,11 @@ import time
 import pytest
 import _pytest
 import threading
-import json
 import multiprocessing
 from queue import Empty
 from tblib import pickling_support
-from multiprocessing import Manager, Process, Event
-from rohan.meter.MeterInstance import MeterInstanceUser,MeterInstanceDB
+from multiprocessing import Manager, Process
+from rohan.meter.MeterInstance import MeterInstanceUser,MeterInstanceDB,lock_group,unlock_seen,wait_unlock
 import logging
 from contextlib import ExitStack,contextmanager
 import atexit
@@ -30,8 +29,8 @@ from _pytest._io import TerminalWriter
 from  rohan.meter.MeterDB import MeterDB,MeterDBBase
 import random
 import signal
-import rpyc
-from rpyc.utils.server import ThreadedServer
+from rohan.meter.LockBroker import LockBroker, LockBrokerClient
+from rohan.meter.LockLedger import LockJournal
 from logging.handlers import QueueHandler, QueueListener
 import pickle
 
@@ -133,7 +132,7 @@ def process_with_threads(config, queue,  log_queue, session, tests_per_worker, e
     [t.join() for t in threads]
 
 
-def process_with_multi_meters(config, queue,  log_queue, session, multi_meters, server_port,  errors):
+def process_with_multi_meters(config, queue,  log_queue, session, multi_meters, broker_path,  errors):
     # This function will be called from subprocesses, forked from the main
     # pytest process. First thing we need to do is to change config's value
     # so we know we are running as a worker.
@@ -143,8 +142,8 @@ def process_with_multi_meters(config, queue,  log_queue, session, multi_meters,
     handler = QueueHandler(log_queue)
     root.addHandler(handler)
 
-    # connect to the server managing the locks
-    lock_server = rpyc.connect(host='localhost', port=server_port)
+    # connect to the broker managing the locks
+    lock_server = LockBrokerClient(broker_path)
     multi_meters = [ [RemoteMeter(meter.info, lock_server) if isinstance(meter, MeterInstanceDB) else meter for meter in meters] for meters in multi_meters]
 
     v = multi_meters[0]
@@ -165,13 +164,13 @@ def set_log_dir(dir):
     global log_dir
     log_dir = dir
 
-def process_with_meters(config, queue,  log_queue,  session, meters, server_port, errors):
+def process_with_meters(config, queue,  log_queue,  session, meters, broker_path, errors):
     # This function will be called from subprocesses, forked from the main
     # pytest process. First thing we need to do is to change config's value
     # so we know we are running as a worker.
     config.parallel_worker = True
 
-    lock_server = rpyc.connect(host='localhost', port=server_port)
+    lock_server = LockBrokerClient(broker_path)
 
     root = logging.getLogger()
     handler = QueueHandler(log_queue)
@@ -268,13 +267,15 @@ class ThreadWorkerMeter(ThreadWorkerBase):
         timeout = time.time()+self.lock_timeout
         try:
             while not self.queue.empty():
+                seen = unlock_seen([self.meter])
                 locked = self.meter.lock()
                 if not locked:
                     if timeout < time.time():
                         LOGGER.error("Meter lock timeout")
                         raise ValueError("Meter lock timeout.  use --lock_timeout option to extend timeout from 1 minute")
                     LOGGER.info("Meter locked.  Waiting")
-                    time.sleep(random.randint(50,70))
+                    # retry as soon as a meter is released, polling is the fallback
+                    wait_unlock([self.meter], seen, random.randint(50,70))
                 else:
                     self.meter_exit_handler = MeterExitHandler(self.meter)
                     break
@@ -309,17 +310,14 @@ class ThreadWorkerMultiMeter(ThreadWorkerBase):
             timeout = time.time()+self.lock_timeout
 
             while not self.queue.empty():
-                locks = [m for m in self.multi_meter if m.lock()]
-                locked = len(locks) == len(self.multi_meter)
+                seen = unlock_seen(self.multi_meter)
+                locked = lock_group(self.multi_meter)
                 if not locked:
-                    # unlock and try again later
-                    for x in locks:
-                        x.unlock()
                     if timeout < time.time():
                         LOGGER.error("Meter lock timeout")
                         raise ValueError("Meter lock timeout.  use --lock_timeout option to extend timeout from 1 minute")
                     LOGGER.info("Meters locked.  Waiting")
-                    time.sleep(random.randint(50,70))
+                    wait_unlock(self.multi_meter, seen, random.randint(50,70))
                 else:
                     self.meter_exit_handler = [MeterExitHandler(meter) for meter in self.multi_meter]
                     break
@@ -375,80 +373,12 @@ class MeterExitHandler:
         self.meter.unlock()
         self.callbacks = None
 
-class RemoteDBServer(rpyc.Service):
-    def __init__(self, meterdb):
-        self.db = meterdb
-        self.locks = []
-        path = os.getenv("BUILD_ARTIFACTSTAGINGDIRECTORY", ".")
-        self.filename = os.path.join(path, "parallel.locks.json")
-        rpyc.service.__init__(self)
-
-    def update_locks(self):
-        LOGGER.info("Updated parallel.locks.json with %s", self.locks)
-        with open(self.filename, "w") as fh:
-            json.dump(self.locks, fh, indent=4)
-
-    @rpyc.exposed
-    def lock_node(self, node):
-        locked = self.db.lock_node(node)
-        if locked:
-            self.locks.append(str(node))
-            self.update_locks()
-        return locked
-
-    @rpyc.exposed
-    def unlock_node(self, node):
-        self.locks.remove(str(node))
-        ret = self.db.unlock_node(node)
-        self.update_locks()
-
-class RPCThreadedServer(ThreadedServer):
-    ''' an RPC server that adds a wait_up method that
-        waits for the server to start listening.  This is required
-        to avoid a client from trying to connect to the server
-        before the server has initialized and causes a connect timeout
-    '''
-    def __init__(self, *args, **kwargs):
-        self.start_event = Event()
-        ThreadedServer.__init__(self, *args, **kwargs)
-
-    def _listen(self):
-        if self.active:
-            return
-        super(ThreadedServer, self)._listen()
-        self.start_event.set()
-
-    def wait_up(self):
-        self.start_event.wait()
-
-class RemoteDBServerThread():
-    def __init__(self, db, name):
-        self.object = RemoteDBServer(db)
-        config = rpyc.core.protocol.DEFAULT_CONFIG.copy()
-        config['allow_all_attrs'] = True
-        config['allow_exposed_attrs'] = False
-        self.server = RPCThreadedServer(self.object, protocol_config=config, logger=LOGGER)
-        self.thread = threading.Thread(target=self.server.start)
-        self.thread.start()
-        self.server.wait_up()
-        self.port = self.server.port
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self.server.close()
-
-    def close(self):
-        self.server.close()
-
-
 class RemoteMeter(MeterInstanceDB):
     def __init__(self, info, server):
         """ This is a class to hold all of the information about a meter
-        that was selected from the database """
+        that was selected from the database, locked through the lock broker """
         self.server = server
-        self.parent_db = self.server.root
+        self.parent_db = self.server
         self.info = info
         self.locked = False
 
@@ -484,27 +414,13 @@ def pytest_configure(config):
         setattr(config, 'mdb_client', multi_dbclient)
 
         assert meter_pairs is None, "Can't specify a DUT database and manual meter pair list (--meter-pairs)"
-        multi_meters = multi_dbclient.get_meters()
-
-        # now, sort the list by group, then create two array of groups
-        sorted_by_peer = sorted(multi_meters, key=lambda x: x.info['PEER_GROUP'] if x.info['PEER_GROUP'] else '')
-        last_peer = None
-        multi_meters=[]
-        current_list=[]
-        for x in sorted_by_peer:
-            if x.info['PEER_GROUP'] == last_peer:
-                current_list.append(x)
+        # the meters of each peer group are tested together
+        multi_meters = []
+        for peer_group, group in multi_dbclient.get_meter_groups('peer_group').items():
+            if len(group) > 1:
+                multi_meters.append(group)
             else:
-                if current_list:
-                    if len(current_list) > 1:
-                        multi_meters.append(current_list)
-                    else:
-                        LOGGER.warning("rejecting single meter in PEER_GROUP.  there needs to be at least two meters in a group")
-                current_list = [x]
-            last_peer = x.info['PEER_GROUP']
-
-        if len(current_list) > 1:
-            multi_meters.append(current_list)
+                LOGGER.warning("rejecting single meter in PEER_GROUP %s.  there needs to be at least two meters in a group", peer_group)
 
         if not multi_meters:
             LOGGER.error("No meters are marked available in database to run tests. use option 'release=true' to force-release meters")
@@ -748,19 +664,27 @@ but does not have '@pytest.mark.parallel(p2p_meters={meters})` mark""",session.i
             # are there any common meters?
             common_meters = reg_meters.intersection(all_multi)
 
+            if queue_meter or queue_multimeter:
+                path = os.getenv("BUILD_ARTIFACTSTAGINGDIRECTORY", ".")
+                journal = es.enter_context(LockJournal(os.path.join(path, "parallel.locks.journal"), truncate=True))
+
             if queue_meter:
                 assert self.meters, "you must specify --meters or --dut-db.  There are selected tests that need meters"
-                mserver = es.enter_context(RemoteDBServerThread(self.dbclient, "single-meter-db-server"))
+                if self.dbclient:
+                    self.dbclient.journal_locks(journal)
+                mserver = es.enter_context(LockBroker(self.dbclient))
                 for meter in self.meters:
-                    args = (self._config, queue_meter, log_queue, session, [meter], mserver.port, errors)
+                    args = (self._config, queue_meter, log_queue, session, [meter], mserver.path, errors)
                     process = Process(target=process_with_meters, args=args,name=f"MeterProcess-{meter.ip_address}")
                     processes.append(process)
 
             if queue_multimeter:
                 assert self.multi_meters, "you must specify --multi-db.  There are selected tests that need meters"
-                mmserver = es.enter_context(RemoteDBServerThread(self.multi_dbclient, "multi-meter-db-server"))
+                if self.multi_dbclient:
+                    self.multi_dbclient.journal_locks(journal)
+                mmserver = es.enter_context(LockBroker(self.multi_dbclient))
                 for meters in self.multi_meters:
-                    args = (self._config, queue_multimeter, log_queue, session, [meters], mmserver.port, errors)
+                    args = (self._config, queue_multimeter, log_queue, session, [meters], mmserver.path, errors)
                     process = Process(target=process_with_multi_meters, args=args,name=f"MultiMeterProcess-{meters[0].ip_address}")
                     multi_process.append(process)
 
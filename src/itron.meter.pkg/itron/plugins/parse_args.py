@@ -26,6 +26,7 @@ def parse_meter_options(config, logger):
             lock_timeout = timedelta(seconds=float(val)).total_seconds()
 
     max_meters = int(parse_config(config, 'max_meters'))
+    lock_priority = int(parse_config(config, 'lock_priority') or 0)
 
     if not dut_db and not meters and os.getenv("PYTEST_DUT_DB"):
         dut_db = os.getenv("PYTEST_DUT_DB")
@@ -45,27 +46,13 @@ def parse_meter_options(config, logger):
         multi_dbclient = MeterDB(multi_db, logger)
 
         assert meter_pairs is None, "Can't specify a DUT database and manual meter pair list (--meter-pairs)"
-        multi_meters = multi_dbclient.get_meters()
-
-        # now, sort the list by group, then create two array of groups
-        sorted_by_peer = sorted(multi_meters, key=lambda x: x.info['PEER_GROUP'] if x.info['PEER_GROUP'] else '')
-        last_peer = None
-        multi_meters=[]
-        current_list=[]
-        for x in sorted_by_peer:
-            if x.info['PEER_GROUP'] == last_peer:
-                current_list.append(x)
+        # the meters of each peer group are tested together
+        multi_meters = []
+        for peer_group, group in multi_dbclient.get_meter_groups('peer_group').items():
+            if len(group) > 1:
+                multi_meters.append(group)
             else:
-                if current_list:
-                    if len(current_list) > 1:
-                        multi_meters.append(current_list)
-                    else:
-                        logger.warning("rejecting single meter in PEER_GROUP.  there needs to be at least two meters in a group")
-                current_list = [x]
-            last_peer = x.info['PEER_GROUP']
-
-        if len(current_list) > 1:
-            multi_meters.append(current_list)
+                logger.warning("rejecting single meter in PEER_GROUP %s.  there needs to be at least two meters in a group", peer_group)
 
         if not multi_meters:
             logger.error("No meters are marked available in database to run tests. use option 'release=true' to force-release meters")
@@ -94,7 +81,8 @@ def parse_meter_options(config, logger):
     options =  {
         'meters': meters,
         'multi_meters': multi_meters,
-        'max_meters': max_meters
+        'max_meters': max_meters,
+        'lock_priority': lock_priority
     }
     if lock_timeout:
         options['lock_timeout'] = lock_timeout
@@ -112,6 +100,7 @@ def add_meter_options(parser):
     meter_pairs_help = ('list if physical meter IP addresses of meters to be used for peer-to-peer testing')
     lock_help = ('timeout (in seconds) for locking meter database.  currently lock is 12 hours')
     max_help = ('maximum number of meters that will be used by the session.  this allows two runs to share a larger group of meters.')
+    priority_help = ('priority of the session in the meter lock queue, higher is served first.  sessions of the same priority are served in order of arrival.')
 
     group.addoption(
         '--cpus',
@@ -152,6 +141,11 @@ def add_meter_options(parser):
         dest='lock_timeout',
         help=lock_help
     )
+    group.addoption(
+        '--lock-priority',
+        dest='lock_priority',
+        help=priority_help
+    )
     parser.addini('meters', meters_help)
     parser.addini('meter_pairs', meter_pairs_help)
     parser.addini('max_meters', max_help)
@@ -159,3 +153,4 @@ def add_meter_options(parser):
     parser.addini('dut_db', dutdb_help)
     parser.addini('multi_db', multi_help)
     parser.addini('lock_timeout', lock_help)
+    parser.addini('lock_priority', priority_help)
@@ -82,7 +82,8 @@ class XDistMasterMetersPlugin:
         max_meters = self.options['max_meters']
         # TODO: add meter scheduler
         #return LoadGroupScheduling(config, log)
-        self.meter_scheduler = MeterScheduler(config, LOGGER, self.lock_timeout,max_meters, log, m, mul)
+        self.meter_scheduler = MeterScheduler(config, LOGGER, self.lock_timeout,max_meters, log, m, mul,
+                                              priority=self.options.get('lock_priority', 0))
         return self.meter_scheduler
 
     #@pytest.hookimpl(tryfirst=True)
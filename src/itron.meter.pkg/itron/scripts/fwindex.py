@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+#
+# Description: maintain the firmware build catalog used by FwMan.get_build
+#
+# Usage: fw-index [--full] [--jobs N] [--path BUILD_PATH ...] [--csv FILE]
+
+import csv
+import logging
+import argparse
+from rohan.meter import FwMan
+from rohan.meter.BuildCatalog import BuildIndexer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index new and changed firmware builds into the version catalog')
+    parser.add_argument('--full', action='store_true', help="re-list every directory and re-index every build")
+    parser.add_argument('-j', '--jobs', type=int, default=8, help="builds processed at the same time")
+    parser.add_argument('--path', action='append', help="build directory to scan (default: all GEN5_RIVA_SR_10*/Latest)")
+    parser.add_argument('--no-digests', action='store_true', help="do not download packages to record their SHA-256")
+    parser.add_argument('--no-agents', action='store_true', help="do not record DI AppServices and HAN versions")
+    parser.add_argument('--csv', type=str, help="also write the catalog to a csv file")
+    parser.add_argument('-d', '--debug', action='store_true', help="set log level to debug")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    indexer = BuildIndexer(jobs=args.jobs, digests=not args.no_digests, agents=not args.no_agents, refresh=args.full)
+    results = indexer.run(args.path)
+
+    summary = {}
+    for result in results.values():
+        key = result if isinstance(result, str) else 'failed'
+        summary[key] = summary.get(key, 0) + 1
+    print(", ".join(f"{count} {key}" for key, count in sorted(summary.items())) or "no builds found")
+
+    if args.csv:
+        csv_columns = ['fw_version', 'as_ver', 'han_ver', 'fw_path', 'coldstart']
+        with open(args.csv, 'w') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=csv_columns, extrasaction='ignore')
+            writer.writeheader()
+            for _, data in FwMan.version_tree.items():
+                writer.writerow(data)
+
+    exit(1 if 'failed' in summary else 0)
+
+
+if __name__ == "__main__":
+    main()
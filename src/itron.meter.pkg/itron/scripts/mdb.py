@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
 from kaizenbot.kbotdbclient_psql import _KBotDBClient_psql
-from rohan.meter.MeterDB import MeterDB
+from rohan.meter.MeterDB import MeterDB, EVENT_DAYS
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse
 import abc
+import gzip
 import sys
 import os
 import json
@@ -164,12 +165,93 @@ class cmd_dump(CommandEntry):
         super().__init__(name, "dump database")
 
     def run_command(self,mgr,args, unknown):
-        data = mgr.dump()
-        print(data)
+        compress = args.compress or (args.output and args.output.endswith('.gz'))
+        if args.output:
+            out = gzip.open(args.output, 'wt') if compress else open(args.output, 'w')
+        else:
+            out = gzip.open(sys.stdout.buffer, 'wt') if compress else sys.stdout
+        try:
+            mgr.dump(out, tables=args.table, copy=args.copy)
+        finally:
+            if out is not sys.stdout:
+                out.close()
 
     def add_parameters(self, parser):
-        #generic_parameters(parser)
-        pass
+        parser.add_argument('-o', '--output', type=str, default=None, help="write to a file instead of stdout, gzip when it ends with .gz")
+        parser.add_argument('-t', '--table', action='append', default=None, help="table to dump, repeat for more, default all")
+        parser.add_argument('-z', '--compress', action='store_true', help="gzip the output")
+        parser.add_argument('--copy', action='store_true', help="COPY blocks instead of INSERT statements (postgres)")
+
+class cmd_stats(CommandEntry):
+    def __init__(self):
+        name = type(self).__name__.split('_')[1]
+        super().__init__(name, "meter utilisation, lock wait times and contention hotspots")
+
+    @staticmethod
+    def seconds(value):
+        """ 90, 30m, 24h or 7d as seconds """
+        units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+        if value[-1:] in units:
+            return float(value[:-1]) * units[value[-1]]
+        return float(value)
+
+    def run_command(self,mgr,args, unknown):
+        until = time.time() - self.seconds(args.until)
+        since = until - self.seconds(args.since)
+        meters = [m.ip_address for m in mgr.get_meters()]
+        stats = mgr.lock_stats(since, until, nodes=meters, host=args.host, build=args.build, top=args.top)
+        if args.json:
+            print(json.dumps(stats, indent=2))
+            return
+
+        def fmt(value):
+            return "-" if value is None else "%.1fs" % value
+
+        start, end = (datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M") for t in stats['window'])
+        requests, waits = stats['requests'], stats['waits']
+        print("window %s - %s (%.1f h)" % (start, end, (until - since) / 3600))
+        print("requests %d  granted %d  cancelled %d  waiting %d" % (
+            requests['made'], requests['granted'], requests['cancelled'], requests['waiting']))
+        print("wait p50 %s  p90 %s  p99 %s  max %s" % (fmt(waits['p50']), fmt(waits['p90']), fmt(waits['p99']), fmt(waits['max'])))
+        print("peak meters locked %d of %d" % (stats['peak'], len(meters)))
+        print()
+        print("%-20s %6s %7s %8s %7s %7s %9s" % ("meter", "util", "grants", "held h", "denies", "waits", "wait s"))
+        for ip, entry in sorted(stats['meters'].items(), key=lambda item: item[1]['utilisation'], reverse=True):
+            print("%-20s %5.1f%% %7d %8.2f %7d %7d %9.1f" % (ip, entry['utilisation'] * 100, entry['grants'], entry['held'] / 3600,
+                                                          entry['denies'], entry['waits'], entry['wait_time']))
+        if stats['hotspots']:
+            print()
+            print("hotspots: " + ", ".join(stats['hotspots']))
+        if stats['hosts']:
+            print()
+            print("%-30s %7s %9s %9s  %s" % ("host", "grants", "requests", "wait p50", "builds"))
+            for host, entry in sorted(stats['hosts'].items(), key=lambda item: str(item[0])):
+                print("%-30s %7d %9d %9s  %s" % (host, entry['grants'], entry['requests'], fmt(entry['wait_p50']), ' '.join(entry['builds'])))
+
+    def add_parameters(self, parser):
+        parser.add_argument('--since', type=str, default="24h", help="window length back from --until, like 30m, 24h or 7d")
+        parser.add_argument('--until', type=str, default="0", help="window end this long ago, default now")
+        parser.add_argument('--host', type=str, default=None, help="only the locks of this host")
+        parser.add_argument('--build', type=str, default=None, help="only the locks of this pipeline build id")
+        parser.add_argument('--top', type=int, default=10, help="number of contention hotspots")
+        parser.add_argument('--json', action='store_true', help="print the statistics as json")
+
+class cmd_migrate(CommandEntry):
+    def __init__(self):
+        name = type(self).__name__.split('_')[1]
+        super().__init__(name, "add the meter lock tables and columns, and drop old lock events")
+
+    def run_command(self,mgr,args, unknown):
+        before, after = mgr.migrate()
+        if before == after:
+            print("schema version %s, up to date" % after)
+        else:
+            print("schema version %s -> %s" % (before, after))
+        if args.days > 0:
+            print("dropped %d lock events older than %g days" % (mgr.purge_events(args.days), args.days))
+
+    def add_parameters(self, parser):
+        parser.add_argument('--days', type=float, default=EVENT_DAYS, help="keep this many days of lock events, 0 keeps them all")
 
 class cmd_listdb(CommandEntry):
     def __init__(self):
@@ -226,6 +308,14 @@ class cmd_unlock(CommandEntry):
 
     def run_command(self,mgr,args, unknown):
         print("nodes: ", unknown)
+        if args.owner:
+            # only what that session still holds, its lease may have been taken over
+            released = mgr.unlock_nodes(unknown, owner=args.owner)
+            print("unlocked: ", released)
+            skipped = [node for node in unknown if node not in released]
+            if skipped:
+                print("not locked by %s: %s" % (args.owner, skipped))
+            return
         for node in unknown:
             try:
                 data = mgr.force_unlock_node(node)
@@ -233,8 +323,7 @@ class cmd_unlock(CommandEntry):
                 print("error unlocking ", node, e)
 
     def add_parameters(self, parser):
-        #generic_parameters(parser)
-        pass
+        parser.add_argument('--owner', type=str, default=None, help="only unlock nodes held by this lock owner")
 
 
 class cmd_resetlocks(CommandEntry):
@@ -382,6 +471,8 @@ def main():
         cmd_sql(),
         cmd_lock(),
         cmd_locks(),
+        cmd_stats(),
+        cmd_migrate(),
         cmd_unlock(),
         cmd_resetlocks(),
         cmd_deactivate(),